@@ -20,11 +20,26 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
-from . import database, schemas, models
+from . import database, schemas, models, auth_cache, permissions
 
 # Supabase provides the bearer token
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login", auto_error=False)
 
+def decode_token(token: str) -> Optional[dict]:
+    """
+    Verifies a Supabase token and returns its claims, or None if invalid.
+    Claims of tokens seen before are served from the cache until `exp`.
+    """
+    claims = auth_cache.get_claims(token)
+    if claims is not None:
+        return claims
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_aud": False})
+    except JWTError:
+        return None
+    auth_cache.put_claims(token, claims)
+    return claims
+
 def get_user_from_token(token: str, db: Session) -> Optional[models.User]:
     """
     Validates token and returns user, creating if necessary (Supabase sync).
@@ -33,21 +48,27 @@ def get_user_from_token(token: str, db: Session) -> Optional[models.User]:
     if not token:
         return None
 
-    try:
-        # Verify Supabase Token
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_aud": False})
-        supabase_uid: str = payload.get("sub")
-        email: str = payload.get("email")
-        user_metadata = payload.get("user_metadata", {})
-        
-        if supabase_uid is None:
-            return None
-            
-    except JWTError:
+    # Verify Supabase Token
+    payload = decode_token(token)
+    if payload is None:
+        return None
+    supabase_uid: str = payload.get("sub")
+    email: str = payload.get("email")
+    user_metadata = payload.get("user_metadata", {})
+
+    if supabase_uid is None:
         return None
 
+    # Fast path: recently resolved identity
+    user = auth_cache.get_user(db, supabase_uid)
+    if user:
+        return user
+
     # Check if user exists in our DB
     user = db.query(models.User).filter(models.User.supabase_id == supabase_uid).first()
+    if user:
+        auth_cache.put_user(user)
+        return user
     
     # Auto-linking / Provisioning
     if not user:
@@ -95,6 +116,7 @@ def get_user_from_token(token: str, db: Session) -> Optional[models.User]:
                     
                     db.commit()
                     db.refresh(new_user)
+                    permissions.invalidate_user(new_user.id)
                     user = new_user
                     break # Success
                 except Exception:
@@ -120,7 +142,8 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
     user = get_user_from_token(token, db)
-    if not user:
+    # Deleted accounts stop working right away, before their data is purged
+    if not user or user.deleted_at is not None:
         raise credentials_exception
     return user
 
@@ -135,30 +158,17 @@ def get_supabase_identity(token: str = Depends(oauth2_scheme)):
     )
     if not token:
         raise credentials_exception
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_aud": False})
-        uid: str = payload.get("sub")
-        email: str = payload.get("email")
-        if uid is None:
-            raise credentials_exception
-        return {"supabase_id": uid, "email": email}
-    except JWTError:
+    payload = decode_token(token)
+    if payload is None or payload.get("sub") is None:
         raise credentials_exception
+    return {"supabase_id": payload.get("sub"), "email": payload.get("email")}
 
 def has_permission(user_id: int, permission_name: str, db: Session):
     """
     Checks if a user has a specific permission.
+    Resolved in memory from the cached role/permission matrix.
     """
-    # Join User -> UserRoles -> Roles -> RolePermissions -> Permission
-    permission = db.query(models.Permission)\
-        .join(models.RolePermissions, models.RolePermissions.permission_id == models.Permission.id)\
-        .join(models.Roles, models.Roles.id == models.RolePermissions.role_id)\
-        .join(models.UserRoles, models.UserRoles.role_id == models.Roles.id)\
-        .filter(models.UserRoles.user_id == user_id)\
-        .filter(models.Permission.permission_name == permission_name)\
-        .first()
-    
-    return permission is not None
+    return permission_name in permissions.resolver.permissions_for(user_id, db)
 
 class PermissionChecker:
     def __init__(self, required_permission: str):
@@ -0,0 +1,120 @@
+"""
+In-process caches for the authentication fast path.
+
+- Token cache: sha256(token) -> verified JWT claims, kept until the token's
+  `exp` passes so repeated requests skip `jwt.decode`.
+- Identity cache: supabase_id -> snapshot of the `users` row, kept for a short
+  TTL so repeated requests skip the lookup SELECT. Snapshots are re-attached
+  to the caller's session with `merge(load=False)`, which issues no query.
+
+Both are bounded LRU maps and per worker process; the identity TTL bounds how
+long another worker's profile change can go unseen.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from . import models, metrics
+
+TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000"))
+# Used for tokens that carry no `exp` claim
+TOKEN_CACHE_DEFAULT_TTL = float(os.getenv("AUTH_TOKEN_CACHE_DEFAULT_TTL", "300"))
+USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", "30"))
+
+class TTLCache:
+    """Bounded LRU map whose entries carry their own absolute expiry time."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, expires_at: float):
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+_tokens = TTLCache(TOKEN_CACHE_SIZE)
+_users = TTLCache(USER_CACHE_SIZE)
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def get_claims(token: str) -> Optional[dict]:
+    return _tokens.get(_digest(token))
+
+def put_claims(token: str, claims: dict):
+    exp = claims.get("exp")
+    expires_at = float(exp) if exp is not None else time.time() + TOKEN_CACHE_DEFAULT_TTL
+    _tokens.put(_digest(token), claims, expires_at)
+
+def get_user(db: Session, supabase_id: str) -> Optional[models.User]:
+    """Returns the cached user attached to `db`, or None on a miss."""
+    snapshot = _users.get(supabase_id)
+    if snapshot is None:
+        return None
+    user = models.User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+def put_user(user: models.User):
+    if not user.supabase_id:
+        return
+    snapshot = {attr.key: getattr(user, attr.key) for attr in sa_inspect(models.User).column_attrs}
+    _users.put(user.supabase_id, snapshot, time.time() + USER_CACHE_TTL)
+
+def invalidate_user(supabase_id: Optional[str]):
+    if supabase_id:
+        _users.pop(supabase_id)
+
+def clear():
+    _tokens.clear()
+    _users.clear()
+
+def stats() -> dict:
+    return {"tokens": _tokens.stats(), "users": _users.stats()}
+
+metrics.register("auth_cache", stats)
@@ -0,0 +1,398 @@
+"""
+Archival of cold chat messages.
+
+Messages older than CHAT_ARCHIVE_AFTER_DAYS are moved out of `chat_messages`
+into `chat_archive_segments`: each segment holds the next CHAT_ARCHIVE_SEGMENT_SIZE
+oldest messages of one room as a single zlib-compressed JSON blob, written
+in the same transaction that deletes the rows. Segments are append-only
+(only moderation and a user's deletion rewrite them), never overlap, and all
+sort before the room's messages still in the table, so the hot table and its
+indexes stay proportional to recent traffic.
+
+A room's old messages are only archived in full segments; up to one
+segment's worth of old messages per room stays in the table until more
+arrive.
+
+`get_messages` falls through to `read_before` when a page reaches past the
+oldest message in the table, and cursors keep working across the boundary
+since both sides page by (created_at, id). Room exports read the archive
+first (`export_rows`). Deleting, hiding or unhiding archived messages
+(`delete_message`, `moderate`) rewrites their segments; a segment's
+`min_id`/`max_id` bound the ids inside it, which are only roughly in time
+order (chat_pipeline allocates them in blocks per worker).
+
+Every worker runs an archiver every CHAT_ARCHIVE_INTERVAL seconds; on
+Postgres, a per-room advisory lock keeps two workers from archiving the same
+room at once.
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Iterator, List, Optional
+
+from sqlalchemy import delete, exists, func, insert, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import database, metrics, models
+from .pagination import decode_cursor, encode_cursor, keyset_filter
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("CHAT_ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.getenv("CHAT_ARCHIVE_INTERVAL", "3600"))
+SEGMENT_SIZE = int(os.getenv("CHAT_ARCHIVE_SEGMENT_SIZE", "1000"))
+# Per pass, so a large backlog is worked off over several passes
+MAX_SEGMENTS_PER_RUN = int(os.getenv("CHAT_ARCHIVE_MAX_SEGMENTS", "200"))
+# Segments decoded per query by exports and user deletion
+SEGMENTS_PER_FETCH = 20
+
+# pg_try_advisory_xact_lock(ARCHIVE_LOCK_CLASS, room_id)
+ARCHIVE_LOCK_CLASS = 727166002
+
+segments = models.ChatArchiveSegment.__table__
+
+ExportRow = namedtuple("ExportRow", ["id", "created_at", "user_id", "username", "content"])
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _utc(value: datetime) -> datetime:
+    # SQLite hands back naive timestamps
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+def _encode(rows) -> bytes:
+    return zlib.compress(json.dumps(
+        [[row.id, row.created_at.isoformat(), row.user_id, row.content, bool(row.is_hidden)] for row in rows],
+        separators=(",", ":"), ensure_ascii=False
+    ).encode())
+
+def _decode(data: bytes) -> List[SimpleNamespace]:
+    """The messages of a segment, oldest first."""
+    return [
+        SimpleNamespace(id=id, created_at=datetime.fromisoformat(created_at), user_id=user_id,
+                        content=content, is_hidden=is_hidden)
+        for id, created_at, user_id, content, is_hidden in json.loads(zlib.decompress(data))
+    ]
+
+def _segment_values(messages) -> dict:
+    first, last = messages[0], messages[-1]
+    return {
+        "first_created_at": first.created_at,
+        "first_id": first.id,
+        "last_created_at": last.created_at,
+        "last_id": last.id,
+        "min_id": min(m.id for m in messages),
+        "max_id": max(m.id for m in messages),
+        "message_count": len(messages),
+        "user_ids": "," + ",".join(str(user_id) for user_id in sorted({m.user_id for m in messages})) + ",",
+        "data": _encode(messages),
+    }
+
+def _key(message) -> tuple:
+    return _utc(message.created_at), message.id
+
+async def read_before(db: AsyncSession, room_id: int, before: Optional[str], limit: int) -> list:
+    """
+    Up to `limit` archived messages of the room, newest first, that sort
+    before the cursor `before` (all of them when None). They are shaped like
+    ChatMessage rows, with `owner` loaded.
+    """
+    started = time.perf_counter()
+    Segment = models.ChatArchiveSegment
+    bound = None
+    if before:
+        created_at, message_id = decode_cursor(before)
+        bound = (_utc(datetime.fromisoformat(created_at)), message_id)
+
+    found = []
+    cursor = before
+    while len(found) < limit:
+        query = select(Segment.first_created_at, Segment.first_id, Segment.data).where(Segment.room_id == room_id)
+        if cursor:
+            # The segment holding the bound starts before it
+            query = query.where(keyset_filter((Segment.first_created_at, Segment.first_id), cursor))
+        segment = (await db.execute(
+            query.order_by(Segment.first_created_at.desc(), Segment.first_id.desc()).limit(1)
+        )).first()
+        if segment is None:
+            break
+        for message in reversed(_decode(segment.data)):
+            if message.is_hidden or (bound is not None and _key(message) >= bound):
+                continue
+            found.append(message)
+            if len(found) == limit:
+                break
+        cursor = encode_cursor(segment.first_created_at, segment.first_id)
+
+    if found:
+        owners = {user.id: user for user in (await db.execute(
+            select(models.User).where(models.User.id.in_({m.user_id for m in found}))
+        )).scalars()}
+        found = [
+            SimpleNamespace(id=m.id, content=m.content, room_id=room_id, created_at=m.created_at,
+                            user_id=m.user_id, owner=owners[m.user_id])
+            for m in found if m.user_id in owners
+        ]
+    archiver.record_read(time.perf_counter() - started)
+    return found
+
+def export_rows(room_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[list]:
+    """Archived messages of a room, oldest first, as lists of ExportRow (one per segment)."""
+    Segment = models.ChatArchiveSegment
+    since_key = _utc(since) if since is not None else None
+    until_key = _utc(until) if until is not None else None
+    after_id = 0
+    while True:
+        # Segments of a room are appended in message order, so their ids are too
+        query = select(Segment.id, Segment.data).where(Segment.room_id == room_id, Segment.id > after_id)
+        if since is not None:
+            query = query.where(Segment.last_created_at >= since)
+        if until is not None:
+            query = query.where(Segment.first_created_at < until)
+        with database.replica_engine.connect() as conn:
+            fetched = conn.execute(query.order_by(Segment.id).limit(SEGMENTS_PER_FETCH)).all()
+            decoded = [_decode(segment.data) for segment in fetched]
+            user_ids = {m.user_id for messages in decoded for m in messages}
+            usernames = dict(conn.execute(
+                select(models.User.id, models.User.username).where(models.User.id.in_(user_ids))
+            ).all()) if user_ids else {}
+        if not fetched:
+            return
+        for messages in decoded:
+            rows = [
+                ExportRow(m.id, m.created_at, m.user_id, usernames.get(m.user_id), m.content)
+                for m in messages
+                if not m.is_hidden
+                and (since_key is None or _utc(m.created_at) >= since_key)
+                and (until_key is None or _utc(m.created_at) < until_key)
+            ]
+            if rows:
+                yield rows
+        after_id = fetched[-1].id
+
+def _rewrite(conn, segment, matches, action: str, limit: Optional[int] = None) -> list:
+    """
+    Deletes, hides or unhides the messages of a segment for which `matches`
+    is true (the first `limit` of them), rewriting the segment (or dropping it
+    once empty). Returns the ids of the messages changed; those already in the
+    requested state are not.
+    """
+    messages = _decode(segment.data)
+    kept, changed = [], []
+    for message in messages:
+        if (limit is None or len(changed) < limit) and matches(message) \
+                and (action == "delete" or message.is_hidden != (action == "hide")):
+            changed.append(message.id)
+            if action == "delete":
+                continue
+            message.is_hidden = action == "hide"
+        kept.append(message)
+    if not changed:
+        return changed
+    if kept:
+        conn.execute(update(segments).where(segments.c.id == segment.id).values(_segment_values(kept)))
+    else:
+        conn.execute(delete(segments).where(segments.c.id == segment.id))
+    return changed
+
+def remove_user(conn, user_id: int) -> int:
+    """
+    Deletion step: rewrites up to SEGMENTS_PER_FETCH segments holding
+    messages of the user without them. Returns the number of messages removed.
+    """
+    fetched = conn.execute(
+        select(segments.c.id, segments.c.data)
+        .where(segments.c.user_ids.like(f"%,{int(user_id)},%"))
+        .limit(SEGMENTS_PER_FETCH)
+        .with_for_update()
+    ).all()
+    return sum(len(_rewrite(conn, segment, lambda m: m.user_id == user_id, "delete")) for segment in fetched)
+
+def delete_message(conn, message_id: int) -> Optional[int]:
+    """Deletes one archived message. Returns its room id, or None if it is not archived."""
+    fetched = conn.execute(
+        select(segments.c.id, segments.c.room_id, segments.c.data)
+        .where(segments.c.max_id >= message_id, segments.c.min_id <= message_id)
+        .with_for_update()
+    ).all()
+    for segment in fetched:
+        if _rewrite(conn, segment, lambda m: m.id == message_id, "delete"):
+            return segment.room_id
+    return None
+
+def moderate(conn, request, after_segment: int = 0, size: int = SEGMENTS_PER_FETCH) -> Optional[tuple]:
+    """
+    Applies a bulk moderation request on chat messages (schemas.BulkModeration)
+    to the archive: rewrites the segments after `after_segment`, in id order,
+    changing at most `size` messages. Returns (position to pass as
+    `after_segment` next, {room_id: [message ids changed]}, messages changed),
+    or None when no segment is left.
+    """
+    query = select(segments.c.id, segments.c.room_id, segments.c.data).where(segments.c.id > after_segment)
+    ids = set(request.ids) if request.ids is not None else None
+    if ids is not None:
+        if not ids:
+            return None
+        query = query.where(segments.c.max_id >= min(ids), segments.c.min_id <= max(ids))
+    if request.author_id is not None:
+        query = query.where(segments.c.user_ids.like(f"%,{int(request.author_id)},%"))
+    if request.room_id is not None:
+        query = query.where(segments.c.room_id == request.room_id)
+    if request.since is not None:
+        query = query.where(segments.c.last_created_at >= request.since)
+    if request.until is not None:
+        query = query.where(segments.c.first_created_at < request.until)
+    since = _utc(request.since) if request.since is not None else None
+    until = _utc(request.until) if request.until is not None else None
+
+    def matches(message) -> bool:
+        return (ids is None or message.id in ids) \
+            and (request.author_id is None or message.user_id == request.author_id) \
+            and (since is None or _utc(message.created_at) >= since) \
+            and (until is None or _utc(message.created_at) < until)
+
+    fetched = conn.execute(query.order_by(segments.c.id).limit(SEGMENTS_PER_FETCH).with_for_update()).all()
+    if not fetched:
+        return None
+    rooms, changed = {}, 0
+    for segment in fetched:
+        last_id = segment.id
+        ids_changed = _rewrite(conn, segment, matches, request.action, size - changed)
+        if ids_changed:
+            rooms.setdefault(segment.room_id, []).extend(ids_changed)
+            changed += len(ids_changed)
+        if changed >= size:
+            # The segment may hold more matches: the next call starts at it
+            # again, and finds the messages changed here no longer matching
+            last_id = segment.id - 1
+            break
+    return last_id, rooms, changed
+
+class ChatArchiver:
+    def __init__(self, interval: float = ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.segments_written = 0
+        self.messages_archived = 0
+        self.last_run_ms = 0.0
+        self.reads = 0
+        self.read_ms_total = 0.0
+        self.last_read_ms = 0.0
+        self.sizes = {}
+
+    async def start(self):
+        if self._task is not None or self.interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Archiving uses the sync engine, so it runs off the event loop
+                archived = await asyncio.to_thread(self.archive)
+                if archived:
+                    print(f"Chat archive: archived {archived} messages")
+            except Exception as e:
+                print(f"Chat archive: run failed: {e}")
+
+    def archive(self, older_than: Optional[datetime] = None) -> int:
+        """One pass over all rooms. Returns the number of messages archived."""
+        started = time.perf_counter()
+        cutoff = older_than or _now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+        Message = models.ChatMessage
+        with database.engine.connect() as conn:
+            # Index probes per room instead of a scan of the whole table
+            room_ids = conn.execute(
+                select(models.Room.id).where(exists().where(Message.room_id == models.Room.id, Message.created_at < cutoff))
+            ).scalars().all()
+        archived = written = 0
+        for room_id in room_ids:
+            while written < MAX_SEGMENTS_PER_RUN:
+                count = self._archive_segment(room_id, cutoff)
+                if not count:
+                    break
+                archived += count
+                written += 1
+        self.runs += 1
+        self.segments_written += written
+        self.messages_archived += archived
+        self.last_run_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.measure()
+        return archived
+
+    def _archive_segment(self, room_id: int, cutoff: datetime) -> int:
+        Message = models.ChatMessage
+        with database.engine.begin() as conn:
+            if conn.dialect.name == "postgresql" and not conn.execute(
+                text("SELECT pg_try_advisory_xact_lock(:lock_class, :room_id)"),
+                {"lock_class": ARCHIVE_LOCK_CLASS, "room_id": room_id}
+            ).scalar():
+                return 0
+            rows = conn.execute(
+                select(Message.id, Message.created_at, Message.user_id, Message.content, Message.is_hidden)
+                .where(Message.room_id == room_id, Message.created_at < cutoff)
+                .order_by(Message.created_at, Message.id)
+                .limit(SEGMENT_SIZE)
+            ).all()
+            if len(rows) < SEGMENT_SIZE:
+                return 0
+            conn.execute(insert(segments).values(room_id=room_id, **_segment_values(rows)))
+            conn.execute(delete(Message).where(Message.id.in_([row.id for row in rows])))
+        return len(rows)
+
+    def measure(self):
+        """Refreshes the table size figures reported by stats()."""
+        with database.engine.connect() as conn:
+            hot = None
+            if conn.dialect.name == "postgresql":
+                # The planner's estimate (-1 before the first ANALYZE); an exact count would scan the table
+                hot = conn.execute(text(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = 'chat_messages'::regclass"
+                )).scalar()
+            if hot is None or hot < 0:
+                hot = conn.execute(select(func.count()).select_from(models.ChatMessage)).scalar()
+            count, messages, size = conn.execute(select(
+                func.count(), func.coalesce(func.sum(segments.c.message_count), 0),
+                func.coalesce(func.sum(func.length(segments.c.data)), 0),
+            ).select_from(segments)).one()
+        self.sizes = {
+            "hot_messages": hot,
+            "archive_segments": count,
+            "archive_messages": messages,
+            "archive_bytes": size,
+        }
+
+    def record_read(self, seconds: float):
+        self.reads += 1
+        self.last_read_ms = round(seconds * 1000, 2)
+        self.read_ms_total += seconds * 1000
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "segments_written": self.segments_written,
+            "messages_archived": self.messages_archived,
+            "last_run_ms": self.last_run_ms,
+            **self.sizes,
+            "archive_reads": self.reads,
+            "archive_read_ms_avg": round(self.read_ms_total / self.reads, 2) if self.reads else 0.0,
+            "last_archive_read_ms": self.last_read_ms,
+        }
+
+archiver = ChatArchiver()
+metrics.register("chat_archive", archiver.stats)
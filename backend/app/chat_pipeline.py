@@ -0,0 +1,250 @@
+"""
+Write-behind persistence for chat messages.
+
+Messages get their id and timestamp on the server as soon as they arrive, so
+they can be broadcast immediately. They are then queued and a single writer
+task inserts them into `chat_messages` in batches: one multi-row INSERT every
+CHAT_FLUSH_BATCH_SIZE messages or CHAT_FLUSH_INTERVAL_MS milliseconds,
+whichever comes first. The queue is bounded (CHAT_QUEUE_MAX); when it is full,
+`submit` waits, which slows senders down instead of growing memory. `stop()`
+flushes everything still queued and is called on application shutdown.
+
+Messages whose room or author has been deleted since they were sent are left
+out of the insert (`rejected`). A batch mixes rooms and users, so when one
+row still violates a constraint (its room or author was purged in between)
+the batch is split in halves until only the failing rows are left, and just
+those are dropped. No failed flush ends the writer task, and `submit`
+restarts one that died anyway, so senders never wait on a queue nobody drains.
+
+One pipeline runs per worker process.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+from . import database, models, metrics
+
+BATCH_SIZE = int(os.getenv("CHAT_FLUSH_BATCH_SIZE", "200"))
+FLUSH_INTERVAL_MS = int(os.getenv("CHAT_FLUSH_INTERVAL_MS", "50"))
+QUEUE_MAX = int(os.getenv("CHAT_QUEUE_MAX", "10000"))
+ID_BLOCK_SIZE = int(os.getenv("CHAT_ID_BLOCK_SIZE", "50"))
+FLUSH_RETRIES = int(os.getenv("CHAT_FLUSH_RETRIES", "3"))
+
+_STOP = object()
+
+class MessageIdAllocator:
+    """
+    Hands out `chat_messages.id` values before the row is inserted.
+
+    On Postgres, ids are reserved in blocks from the table's own sequence, so
+    they never collide across workers. SQLite has no sequences; ids continue
+    from MAX(id), which is only safe with a single writer process (local dev).
+    """
+
+    def __init__(self, block_size: int = ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = asyncio.Lock()
+        self._next_local: Optional[int] = None
+
+    async def next_id(self) -> int:
+        if not self._ids:
+            async with self._lock:
+                if not self._ids:
+                    await self._refill()
+        return self._ids.popleft()
+
+    async def _refill(self):
+        async with database.async_engine.connect() as conn:
+            if conn.dialect.name == "postgresql":
+                rows = await conn.execute(
+                    text("SELECT nextval(pg_get_serial_sequence('chat_messages', 'id')) FROM generate_series(1, :n)"),
+                    {"n": self.block_size}
+                )
+                self._ids.extend(row[0] for row in rows)
+                return
+            if self._next_local is None:
+                current = await conn.scalar(text("SELECT COALESCE(MAX(id), 0) FROM chat_messages"))
+                self._next_local = current + 1
+        self._ids.extend(range(self._next_local, self._next_local + self.block_size))
+        self._next_local += self.block_size
+
+class ChatPersistencePipeline:
+    def __init__(self):
+        self.allocator = MessageIdAllocator()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.persisted = 0
+        self.batches = 0
+        self.retries = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.max_batch = 0
+        self.last_flush_ms = 0.0
+
+    async def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=QUEUE_MAX)
+        else:
+            # The writer died: a new one takes over its queue
+            print("Chat pipeline: writer stopped unexpectedly, restarting")
+            self.restarts += 1
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes everything queued so far, then stops the writer."""
+        if self._task is None:
+            return
+        await self.start()
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    async def submit(self, room_id: int, user_id: int, content: str) -> dict:
+        """
+        Assigns an id and timestamp and queues the message for persistence.
+        Returns the row as it will be stored.
+        """
+        if self._task is None or self._task.done():
+            await self.start()
+        row = {
+            "id": await self.allocator.next_id(),
+            "content": content,
+            "room_id": room_id,
+            "user_id": user_id,
+            "created_at": datetime.now(timezone.utc),
+        }
+        await self._queue.put(row)
+        self.enqueued += 1
+        return row
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + FLUSH_INTERVAL_MS / 1000
+            while len(batch) < BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush_safely(batch)
+            if stopping:
+                # Drain whatever was queued behind the stop marker as well
+                while not self._queue.empty():
+                    rest = [self._queue.get_nowait() for _ in range(min(BATCH_SIZE, self._queue.qsize()))]
+                    await self._flush_safely([row for row in rest if row is not _STOP])
+                return
+
+    async def _flush_safely(self, batch):
+        # Nothing a flush raises may end the writer: senders would block on a full queue
+        try:
+            await self._flush(batch)
+        except Exception as e:
+            print(f"Chat pipeline: dropping batch of {len(batch)} messages: {e}")
+            self.dropped += len(batch)
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        for attempt in range(1, FLUSH_RETRIES + 1):
+            try:
+                rows = await self._live(batch)
+                if rows:
+                    await self._insert(rows)
+                stored = len(rows)
+                break
+            except IntegrityError:
+                # Retrying would fail the same way: store what can be stored
+                stored = await self._salvage(rows)
+                break
+            except Exception as e:
+                if attempt == FLUSH_RETRIES:
+                    print(f"Chat pipeline: dropping batch of {len(batch)} messages after {attempt} attempts: {e}")
+                    self.dropped += len(batch)
+                    return
+                self.retries += 1
+                await asyncio.sleep(0.1 * attempt)
+        self.persisted += stored
+        self.rejected += len(batch) - len(rows)
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    async def _live(self, batch) -> list:
+        """The messages of a batch whose room and author are not deleted."""
+        async with database.async_engine.connect() as conn:
+            rooms = set((await conn.scalars(select(models.Room.id).where(
+                models.Room.id.in_({row["room_id"] for row in batch}), models.Room.deleted_at.is_(None)
+            ))).all())
+            users = set((await conn.scalars(select(models.User.id).where(
+                models.User.id.in_({row["user_id"] for row in batch}), models.User.deleted_at.is_(None)
+            ))).all())
+        return [row for row in batch if row["room_id"] in rooms and row["user_id"] in users]
+
+    async def _insert(self, rows):
+        async with database.async_engine.begin() as conn:
+            await conn.execute(insert(models.ChatMessage.__table__).values(rows))
+
+    async def _salvage(self, batch) -> int:
+        """
+        Inserts a batch that violated a constraint (e.g. its room or author was
+        purged meanwhile) by halves, dropping only the rows that fail on their
+        own. Returns the number of rows stored.
+        """
+        if len(batch) == 1:
+            print(f"Chat pipeline: dropping message {batch[0]['id']} (room {batch[0]['room_id']}): constraint violated")
+            self.dropped += 1
+            return 0
+        stored = 0
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                await self._insert(half)
+                stored += len(half)
+            except IntegrityError:
+                stored += await self._salvage(half)
+            except Exception as e:
+                # Not the row's fault, but the batch already used its retries
+                print(f"Chat pipeline: dropping {len(half)} messages while splitting a batch: {e}")
+                self.dropped += len(half)
+        return stored
+
+    def stats(self) -> dict:
+        return {
+            "enqueued": self.enqueued,
+            "persisted": self.persisted,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "retries": self.retries,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+pipeline = ChatPersistencePipeline()
+metrics.register("chat_pipeline", pipeline.stats)
@@ -0,0 +1,107 @@
+"""
+Builds bounded comment threads with one query.
+
+A page of parent comments (top-level comments of a post, or the replies of one
+comment) is the anchor of a recursive CTE that walks down at most `max_depth`
+reply levels and keeps only the first `replies_limit` replies of each parent.
+That single query returns every node with its depth, its owner (joined) and
+its total reply count; the tree is then assembled in memory in O(n).
+
+Ordering is oldest first at every level. A node whose replies were cut off,
+by `replies_limit` or by `max_depth`, has `reply_count > len(replies)`; the
+rest are fetched with `load_threads(parent_id=...)`, starting from
+`replies_cursor` when some replies were already shown.
+"""
+from typing import List, Optional
+
+from sqlalchemy import and_, func, literal, select
+from sqlalchemy.orm import Session, aliased, joinedload
+
+from . import models
+from .pagination import encode_cursor, keyset_filter
+
+def _sort_key(comment: models.Comment):
+    return (comment.created_at, comment.id)
+
+def load_threads(
+    db: Session,
+    post_id: Optional[int] = None,
+    parent_id: Optional[int] = None,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    max_depth: int = 3,
+    replies_limit: int = 3,
+) -> List[dict]:
+    """
+    Returns the top-level comments of `post_id`, or the replies of
+    `parent_id`, as nested dicts shaped like schemas.CommentThread.
+    """
+    Comment = models.Comment
+    # Hiding a comment hides its replies too (moderation), so no walk passes a hidden node
+    anchor = select(Comment.id).where(Comment.is_hidden.is_(False))
+    if parent_id is not None:
+        anchor = anchor.where(Comment.parent_id == parent_id)
+    else:
+        anchor = anchor.where(Comment.post_id == post_id, Comment.parent_id.is_(None))
+    if cursor:
+        anchor = anchor.where(keyset_filter((Comment.created_at, Comment.id), cursor, descending=False))
+    page = anchor.order_by(Comment.created_at, Comment.id).limit(limit).subquery()
+
+    tree = select(page.c.id.label("id"), literal(0).label("depth"))\
+        .cte("comment_tree", recursive=True)
+    child = aliased(Comment)
+    sibling = aliased(Comment)
+    # Only the first `replies_limit` replies of each parent; deeper levels hang off those
+    first_replies = select(sibling.id)\
+        .where(sibling.parent_id == child.parent_id, sibling.is_hidden.is_(False))\
+        .order_by(sibling.created_at, sibling.id)\
+        .limit(replies_limit)\
+        .correlate(child)
+    tree = tree.union_all(
+        select(child.id, tree.c.depth + 1)
+        .join(tree, child.parent_id == tree.c.id)
+        .where(and_(tree.c.depth < max_depth, child.id.in_(first_replies), child.is_hidden.is_(False)))
+    )
+
+    reply = aliased(Comment)
+    reply_count = select(func.count(reply.id))\
+        .where(reply.parent_id == Comment.id, reply.is_hidden.is_(False))\
+        .correlate(Comment)\
+        .scalar_subquery()
+    rows = db.execute(
+        select(Comment, tree.c.depth, reply_count)
+        .join(tree, tree.c.id == Comment.id)
+        .options(joinedload(Comment.owner))
+        .order_by(Comment.created_at, Comment.id)
+    ).all()
+
+    nodes = {}
+    children = {}
+    roots = []
+    for comment, depth, count in rows:
+        nodes[comment.id] = {
+            "id": comment.id,
+            "content": comment.content,
+            "post_id": comment.post_id,
+            "parent_id": comment.parent_id,
+            "created_at": comment.created_at,
+            "owner_id": comment.owner_id,
+            "owner": comment.owner,
+            "reply_count": count,
+            "replies": [],
+            "replies_cursor": None,
+        }
+        if depth == 0:
+            roots.append(comment)
+        else:
+            children.setdefault(comment.parent_id, []).append(comment)
+
+    for parent, replies in children.items():
+        node = nodes.get(parent)
+        if node is None:
+            continue
+        node["replies"] = [nodes[reply.id] for reply in replies]
+        if node["reply_count"] > len(replies):
+            node["replies_cursor"] = encode_cursor(*_sort_key(replies[-1]))
+
+    return [nodes[root.id] for root in roots]
@@ -1,6 +1,8 @@
 import os
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 load_dotenv()
@@ -26,6 +28,41 @@ engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args=connect_args)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Optional read replica for long reads (exports), so they never hold a
+# transaction open on the primary. Falls back to the primary when unset.
+REPLICA_DATABASE_URL = os.getenv("DATABASE_REPLICA_URL")
+if REPLICA_DATABASE_URL and REPLICA_DATABASE_URL.startswith("postgres://"):
+    REPLICA_DATABASE_URL = REPLICA_DATABASE_URL.replace("postgres://", "postgresql://", 1)
+if REPLICA_DATABASE_URL and "sslmode" not in REPLICA_DATABASE_URL and "localhost" not in REPLICA_DATABASE_URL and "sqlite" not in REPLICA_DATABASE_URL:
+    REPLICA_DATABASE_URL += "?sslmode=require"
+
+replica_engine = create_engine(REPLICA_DATABASE_URL, pool_pre_ping=True) if REPLICA_DATABASE_URL else engine
+
+def _async_database_url(url: str):
+    """
+    Maps the sync URL onto its async driver: asyncpg for Postgres,
+    aiosqlite for SQLite. asyncpg does not understand libpq-only options.
+    """
+    url = make_url(url)
+    query = dict(url.query)
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    sslmode = query.pop("sslmode", None)
+    query.pop("channel_binding", None)
+    if sslmode:
+        query["ssl"] = sslmode
+    return url.set(drivername="postgresql+asyncpg", query=query)
+
+async_connect_args = {}
+ASYNC_DATABASE_URL = _async_database_url(SQLALCHEMY_DATABASE_URL)
+if ASYNC_DATABASE_URL.host and "pooler" in ASYNC_DATABASE_URL.host:
+    # PgBouncer in transaction mode (Neon's pooled endpoint) breaks asyncpg's prepared statement cache
+    async_connect_args = {"statement_cache_size": 0}
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, connect_args=async_connect_args, pool_pre_ping=True)
+
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -34,3 +71,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
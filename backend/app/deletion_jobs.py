@@ -0,0 +1,299 @@
+"""
+Background deletion of users and rooms.
+
+Deleting a power user or an active room in one transaction holds locks on
+every table it touches for as long as it runs, and ORM cascades load every
+child row first. Instead, the request only marks the entity (`deleted_at`) and
+records a `deletion_jobs` row, then returns 202. Every worker runs a
+`DeletionWorker` that claims pending jobs and purges dependent rows in
+batches of DELETION_BATCH_SIZE, children before parents, one transaction per
+batch. The batch and the job's progress (`step`, `rows_deleted`) commit
+together.
+
+A claimed job is leased until `locked_until`, renewed with every batch. If the
+worker dies or a batch fails, the lease runs out and any worker runs the job
+again from its first step: every step is a plain "delete what is left", so
+finished steps cost one empty batch each, and rows that arrived after their
+step ran (a chat message still in a worker's write-behind queue) are removed
+before the parent row, whose delete would otherwise fail on them. `step`
+records progress only.
+
+Writes into a deleted room or by a deleted user are refused from the moment
+it is marked, and its open sockets are closed (`websockets.manager`).
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import or_, select, text, update
+from sqlalchemy.orm import Session
+
+from . import auth_cache, chat_archive, database, http_cache, metrics, models, permissions
+
+BATCH_SIZE = int(os.getenv("DELETION_BATCH_SIZE", "1000"))
+POLL_INTERVAL = float(os.getenv("DELETION_POLL_INTERVAL", "2"))
+LEASE_SECONDS = 60
+MAX_ATTEMPTS = 5
+
+jobs = models.DeletionJob.__table__
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+def _delete_batch(conn, table: str, where: str, params: dict, key: str = "id") -> int:
+    """Deletes up to BATCH_SIZE rows of `table` matching `where`."""
+    return conn.execute(text(
+        f"DELETE FROM {table} WHERE {where} AND {key} IN "
+        f"(SELECT {key} FROM {table} WHERE {where} LIMIT :batch)"
+    ), {**params, "batch": BATCH_SIZE}).rowcount
+
+def _step(table: str, where: str, key: str = "id"):
+    return lambda conn, entity_id: _delete_batch(conn, table, where, {"id": entity_id}, key)
+
+def _comments_step(anchor: str):
+    """
+    Deletes the comments matching `anchor` together with all their replies,
+    leaves first, since a comment cannot go before the replies pointing at it.
+    """
+    def run(conn, entity_id):
+        # The CTE sits inside the IN so the statement still starts with
+        # DELETE (sqlite3 reports no rowcount otherwise)
+        return conn.execute(text(f"""
+            DELETE FROM comments WHERE id IN (
+                WITH RECURSIVE doomed(id) AS (
+                    SELECT id FROM comments WHERE {anchor}
+                    UNION
+                    SELECT comments.id FROM comments JOIN doomed ON comments.parent_id = doomed.id
+                )
+                SELECT doomed.id FROM doomed
+                WHERE NOT EXISTS (SELECT 1 FROM comments AS replies WHERE replies.parent_id = doomed.id)
+                LIMIT :batch
+            )
+        """), {"id": entity_id, "batch": BATCH_SIZE}).rowcount
+    return run
+
+def _likes_given(conn, user_id) -> int:
+    # The counters move in the same transaction as the like rows; RETURNING
+    # only yields rows this batch actually removed, so a resumed job cannot
+    # decrement twice
+    post_ids = conn.execute(text(
+        "DELETE FROM post_likes WHERE id IN "
+        "(SELECT id FROM post_likes WHERE user_id = :id LIMIT :batch) RETURNING post_id"
+    ), {"id": user_id, "batch": BATCH_SIZE}).scalars().all()
+    if post_ids:
+        conn.execute(
+            update(models.Post).where(models.Post.id.in_(post_ids))
+            .values(like_count=models.Post.like_count - 1)
+        )
+    return len(post_ids)
+
+USER_POSTS = "(SELECT id FROM posts WHERE owner_id = :id)"
+ROOM_POSTS = "(SELECT id FROM posts WHERE room_id = :id)"
+
+# (name, batch function) in dependency order; the entity row itself goes last
+STEPS = {
+    "user": [
+        ("likes_given", _likes_given),
+        ("saved_posts", _step("saved_posts", "user_id = :id")),
+        ("user_roles", _step("user_roles", "user_id = :id")),
+        ("room_members", _step("room_members", "user_id = :id", key="room_id")),
+        ("read_watermarks", _step("room_read_watermarks", "user_id = :id", key="room_id")),
+        ("chat_messages", _step("chat_messages", "user_id = :id")),
+        ("chat_archive", chat_archive.remove_user),
+        ("comments", _comments_step(f"owner_id = :id OR post_id IN {USER_POSTS}")),
+        ("post_likes", _step("post_likes", f"post_id IN {USER_POSTS}")),
+        ("post_saves", _step("saved_posts", f"post_id IN {USER_POSTS}")),
+        ("posts", _step("posts", "owner_id = :id")),
+        ("user", _step("users", "id = :id")),
+    ],
+    "room": [
+        # Members first, so nobody can post into the room while it is purged
+        ("room_members", _step("room_members", "room_id = :id", key="user_id")),
+        ("read_watermarks", _step("room_read_watermarks", "room_id = :id", key="user_id")),
+        ("chat_messages", _step("chat_messages", "room_id = :id")),
+        ("chat_archive", _step("chat_archive_segments", "room_id = :id")),
+        ("comments", _comments_step(f"post_id IN {ROOM_POSTS}")),
+        ("post_likes", _step("post_likes", f"post_id IN {ROOM_POSTS}")),
+        ("post_saves", _step("saved_posts", f"post_id IN {ROOM_POSTS}")),
+        ("posts", _step("posts", "room_id = :id")),
+        ("room", _step("rooms", "id = :id")),
+    ],
+}
+
+def _invalidate(entity_type: str, entity_id: int, supabase_id: Optional[str] = None):
+    if entity_type == "user":
+        auth_cache.invalidate_user(supabase_id)
+        permissions.invalidate_user(entity_id)
+        http_cache.invalidate("posts", f"memberships:{entity_id}")
+    else:
+        http_cache.invalidate("rooms", "posts")
+
+def _enqueue(db: Session, entity, entity_type: str) -> models.DeletionJob:
+    entity.deleted_at = _now()
+    job = models.DeletionJob(entity_type=entity_type, entity_id=entity.id, status="pending")
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def delete_user(db: Session, user: models.User) -> models.DeletionJob:
+    """Marks the user deleted (they can no longer sign in) and queues the purge."""
+    job = _enqueue(db, user, "user")
+    _invalidate("user", user.id, user.supabase_id)
+    return job
+
+def delete_room(db: Session, room: models.Room) -> models.DeletionJob:
+    """Marks the room deleted (hidden from lists, closed to joins) and queues the purge."""
+    job = _enqueue(db, room, "room")
+    _invalidate("room", room.id)
+    return job
+
+class DeletionWorker:
+    def __init__(self, poll_interval: float = POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.batches = 0
+        self.rows_deleted = 0
+        self.last_batch_ms = 0.0
+
+    async def start(self):
+        if self._task is not None or self.poll_interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                # Purging uses the sync engine, so it runs off the event loop
+                while await asyncio.to_thread(self.run_next):
+                    pass
+            except Exception as e:
+                print(f"Deletion jobs: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def _claim(self, job_id: Optional[int] = None) -> Optional[models.DeletionJob]:
+        """The oldest claimable job, or the given one if it is claimable."""
+        now = _now()
+        with database.SessionLocal() as db:
+            query = select(models.DeletionJob).where(
+                models.DeletionJob.status.in_(["pending", "running"]),
+                or_(models.DeletionJob.locked_until.is_(None), models.DeletionJob.locked_until < now),
+            )
+            if job_id is not None:
+                query = query.where(models.DeletionJob.id == job_id)
+            job = db.scalars(query.order_by(models.DeletionJob.id).limit(1)).first()
+            if job is None:
+                return None
+            # Conditional on the lease, so two workers cannot both take it
+            claimed = db.execute(
+                update(models.DeletionJob)
+                .where(
+                    models.DeletionJob.id == job.id,
+                    or_(models.DeletionJob.locked_until.is_(None), models.DeletionJob.locked_until < now),
+                )
+                .values(
+                    status="running",
+                    attempts=models.DeletionJob.attempts + 1,
+                    locked_until=now + timedelta(seconds=LEASE_SECONDS),
+                    updated_at=now,
+                )
+                # Refreshed below; evaluating the lease in Python trips on SQLite's naive datetimes
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.commit()
+            if not claimed:
+                return None
+            db.refresh(job)
+            db.expunge(job)
+            return job
+
+    def run_next(self) -> bool:
+        """Claims one job and runs it to completion. Returns False when there was none."""
+        job = self._claim()
+        if job is None:
+            return False
+        self._run_claimed(job)
+        return True
+
+    def run_job(self, job_id: int) -> bool:
+        """
+        Claims the given job and runs it to completion. Returns False if it is
+        not claimable: finished, or leased by a worker (or a failed attempt).
+        """
+        job = self._claim(job_id)
+        if job is None:
+            return False
+        self._run_claimed(job)
+        return True
+
+    def _run_claimed(self, job: models.DeletionJob):
+        if job.attempts > MAX_ATTEMPTS:
+            self._finish(job, "failed")
+            self.jobs_failed += 1
+            return
+        try:
+            self._purge(job)
+        except Exception as e:
+            # Leave the lease to run out; the job is retried from the first step
+            print(f"Deletion job {job.id} ({job.entity_type} {job.entity_id}) failed at {job.step}: {e}")
+            with database.engine.begin() as conn:
+                conn.execute(update(jobs).where(jobs.c.id == job.id).values(error=str(e)[:2000], updated_at=_now()))
+            return
+        self._finish(job, "done")
+        self.jobs_done += 1
+        _invalidate(job.entity_type, job.entity_id)
+
+    def _purge(self, job: models.DeletionJob):
+        rows_deleted = job.rows_deleted
+        for name, batch in STEPS[job.entity_type]:
+            while True:
+                started = time.perf_counter()
+                with database.engine.begin() as conn:
+                    deleted = batch(conn, job.entity_id)
+                    rows_deleted += deleted
+                    now = _now()
+                    conn.execute(update(jobs).where(jobs.c.id == job.id).values(
+                        step=name,
+                        rows_deleted=rows_deleted,
+                        updated_at=now,
+                        locked_until=now + timedelta(seconds=LEASE_SECONDS),
+                    ))
+                job.step = name
+                self.batches += 1
+                self.rows_deleted += deleted
+                self.last_batch_ms = round((time.perf_counter() - started) * 1000, 2)
+                if deleted <= 0:
+                    break
+
+    def _finish(self, job: models.DeletionJob, status: str):
+        now = _now()
+        with database.engine.begin() as conn:
+            conn.execute(update(jobs).where(jobs.c.id == job.id).values(
+                status=status, finished_at=now, updated_at=now, locked_until=None
+            ))
+
+    def stats(self) -> dict:
+        return {
+            "jobs_done": self.jobs_done,
+            "jobs_failed": self.jobs_failed,
+            "batches": self.batches,
+            "rows_deleted": self.rows_deleted,
+            "last_batch_ms": self.last_batch_ms,
+        }
+
+worker = DeletionWorker()
+metrics.register("deletion_jobs", worker.stats)
@@ -0,0 +1,103 @@
+"""
+Streaming export of a room's chat history and posts, as NDJSON or CSV.
+
+Rows are read EXPORT_FETCH_SIZE at a time, each fetch in its own short
+transaction that resumes after the last (created_at, id) read, and encoded
+while the response is being sent, so memory stays flat however long the
+history is. A fetch returns its connection to the pool before its rows are
+handed on, so a slow client never holds a connection or keeps a transaction
+(and the vacuum horizon) open. Reads go to the replica when
+DATABASE_REPLICA_URL is set.
+
+The export is therefore not one snapshot: rows created meanwhile after the
+resume point are included, rows deleted meanwhile may or may not be.
+
+Chat exports start with the room's archived messages (chat_archive), which
+all sort before the ones in the table.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+from datetime import datetime
+from typing import Iterator, Optional
+
+from sqlalchemy import select
+
+from . import chat_archive, database, models
+from .pagination import encode_cursor, keyset_filter
+
+FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def _messages(room_id: int):
+    Message = models.ChatMessage
+    return select(
+        Message.id, Message.created_at, Message.user_id, models.User.username, Message.content
+    ).outerjoin(models.User, models.User.id == Message.user_id)\
+        .where(Message.room_id == room_id, Message.is_hidden.is_(False)), Message
+
+def _posts(room_id: int):
+    Post = models.Post
+    return select(
+        Post.id, Post.created_at, Post.owner_id, models.User.username,
+        Post.title, Post.content, Post.attachment_url, Post.like_count
+    ).outerjoin(models.User, models.User.id == Post.owner_id)\
+        .where(Post.room_id == room_id, Post.is_hidden.is_(False)), Post
+
+QUERIES = {"messages": _messages, "posts": _posts}
+
+def _batches(query, model) -> Iterator[list]:
+    """Yields lists of up to FETCH_SIZE rows, oldest first, each read in its own transaction."""
+    order = (model.created_at, model.id)
+    cursor = None
+    while True:
+        page = query if cursor is None else query.where(keyset_filter(order, cursor, descending=False))
+        # Closed before yielding: the consumer may take its time with the rows
+        with database.replica_engine.connect() as conn:
+            rows = conn.execute(page.order_by(*order).limit(FETCH_SIZE)).all()
+        if rows:
+            yield rows
+        if len(rows) < FETCH_SIZE:
+            return
+        cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+def _value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def _ndjson(batches) -> Iterator[str]:
+    for rows in batches:
+        yield "".join(
+            json.dumps({key: _value(value) for key, value in row._asdict().items()}, ensure_ascii=False) + "\n"
+            for row in rows
+        )
+
+def _csv(batches, columns) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, when there was nothing to export
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def stream(kind: str, room_id: int, format: str = "ndjson",
+           since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[str]:
+    """Encoded chunks of the export of `kind` ("messages" or "posts") of a room."""
+    query, model = QUERIES[kind](room_id)
+    if since is not None:
+        query = query.where(model.created_at >= since)
+    if until is not None:
+        query = query.where(model.created_at < until)
+    batches = _batches(query, model)
+    if kind == "messages":
+        batches = itertools.chain(chat_archive.export_rows(room_id, since, until), batches)
+    if format == "csv":
+        return _csv(batches, list(query.selected_columns.keys()))
+    return _ndjson(batches)
@@ -0,0 +1,151 @@
+"""
+Response cache with ETag validators for read-mostly endpoints.
+
+Cached data is grouped into scopes ("rooms", "post:42", "memberships:7"), each
+with a generation token stored in Redis. A response's ETag is a hash of its
+cache key and the current tokens of the scopes it depends on, so it costs one
+MGET and no database work. When the client's If-None-Match matches, the
+answer is a bodyless 304; otherwise the encoded body is served from a
+per-worker TTL cache, and only built from the database on a miss.
+
+Writers call `invalidate(*scopes)` after committing. This replaces each token
+with a fresh random value, which changes every ETag derived from it on all
+workers at once. Tokens are random rather than counters, so a flushed or
+restarted Redis can never bring an old ETag back.
+
+Cache keys must include whatever the body varies on: the query string, and
+the user id for per-user responses. Values too volatile for a scope (online
+counts) go in an `overlay`, applied to the cached data on every request; the
+ETag then also covers the overlaid body.
+"""
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Callable, Optional, Sequence
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+from . import metrics
+from .auth_cache import TTLCache
+from .redis_client import redis_client
+
+CACHE_TTL = float(os.getenv("HTTP_CACHE_TTL", "60"))
+CACHE_SIZE = int(os.getenv("HTTP_CACHE_SIZE", "5000"))
+# Idle tokens expire; a new one only costs each client a full response
+GENERATION_TTL = 86400
+GENERATION_PREFIX = "http_cache:gen:"
+
+def _new_generation() -> str:
+    return uuid.uuid4().hex[:12]
+
+def _encode(data) -> bytes:
+    return json.dumps(jsonable_encoder(data), separators=(",", ":"), ensure_ascii=False).encode()
+
+def _render(build) -> tuple:
+    """Runs `build`, returning the encoded body and the headers it set."""
+    scratch = Response()
+    body = _encode(build(scratch))
+    return body, {name: value for name, value in scratch.headers.items() if name != "content-length"}
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak and strong forms compare equal for If-None-Match
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+class ResponseCache:
+    def __init__(self, client=None, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.client = client or redis_client
+        self.ttl = ttl
+        self._bodies = TTLCache(max_size)
+        self.not_modified = 0
+        self.built = 0
+        self.bypassed = 0
+        self.invalidations = 0
+
+    def generations(self, scopes: Sequence[str]) -> list:
+        keys = [GENERATION_PREFIX + scope for scope in scopes]
+        tokens = self.client.mget(keys)
+        missing = [key for key, token in zip(keys, tokens) if token is None]
+        if missing:
+            # NX, so concurrent first readers agree on one token
+            with self.client.pipeline() as pipe:
+                for key in missing:
+                    pipe.set(key, _new_generation(), ex=GENERATION_TTL, nx=True)
+                for key in missing:
+                    pipe.get(key)
+                created = dict(zip(missing, pipe.execute()[len(missing):]))
+            tokens = [token if token is not None else created[key] for key, token in zip(keys, tokens)]
+        return tokens
+
+    def invalidate(self, *scopes: str):
+        try:
+            with self.client.pipeline() as pipe:
+                for scope in scopes:
+                    pipe.set(GENERATION_PREFIX + scope, _new_generation(), ex=GENERATION_TTL)
+                pipe.execute()
+            self.invalidations += len(scopes)
+        except Exception as e:
+            # Bodies still expire after the TTL, but 304s would go stale: make it loud
+            print(f"HTTP cache: invalidating {scopes} failed ({e})")
+
+    def respond(self, request: Request, key: str, scopes: Sequence[str], build: Callable[[Response], object],
+                overlay: Optional[Callable[[object], object]] = None) -> Response:
+        """
+        Serves `key` from the cache, or from `build(response)` on a miss.
+        `build` returns the response data and may set headers (e.g. the next
+        cursor) on the response it is given; they are cached with the body.
+        `overlay`, if given, takes the decoded data and returns it with live
+        values merged in.
+        """
+        try:
+            tokens = self.generations(scopes)
+        except Exception as e:
+            print(f"HTTP cache: unavailable ({e}), serving uncached")
+            self.bypassed += 1
+            body, extra = _render(build)
+            if overlay is not None:
+                body = _encode(overlay(json.loads(body)))
+            return Response(body, media_type="application/json", headers=extra)
+
+        digest = hashlib.sha256("|".join([key, *tokens]).encode()).hexdigest()[:32]
+        etag = f'"{digest}"'
+        # Per-user bodies must not be shared by intermediaries, and clients must revalidate
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+
+        if_none_match = request.headers.get("if-none-match")
+        if overlay is None and if_none_match and _etag_matches(if_none_match, etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+
+        cached = self._bodies.get((key, etag))
+        if cached is None:
+            cached = _render(build)
+            self._bodies.put((key, etag), cached, time.time() + self.ttl)
+            self.built += 1
+        body, extra = cached
+        if overlay is not None:
+            body = _encode(overlay(json.loads(body)))
+            digest = hashlib.sha256(digest.encode() + body).hexdigest()[:32]
+            headers["ETag"] = f'"{digest}"'
+            if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+                self.not_modified += 1
+                return Response(status_code=304, headers=headers)
+        return Response(body, media_type="application/json", headers={**extra, **headers})
+
+    def stats(self) -> dict:
+        return {
+            **self._bodies.stats(),
+            "not_modified": self.not_modified,
+            "built": self.built,
+            "bypassed": self.bypassed,
+            "invalidations": self.invalidations,
+        }
+
+response_cache = ResponseCache()
+metrics.register("http_cache", response_cache.stats)
+
+def invalidate(*scopes: str):
+    response_cache.invalidate(*scopes)
@@ -0,0 +1,85 @@
+"""
+Maintenance of the denormalized `posts.like_count` column.
+
+`likes.toggle_like` keeps the counter current with an atomic
+`like_count = like_count +/- 1` in the same transaction as the like row.
+Anything that changes `post_likes` some other way (bulk deletes, manual SQL, a
+crash between statements) can leave it off, so every worker periodically
+recomputes the counts and rewrites only the posts that drifted. The job is
+idempotent, so running it on several workers at once is harmless.
+"""
+import asyncio
+import os
+import time
+from typing import Optional
+
+from sqlalchemy import text
+
+from . import database, http_cache, metrics
+
+RECONCILE_INTERVAL = float(os.getenv("LIKE_RECONCILE_INTERVAL", "600"))
+
+RECONCILE_SQL = text("""
+    UPDATE posts SET like_count = counted.n
+    FROM (
+        SELECT posts.id AS post_id, COUNT(post_likes.id) AS n
+        FROM posts LEFT JOIN post_likes ON post_likes.post_id = posts.id
+        GROUP BY posts.id
+    ) AS counted
+    WHERE posts.id = counted.post_id AND posts.like_count <> counted.n
+""")
+
+class LikeCountReconciler:
+    def __init__(self, interval: float = RECONCILE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.corrected = 0
+        self.last_run_ms = 0.0
+
+    async def start(self):
+        if self._task is not None or self.interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def reconcile(self) -> int:
+        """Fixes every drifted counter. Returns the number of posts corrected."""
+        started = time.perf_counter()
+        async with database.async_engine.begin() as conn:
+            result = await conn.execute(RECONCILE_SQL)
+        self.runs += 1
+        self.corrected += result.rowcount
+        self.last_run_ms = round((time.perf_counter() - started) * 1000, 2)
+        if result.rowcount:
+            await asyncio.to_thread(http_cache.invalidate, "posts")
+        return result.rowcount
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                corrected = await self.reconcile()
+                if corrected:
+                    print(f"Like counts: corrected {corrected} posts")
+            except Exception as e:
+                print(f"Like counts: reconcile failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "corrected": self.corrected,
+            "last_run_ms": self.last_run_ms,
+        }
+
+reconciler = LikeCountReconciler()
+metrics.register("like_counts", reconciler.stats)
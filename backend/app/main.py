@@ -1,131 +1,55 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from .database import engine, Base
+from .database import async_engine
+from . import migrations
+from .chat_pipeline import pipeline as chat_pipeline
+from .like_counts import reconciler as like_count_reconciler
+from .deletion_jobs import worker as deletion_worker
+from .chat_archive import archiver as chat_archiver
+from .read_watermarks import writer as read_watermark_writer
+from .redis_client import MockRedis, async_redis_client, redis_client
+from .websockets import manager as connection_manager
 from .routers import auth, rooms, users, posts, likes, comments, moderator # , activity
-from sqlalchemy import text
-from sqlalchemy.exc import ProgrammingError
-
-# Create database tables
-Base.metadata.create_all(bind=engine)
-
-# Manual Migration Check (Temporary for Supabase support)
-def run_migrations():
-    with engine.connect() as connection:
-        try:
-            # Check if column exists
-            connection.execute(text("SELECT supabase_id FROM users LIMIT 1"))
-        except ProgrammingError:
-            print("Migrating DB: Adding supabase_id column to users table...")
-            with engine.begin() as migration_txn:
-                 migration_txn.execute(text("ALTER TABLE users ADD COLUMN supabase_id VARCHAR(255) UNIQUE;"))
-                 migration_txn.execute(text("CREATE INDEX ix_users_supabase_id ON users (supabase_id);"))
-                 migration_txn.execute(text("ALTER TABLE users ALTER COLUMN hashed_password DROP NOT NULL;"))
-            print("Migration complete.")
-
-        try:
-            connection.execute(text("SELECT date_of_birth FROM users LIMIT 1"))
-        except ProgrammingError:
-            print("Migrating DB: Adding date_of_birth column to users table...")
-            with engine.begin() as migration_txn:
-                 migration_txn.execute(text("ALTER TABLE users ADD COLUMN date_of_birth VARCHAR;"))
-            print("date_of_birth Migration complete.")
-
-        try:
-            connection.execute(text("SELECT attachment_url FROM posts LIMIT 1"))
-        except ProgrammingError:
-            print("Migrating DB: Adding attachment_url column to posts table...")
-            with engine.begin() as migration_txn:
-                 migration_txn.execute(text("ALTER TABLE posts ADD COLUMN attachment_url VARCHAR;"))
-            print("attachment_url Migration complete.")
-            
-    # Seed Roles and Permissions (Idempotent Check)
-    try:
-        print("Verifying roles and permissions...")
-        with engine.begin() as seed_txn:
-             # 1. Roles
-            seed_txn.execute(text("INSERT INTO roles (role_name) VALUES ('admin'), ('normal_user') ON CONFLICT (role_name) DO NOTHING"))
-            
-            # 2. Permissions
-            permissions_list = [
-                ('create_post', 'Can create new posts'),
-                ('like_post', 'Can like and unlike posts'),
-                ('chat', 'Can send messages in chat rooms'),
-                ('create_comment', 'Can reply to questions/posts'),
-                ('delete_any_post', 'Admin: Can delete any post'),
-                ('delete_any_comment', 'Admin: Can delete any comment'),
-                ('delete_any_message', 'Admin: Can delete any chat message'),
-                ('manage_rooms', 'Admin: Can create/edit/delete rooms'),
-                ('manage_users', 'Admin: Can manage user accounts')
-            ]
-            for name, desc in permissions_list:
-                seed_txn.execute(
-                    text("INSERT INTO permissions (permission_name, description) VALUES (:name, :desc) ON CONFLICT (permission_name) DO NOTHING"),
-                    {"name": name, "desc": desc}
-                )
-            
-            # 3. Get IDs
-            roles = seed_txn.execute(text("SELECT id, role_name FROM roles")).fetchall()
-            perms = seed_txn.execute(text("SELECT id, permission_name FROM permissions")).fetchall()
-            
-            role_ids = {r[1]: r[0] for r in roles}
-            perm_ids = {p[1]: p[0] for p in perms}
-            
-            # 4. Assign Permissions (Idempotent)
-            def assign_perm(r_name, p_name):
-                r_id = role_ids.get(r_name)
-                p_id = perm_ids.get(p_name)
-                if r_id and p_id:
-                     seed_txn.execute(
-                        text("INSERT INTO role_permissions (role_id, permission_id) SELECT :r_id, :p_id WHERE NOT EXISTS (SELECT 1 FROM role_permissions WHERE role_id = :r_id AND permission_id = :p_id)"),
-                        {"r_id": r_id, "p_id": p_id}
-                    )
-
-            # Admin gets ALL
-            for p_name in perm_ids.keys():
-                assign_perm('admin', p_name)
-            
-            # Normal User gets specific set
-            user_perms = ['create_post', 'like_post', 'chat', 'create_comment']
-            for p_name in user_perms:
-                 assign_perm('normal_user', p_name)
-
-        print("Roles and permissions verification complete.")
-    except Exception as e:
-        print(f"Error seeding roles/permissions: {e}")
-
-    # Seed Rooms if empty
-    try:
-        with engine.connect() as connection:
-            result = connection.execute(text("SELECT count(*) FROM rooms"))
-            count = result.scalar()
-            
-        if count == 0:
-            print("Seeding default rooms...")
-            default_rooms = [
-                ("JEE Mains", "Dedicated to JEE Mains preparation and discussion."),
-                ("JEE Advance", "Advanced topics and problem solving for JEE Advance."),
-                ("CAT", "Crack the CAT with peer support and resources."),
-                ("NIMCET", "NIMCET exam preparation community."),
-                ("Programming", "Discuss coding, algorithms, and development."),
-                ("10th", "Study group for 10th grade students."),
-                ("12th", "Study group for 12th grade students.")
-            ]
-            with engine.begin() as seed_txn:
-                for name, desc in default_rooms:
-                    seed_txn.execute(
-                        text("INSERT INTO rooms (name, description) VALUES (:name, :desc)"),
-                        {"name": name, "desc": desc}
-                    )
-            print("Rooms seeded successfully.")
-    except Exception as e:
-        print(f"Error seeding rooms: {e}")
-
-run_migrations()
 
 from fastapi.middleware.cors import CORSMiddleware
+from .pagination import NEXT_CURSOR_HEADER
+
+# Set to false when migrations are run out of band (python -m app.migrations)
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if MIGRATE_ON_STARTUP:
+        # A single ledger query when the schema is current
+        await asyncio.to_thread(migrations.migrate)
+    if isinstance(redis_client, MockRedis):
+        # Active expiry for the in-memory store
+        await redis_client.start()
+    await chat_pipeline.start()
+    await read_watermark_writer.start()
+    await connection_manager.start()
+    await like_count_reconciler.start()
+    await deletion_worker.start()
+    await chat_archiver.start()
+    yield
+    await chat_archiver.stop()
+    await deletion_worker.stop()
+    await like_count_reconciler.stop()
+    await connection_manager.stop()
+    # Reads reported since the last flush
+    await read_watermark_writer.stop()
+    # Persist any chat messages still queued before the worker exits
+    await chat_pipeline.stop()
+    if isinstance(redis_client, MockRedis):
+        await redis_client.stop()
+    # Its pooled connections belong to this event loop
+    await async_redis_client.aclose()
+    await async_engine.dispose()
+
+app = FastAPI(title="Synapse API", lifespan=lifespan)
 
-app = FastAPI(title="Synapse API")
-
-import os
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -151,6 +75,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 app.include_router(auth.router)
@@ -0,0 +1,16 @@
+"""
+Tiny in-process metrics registry.
+
+Subsystems register a collector (a zero-argument callable returning a dict of
+counters) under a name, and `/moderator/metrics` returns a snapshot of all of
+them. Counters are per worker process.
+"""
+from typing import Callable, Dict
+
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+def register(name: str, collector: Callable[[], dict]):
+    _collectors[name] = collector
+
+def snapshot() -> Dict[str, dict]:
+    return {name: collector() for name, collector in _collectors.items()}
@@ -0,0 +1,363 @@
+"""
+Versioned schema migrations.
+
+Every change to the schema (or to seed data) is a numbered function registered
+with `@migration`. Applied versions are recorded in the `schema_migrations`
+table, so a worker booting against an up-to-date database costs one query:
+`SELECT max(version) FROM schema_migrations`.
+
+When something is pending, the runner takes a Postgres advisory lock, so with
+several workers booting at once only one migrates while the others wait and
+then find nothing left to do. Each migration runs in its own transaction
+together with its ledger row, unless it is registered with
+`transactional=False` (e.g. CREATE INDEX CONCURRENTLY).
+
+Migrations must be safe on databases that predate the ledger, which already
+have some of these changes applied: check before altering.
+
+Run out of band with `python -m app.migrations` (add `--status` to only list
+what is pending), and set MIGRATE_ON_STARTUP=false to keep workers from
+migrating at boot.
+"""
+import json
+import sys
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, insert, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from . import database, like_counts, models, permissions, search
+
+Migration = namedtuple("Migration", ["version", "name", "apply", "transactional"])
+
+MIGRATIONS = []
+
+# Arbitrary, but must stay the same across releases
+ADVISORY_LOCK_ID = 727166001
+
+_ledger_metadata = MetaData()
+ledger = Table(
+    "schema_migrations", _ledger_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+def migration(version: int, name: str, transactional: bool = True):
+    def register(fn):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} ({name}) must come after {MIGRATIONS[-1].version}")
+        MIGRATIONS.append(Migration(version, name, fn, transactional))
+        return fn
+    return register
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+@migration(1, "initial_schema")
+def _initial_schema(conn):
+    database.Base.metadata.create_all(bind=conn)
+
+@migration(2, "users_supabase_id")
+def _users_supabase_id(conn):
+    if _has_column(conn, "users", "supabase_id"):
+        return
+    conn.execute(text("ALTER TABLE users ADD COLUMN supabase_id VARCHAR(255) UNIQUE"))
+    conn.execute(text("CREATE INDEX ix_users_supabase_id ON users (supabase_id)"))
+    conn.execute(text("ALTER TABLE users ALTER COLUMN hashed_password DROP NOT NULL"))
+
+@migration(3, "users_date_of_birth")
+def _users_date_of_birth(conn):
+    if not _has_column(conn, "users", "date_of_birth"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN date_of_birth VARCHAR"))
+
+@migration(4, "posts_attachment_url")
+def _posts_attachment_url(conn):
+    if not _has_column(conn, "posts", "attachment_url"):
+        conn.execute(text("ALTER TABLE posts ADD COLUMN attachment_url VARCHAR"))
+
+@migration(5, "posts_like_count")
+def _posts_like_count(conn):
+    if _has_column(conn, "posts", "like_count"):
+        return
+    conn.execute(text("ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text(
+        "UPDATE posts SET like_count = (SELECT COUNT(*) FROM post_likes WHERE post_likes.post_id = posts.id)"
+    ))
+
+@migration(6, "comments_parent_created_index")
+def _comments_parent_created_index(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_comments_parent_created ON comments (parent_id, created_at, id)"))
+
+@migration(7, "posts_search_index")
+def _posts_search_index(conn):
+    search.ensure_search_index(conn)
+
+@migration(8, "seed_roles_permissions")
+def _seed_roles_permissions(conn):
+    conn.execute(text("INSERT INTO roles (role_name) VALUES ('admin'), ('normal_user') ON CONFLICT (role_name) DO NOTHING"))
+
+    permissions_list = [
+        ('create_post', 'Can create new posts'),
+        ('like_post', 'Can like and unlike posts'),
+        ('chat', 'Can send messages in chat rooms'),
+        ('create_comment', 'Can reply to questions/posts'),
+        ('delete_any_post', 'Admin: Can delete any post'),
+        ('delete_any_comment', 'Admin: Can delete any comment'),
+        ('delete_any_message', 'Admin: Can delete any chat message'),
+        ('manage_rooms', 'Admin: Can create/edit/delete rooms'),
+        ('manage_users', 'Admin: Can manage user accounts')
+    ]
+    for name, desc in permissions_list:
+        conn.execute(
+            text("INSERT INTO permissions (permission_name, description) VALUES (:name, :desc) ON CONFLICT (permission_name) DO NOTHING"),
+            {"name": name, "desc": desc}
+        )
+
+    role_ids = {r[1]: r[0] for r in conn.execute(text("SELECT id, role_name FROM roles"))}
+    perm_ids = {p[1]: p[0] for p in conn.execute(text("SELECT id, permission_name FROM permissions"))}
+
+    def assign_perm(r_name, p_name):
+        r_id = role_ids.get(r_name)
+        p_id = perm_ids.get(p_name)
+        if r_id and p_id:
+            conn.execute(
+                text("INSERT INTO role_permissions (role_id, permission_id) SELECT :r_id, :p_id WHERE NOT EXISTS (SELECT 1 FROM role_permissions WHERE role_id = :r_id AND permission_id = :p_id)"),
+                {"r_id": r_id, "p_id": p_id}
+            )
+
+    # Admin gets ALL
+    for p_name in perm_ids.keys():
+        assign_perm('admin', p_name)
+
+    # Normal User gets specific set
+    for p_name in ['create_post', 'like_post', 'chat', 'create_comment']:
+        assign_perm('normal_user', p_name)
+
+@migration(9, "seed_rooms")
+def _seed_rooms(conn):
+    if conn.execute(text("SELECT count(*) FROM rooms")).scalar():
+        return
+    default_rooms = [
+        ("JEE Mains", "Dedicated to JEE Mains preparation and discussion."),
+        ("JEE Advance", "Advanced topics and problem solving for JEE Advance."),
+        ("CAT", "Crack the CAT with peer support and resources."),
+        ("NIMCET", "NIMCET exam preparation community."),
+        ("Programming", "Discuss coding, algorithms, and development."),
+        ("10th", "Study group for 10th grade students."),
+        ("12th", "Study group for 12th grade students.")
+    ]
+    for name, desc in default_rooms:
+        conn.execute(text("INSERT INTO rooms (name, description) VALUES (:name, :desc)"), {"name": name, "desc": desc})
+
+def _model_index(name: str):
+    for table in database.Base.metadata.tables.values():
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(name)
+
+def _create_index(conn, name: str):
+    """
+    Builds an index declared in models.py. On Postgres it is built
+    CONCURRENTLY, so writes to the table are not blocked meanwhile; that
+    needs a connection outside a transaction (transactional=False).
+    """
+    index = _model_index(name)
+    columns = ", ".join(column.name for column in index.columns)
+    unique = "UNIQUE " if index.unique else ""
+    if conn.dialect.name != "postgresql":
+        conn.execute(text(f"CREATE {unique}INDEX IF NOT EXISTS {name} ON {index.table.name} ({columns})"))
+        return
+    # An interrupted concurrent build leaves an INVALID index that IF NOT EXISTS would keep
+    invalid = conn.execute(
+        text("SELECT 1 FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = :name AND NOT i.indisvalid"),
+        {"name": name}
+    ).first()
+    if invalid:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    conn.execute(text(f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {index.table.name} ({columns})"))
+
+@migration(10, "hot_path_indexes", transactional=False)
+def _hot_path_indexes(conn):
+    # Unique indexes cannot be built over duplicates; keep the oldest row of each
+    for table, keys in [
+        ("post_likes", "post_id, user_id"),
+        ("saved_posts", "user_id, post_id"),
+        ("user_roles", "user_id, role_id"),
+    ]:
+        removed = conn.execute(text(
+            f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {keys})"
+        )).rowcount
+        if removed:
+            print(f"Migrating DB: removed {removed} duplicate rows from {table}")
+            if table == "post_likes":
+                conn.execute(like_counts.RECONCILE_SQL)
+
+    for name in [
+        "ix_posts_room_created",
+        "ix_posts_created",
+        "ix_comments_post_created",
+        "ix_chat_messages_room_created",
+        "uq_post_likes_post_user",
+        "uq_saved_posts_user_post",
+        "uq_user_roles_user_role",
+    ]:
+        _create_index(conn, name)
+
+@migration(11, "deletion_jobs")
+def _deletion_jobs(conn):
+    for table in ("users", "rooms"):
+        if not _has_column(conn, table, "deleted_at"):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN deleted_at TIMESTAMP WITH TIME ZONE"))
+    models.DeletionJob.__table__.create(conn, checkfirst=True)
+
+@migration(12, "deletion_indexes", transactional=False)
+def _deletion_indexes(conn):
+    # Each purge batch looks rows up by these columns
+    for name in [
+        "ix_room_members_room",
+        "ix_posts_owner",
+        "ix_comments_owner",
+        "ix_saved_posts_post",
+        "ix_post_likes_user",
+        "ix_chat_messages_user",
+    ]:
+        _create_index(conn, name)
+
+@migration(13, "hidden_content")
+def _hidden_content(conn):
+    # A constant default: Postgres adds the column without rewriting the table
+    for table in ("posts", "comments", "chat_messages"):
+        if not _has_column(conn, table, "is_hidden"):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN is_hidden BOOLEAN NOT NULL DEFAULT FALSE"))
+
+@migration(14, "chat_archive_segments")
+def _chat_archive_segments(conn):
+    models.ChatArchiveSegment.__table__.create(conn, checkfirst=True)
+
+@migration(15, "room_read_watermarks")
+def _room_read_watermarks(conn):
+    models.RoomReadWatermark.__table__.create(conn, checkfirst=True)
+
+@migration(16, "unread_indexes", transactional=False)
+def _unread_indexes(conn):
+    for name in ["ix_chat_messages_room_id", "ix_posts_room_id"]:
+        _create_index(conn, name)
+
+@migration(17, "chat_archive_id_range", transactional=False)
+def _chat_archive_id_range(conn):
+    for column in ("min_id", "max_id"):
+        if not _has_column(conn, "chat_archive_segments", column):
+            conn.execute(text(f"ALTER TABLE chat_archive_segments ADD COLUMN {column} INTEGER"))
+    # Segments are zlib-compressed JSON rows, message id first (chat_archive)
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, data FROM chat_archive_segments WHERE min_id IS NULL ORDER BY id LIMIT 100"
+        )).all()
+        if not rows:
+            break
+        for segment_id, data in rows:
+            ids = [message[0] for message in json.loads(zlib.decompress(data))]
+            conn.execute(
+                text("UPDATE chat_archive_segments SET min_id = :min_id, max_id = :max_id WHERE id = :id"),
+                {"min_id": min(ids), "max_id": max(ids), "id": segment_id}
+            )
+    _create_index(conn, "ix_chat_archive_segments_ids")
+
+@migration(18, "read_watermark_keys")
+def _read_watermark_keys(conn):
+    # Watermarks compare by (created_at, id); existing ones take the timestamp
+    # of the row they point at, or of their last write if it is gone
+    for kind, table in (("message", "chat_messages"), ("post", "posts")):
+        column = f"last_read_{kind}_at"
+        if _has_column(conn, "room_read_watermarks", column):
+            continue
+        conn.execute(text(f"ALTER TABLE room_read_watermarks ADD COLUMN {column} TIMESTAMP WITH TIME ZONE"))
+        conn.execute(text(
+            f"UPDATE room_read_watermarks SET {column} = COALESCE("
+            f"(SELECT created_at FROM {table} WHERE {table}.id = room_read_watermarks.last_read_{kind}_id), updated_at) "
+            f"WHERE last_read_{kind}_id > 0"
+        ))
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+def current_version(engine=None):
+    """Highest applied version, or None when the ledger does not exist yet."""
+    engine = engine or database.engine
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(func.max(ledger.c.version))).scalar()
+    except (ProgrammingError, OperationalError):
+        return None
+
+def pending(engine=None):
+    engine = engine or database.engine
+    try:
+        with engine.connect() as conn:
+            applied = set(conn.execute(select(ledger.c.version)).scalars())
+    except (ProgrammingError, OperationalError):
+        applied = set()
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+@contextmanager
+def _migration_lock(engine):
+    """Serializes migration runs across processes (Postgres only; SQLite is single-host)."""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+
+def migrate(engine=None) -> int:
+    """Applies every pending migration. Returns how many ran."""
+    engine = engine or database.engine
+    current = current_version(engine)
+    if current is not None and current >= LATEST_VERSION:
+        return 0
+
+    applied = 0
+    with _migration_lock(engine):
+        with engine.begin() as conn:
+            ledger.create(conn, checkfirst=True)
+        # Another worker may have finished while we waited for the lock
+        for m in pending(engine):
+            print(f"Migrating DB: {m.version} {m.name}...")
+            if m.transactional:
+                with engine.begin() as conn:
+                    m.apply(conn)
+                    conn.execute(insert(ledger).values(version=m.version, name=m.name))
+            else:
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    m.apply(conn)
+                    conn.execute(insert(ledger).values(version=m.version, name=m.name))
+            applied += 1
+    if applied:
+        # Roles or permissions may have changed; drop every worker's cached matrix
+        permissions.bump_version()
+        print(f"Migrations complete: {applied} applied, schema at version {LATEST_VERSION}.")
+    return applied
+
+def reset_schema(engine=None):
+    """Drops every table, the search index and the ledger (scripts/rebuild_db.py)."""
+    engine = engine or database.engine
+    with engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            conn.execute(text("DROP TABLE IF EXISTS posts_fts"))
+        database.Base.metadata.drop_all(bind=conn)
+        ledger.drop(conn, checkfirst=True)
+
+if __name__ == "__main__":
+    if "--status" in sys.argv[1:]:
+        todo = pending()
+        print(f"Schema version: {current_version()} (latest {LATEST_VERSION})")
+        for m in todo:
+            print(f"  pending: {m.version} {m.name}")
+        sys.exit(1 if todo else 0)
+    migrate()
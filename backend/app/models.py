@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Text, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, Text, ForeignKey, DateTime, Index, LargeBinary, false
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.sql import func
 from .database import Base
@@ -15,6 +15,8 @@ class User(Base):
     is_verified = Column(Boolean, default=False)
     refresh_token = Column(String, nullable=True)
     supabase_id = Column(String, unique=True, nullable=True, index=True)
+    # Set when deletion is requested; the row goes once its data is purged (deletion_jobs)
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
 
     posts = relationship("Post", back_populates="owner")
     comments = relationship("Comment", back_populates="owner")
@@ -30,12 +32,16 @@ class RoomMember(Base):
     room_id = Column(Integer, ForeignKey("rooms.id"), primary_key=True)
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # The primary key leads with user_id; a room's members (deletion_jobs)
+    __table_args__ = (Index("ix_room_members_room", "room_id"),)
+
 class Room(Base):
     __tablename__ = "rooms"
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, index=True)
     description = Column(String)
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
 
     posts = relationship("Post", back_populates="room", cascade="all, delete-orphan")
     members = relationship("User", secondary="room_members", back_populates="joined_rooms")
@@ -52,6 +58,10 @@ class Post(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     owner_id = Column(Integer, ForeignKey("users.id"))
     room_id = Column(Integer, ForeignKey("rooms.id"))
+    # Maintained by likes.toggle_like and reconciled by like_counts.reconciler
+    like_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Hidden by a moderator: kept, but left out of every listing
+    is_hidden = Column(Boolean, nullable=False, default=False, server_default=false())
 
     owner = relationship("User", back_populates="posts")
     room = relationship("Room", back_populates="posts")
@@ -59,6 +69,16 @@ class Post(Base):
     saved_by = relationship("SavedPost", back_populates="post")
     likes = relationship("PostLike", back_populates="post")
 
+    # Room feed and moderation feed, newest first
+    __table_args__ = (
+        Index("ix_posts_room_created", "room_id", "created_at", "id"),
+        Index("ix_posts_created", "created_at", "id"),
+        # A user's posts (deletion_jobs)
+        Index("ix_posts_owner", "owner_id"),
+        # Unread counts: a room's posts after a watermark id
+        Index("ix_posts_room_id", "room_id", "id"),
+    )
+
 class Comment(Base):
     __tablename__ = "comments"
 
@@ -67,6 +87,7 @@ class Comment(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     owner_id = Column(Integer, ForeignKey("users.id"))
     post_id = Column(Integer, ForeignKey("posts.id"))
+    is_hidden = Column(Boolean, nullable=False, default=False, server_default=false())
 
     owner = relationship("User", back_populates="comments")
     post = relationship("Post", back_populates="comments")
@@ -74,6 +95,13 @@ class Comment(Base):
     parent_id = Column(Integer, ForeignKey("comments.id"), nullable=True)
     replies = relationship("Comment", backref=backref("parent", remote_side=[id]))
 
+    __table_args__ = (
+        # A post's comments, and replies of a parent, in display order (comment_tree)
+        Index("ix_comments_post_created", "post_id", "created_at", "id"),
+        Index("ix_comments_parent_created", "parent_id", "created_at", "id"),
+        Index("ix_comments_owner", "owner_id"),
+    )
+
 class SavedPost(Base):
     __tablename__ = "saved_posts"
 
@@ -84,6 +112,11 @@ class SavedPost(Base):
     user = relationship("User", back_populates="saved_posts")
     post = relationship("Post", back_populates="saved_by")
 
+    __table_args__ = (
+        Index("uq_saved_posts_user_post", "user_id", "post_id", unique=True),
+        Index("ix_saved_posts_post", "post_id"),
+    )
+
 class PostLike(Base):
     __tablename__ = "post_likes"
 
@@ -94,6 +127,12 @@ class PostLike(Base):
     user = relationship("User", back_populates="liked_posts")
     post = relationship("Post", back_populates="likes")
 
+    # One like per user per post; post_id first also serves per-post counts
+    __table_args__ = (
+        Index("uq_post_likes_post_user", "post_id", "user_id", unique=True),
+        Index("ix_post_likes_user", "user_id"),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
 
@@ -102,10 +141,19 @@ class ChatMessage(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     user_id = Column(Integer, ForeignKey("users.id"))
     room_id = Column(Integer, ForeignKey("rooms.id"))
+    is_hidden = Column(Boolean, nullable=False, default=False, server_default=false())
 
     owner = relationship("User", back_populates="messages")
     room = relationship("Room", back_populates="messages")
 
+    # Message history of a room, newest first
+    __table_args__ = (
+        Index("ix_chat_messages_room_created", "room_id", "created_at", "id"),
+        Index("ix_chat_messages_user", "user_id"),
+        # Unread counts: a room's messages after a watermark id
+        Index("ix_chat_messages_room_id", "room_id", "id"),
+    )
+
 class Roles(Base):
     __tablename__ = "roles"
 
@@ -136,3 +184,77 @@ class UserRoles(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
     role_id = Column(Integer, ForeignKey("roles.id"))
+
+    __table_args__ = (Index("uq_user_roles_user_role", "user_id", "role_id", unique=True),)
+
+class DeletionJob(Base):
+    """Purge of a deleted user's or room's data, in batches (app/deletion_jobs.py)."""
+    __tablename__ = "deletion_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    entity_type = Column(String, nullable=False)  # "user" or "room"
+    entity_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="pending")  # pending, running, done, failed
+    step = Column(String, nullable=True)
+    rows_deleted = Column(Integer, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    # A worker holds the job until then; after a crash another one resumes it
+    locked_until = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        Index("uq_deletion_jobs_entity", "entity_type", "entity_id", unique=True),
+        Index("ix_deletion_jobs_status", "status", "id"),
+    )
+
+class ChatArchiveSegment(Base):
+    """
+    A run of a room's oldest chat messages, moved out of `chat_messages` as
+    one compressed blob (app/chat_archive.py). Segments of a room never
+    overlap and all sort before the room's messages still in the table.
+    """
+    __tablename__ = "chat_archive_segments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    room_id = Column(Integer, ForeignKey("rooms.id"), nullable=False)
+    # (created_at, id) of the first and last message, for keyset lookups
+    first_created_at = Column(DateTime(timezone=True), nullable=False)
+    first_id = Column(Integer, nullable=False)
+    last_created_at = Column(DateTime(timezone=True), nullable=False)
+    last_id = Column(Integer, nullable=False)
+    # Smallest and largest message id inside; ids are only roughly in time order
+    min_id = Column(Integer)
+    max_id = Column(Integer)
+    message_count = Column(Integer, nullable=False)
+    # ",3,17," - authors in the segment, so a user's deletion finds the segments to rewrite
+    user_ids = Column(Text, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_chat_archive_segments_room_first", "room_id", "first_created_at", "first_id"),
+        Index("ix_chat_archive_segments_ids", "max_id", "min_id"),
+    )
+
+class RoomReadWatermark(Base):
+    """
+    How far a user has read a room: everything that sorts after the
+    (created_at, id) of the last message and post read counts as unread
+    (app/read_watermarks.py).
+    """
+    __tablename__ = "room_read_watermarks"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    room_id = Column(Integer, ForeignKey("rooms.id"), primary_key=True)
+    # NULL until something has been read
+    last_read_message_at = Column(DateTime(timezone=True))
+    last_read_message_id = Column(Integer, nullable=False, default=0, server_default="0")
+    last_read_post_at = Column(DateTime(timezone=True))
+    last_read_post_id = Column(Integer, nullable=False, default=0, server_default="0")
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # The primary key leads with user_id; a room's rows (deletion_jobs)
+    __table_args__ = (Index("ix_room_read_watermarks_room", "room_id"),)
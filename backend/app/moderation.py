@@ -0,0 +1,142 @@
+"""
+Set-based bulk moderation.
+
+A bulk request deletes, hides or unhides every post, comment or chat message
+matching a list of ids and/or filters (author, room, created_at window). It is
+applied in batches of MODERATION_BATCH_SIZE rows in id order, one transaction
+per batch: one SELECT for the next ids, then a fixed handful of statements
+over that id list, however many rows match.
+
+Deleting or hiding a comment takes its whole reply subtree with it, so no
+thread is left pointing at a missing parent. Deleting a post removes its
+comments, likes and saves in the same batch. Hidden rows stay in the
+database and are left out of every listing; `unhide` brings them back.
+
+Chat messages are matched in the table first, then in the archive
+(`apply_archive_batch`), whose segments are rewritten a few at a time.
+Messages still queued in chat_pipeline (at most a few milliseconds old) are
+not in the table yet and are not matched.
+"""
+import os
+from collections import namedtuple
+from typing import Optional
+
+from sqlalchemy import bindparam, delete, select, text, update
+
+from . import chat_archive, database, models, schemas
+
+BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "500"))
+
+# Each target is moderated under the permission of its single-item delete
+PERMISSIONS = {
+    "posts": "delete_any_post",
+    "comments": "delete_any_comment",
+    "messages": "delete_any_message",
+}
+
+# ids by room, for the broadcast; counts of rows changed
+Batch = namedtuple("Batch", ["last_id", "rooms", "affected", "related_deleted"])
+
+COMMENT_SUBTREE = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM comments WHERE id IN :ids
+        UNION
+        SELECT comments.id FROM comments JOIN subtree ON comments.parent_id = subtree.id
+    )
+    SELECT id FROM subtree
+"""
+
+# The CTE sits inside the IN so the statements start with DELETE/UPDATE
+# (sqlite3 reports no rowcount otherwise)
+DELETE_COMMENTS = text(f"DELETE FROM comments WHERE id IN ({COMMENT_SUBTREE})")\
+    .bindparams(bindparam("ids", expanding=True))
+HIDE_COMMENTS = text(f"UPDATE comments SET is_hidden = :hidden WHERE id IN ({COMMENT_SUBTREE})")\
+    .bindparams(bindparam("ids", expanding=True))
+
+def has_filter(request: schemas.BulkModeration) -> bool:
+    """A request without any filter would match the whole table."""
+    return request.ids is not None or any(
+        value is not None for value in (request.author_id, request.room_id, request.since, request.until)
+    )
+
+def _matching(request: schemas.BulkModeration):
+    """SELECT id, room_id of the rows `request` applies to, in id order."""
+    if request.target == "posts":
+        model, author, room = models.Post, models.Post.owner_id, models.Post.room_id
+        query = select(model.id, room)
+    elif request.target == "comments":
+        model, author, room = models.Comment, models.Comment.owner_id, models.Post.room_id
+        # Outer, so comments whose post is already gone still match by id or author
+        query = select(model.id, room).outerjoin(models.Post, models.Post.id == models.Comment.post_id)
+    else:
+        model, author, room = models.ChatMessage, models.ChatMessage.user_id, models.ChatMessage.room_id
+        query = select(model.id, room)
+
+    if request.ids is not None:
+        query = query.where(model.id.in_(request.ids))
+    if request.author_id is not None:
+        query = query.where(author == request.author_id)
+    if request.room_id is not None:
+        query = query.where(room == request.room_id)
+    if request.since is not None:
+        query = query.where(model.created_at >= request.since)
+    if request.until is not None:
+        query = query.where(model.created_at < request.until)
+    # Rows already in the requested state are skipped, so every batch makes progress
+    if request.action == "hide":
+        query = query.where(model.is_hidden.is_(False))
+    elif request.action == "unhide":
+        query = query.where(model.is_hidden.is_(True))
+    return query.order_by(model.id), model
+
+def _delete_posts(conn, ids) -> tuple:
+    related = 0
+    # Whole reply trees go in one statement; foreign keys are checked at its end
+    for child in (models.Comment, models.PostLike, models.SavedPost):
+        related += conn.execute(delete(child).where(child.post_id.in_(ids))).rowcount
+    return conn.execute(delete(models.Post).where(models.Post.id.in_(ids))).rowcount, related
+
+def apply_batch(request: schemas.BulkModeration, after_id: int = 0, size: int = BATCH_SIZE) -> Optional[Batch]:
+    """
+    Applies `request` to the next `size` matching rows with an id above
+    `after_id`. Returns None when no row is left.
+    """
+    query, model = _matching(request)
+    with database.engine.begin() as conn:
+        rows = conn.execute(query.where(model.id > after_id).limit(size)).all()
+        if not rows:
+            return None
+        ids = [row.id for row in rows]
+        related = 0
+        if request.target == "comments":
+            if request.action == "delete":
+                affected = conn.execute(DELETE_COMMENTS, {"ids": ids}).rowcount
+            else:
+                affected = conn.execute(HIDE_COMMENTS, {"ids": ids, "hidden": request.action == "hide"}).rowcount
+        elif request.action == "delete":
+            if request.target == "posts":
+                affected, related = _delete_posts(conn, ids)
+            else:
+                affected = conn.execute(delete(model).where(model.id.in_(ids))).rowcount
+        else:
+            affected = conn.execute(
+                update(model).where(model.id.in_(ids)).values(is_hidden=request.action == "hide")
+            ).rowcount
+
+    rooms = {}
+    for row in rows:
+        rooms.setdefault(row.room_id, []).append(row.id)
+    return Batch(ids[-1], rooms, affected, related)
+
+def apply_archive_batch(request: schemas.BulkModeration, after_id: int = 0, size: int = BATCH_SIZE) -> Optional[Batch]:
+    """
+    Like apply_batch, for archived chat messages: `after_id` and `last_id`
+    are positions in the archive (segment ids), changing at most `size`
+    messages. Returns None when no segment is left.
+    """
+    with database.engine.begin() as conn:
+        result = chat_archive.moderate(conn, request, after_id, size)
+    if result is None:
+        return None
+    last_id, rooms, affected = result
+    return Batch(last_id, rooms, affected, 0)
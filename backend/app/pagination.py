@@ -0,0 +1,86 @@
+"""
+Opaque keyset (cursor) pagination.
+
+A cursor encodes the sort key of the last row on a page: (created_at, id) for
+time-ordered feeds, or (id,) where there is no timestamp. The next page is
+`WHERE (created_at, id) < (:created_at, :id)`, a single index seek no matter
+how deep the client has scrolled. The cursor for the next page is returned in
+the `X-Next-Cursor` response header, so list bodies keep their shape and
+clients still using skip/limit are unaffected.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Callable, Optional, Sequence
+
+from fastapi import HTTPException, Response
+from sqlalchemy import DateTime, String, literal, tuple_
+from sqlalchemy.types import TypeDecorator
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+class CursorTimestamp(TypeDecorator):
+    """
+    Binds a cursor timestamp (or any stored sort key, e.g. a read watermark)
+    so it compares equal to the stored value.
+    SQLite keeps timestamps as text, and rows written by CURRENT_TIMESTAMP
+    have no fractional seconds, unlike SQLAlchemy's own datetime format.
+    """
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "sqlite":
+            return dialect.type_descriptor(String())
+        return dialect.type_descriptor(DateTime(timezone=True))
+
+    def process_bind_param(self, value, dialect):
+        if dialect.name != "sqlite" or value is None:
+            return value
+        if value.microsecond:
+            return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+
+def encode_cursor(*key) -> str:
+    payload = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(key, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+def keyset_filter(columns: Sequence, cursor: str, descending: bool = True):
+    """
+    Filter selecting the rows that sort after `cursor` when ordering by
+    `columns` (all descending, or all ascending).
+    """
+    key = decode_cursor(cursor)
+    if len(key) != len(columns):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    values = []
+    for column, value in zip(columns, key):
+        if isinstance(column.type, DateTime):
+            try:
+                value = literal(datetime.fromisoformat(value), CursorTimestamp())
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        values.append(value)
+    if len(columns) == 1:
+        return columns[0] < values[0] if descending else columns[0] > values[0]
+    if descending:
+        return tuple_(*columns) < tuple_(*values)
+    return tuple_(*columns) > tuple_(*values)
+
+def set_next_cursor(response: Response, rows: Sequence, limit: int, key: Callable) -> Optional[str]:
+    """Sets X-Next-Cursor from the last row when the page is full."""
+    if not rows or len(rows) < limit:
+        return None
+    cursor = encode_cursor(*key(rows[-1]))
+    response.headers[NEXT_CURSOR_HEADER] = cursor
+    return cursor
@@ -0,0 +1,125 @@
+"""
+Role/permission resolver.
+
+The role -> permission matrix is tiny and rarely changes, so it is loaded once
+and each user's role set is cached; a permission check is then an in-memory
+set lookup. Anything that writes `user_roles` or `role_permissions` must call
+`bump_version()` after committing: it increments a counter in Redis, and every
+worker drops its copy the next time it checks the counter (at most every
+PERMISSIONS_VERSION_CHECK_INTERVAL seconds). Copies are also dropped after
+PERMISSIONS_CACHE_TTL seconds, which covers MockRedis setups where the
+counter is not shared between processes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Optional
+
+from sqlalchemy.orm import Session
+
+from . import models, metrics
+from .redis_client import redis_client
+
+VERSION_KEY = "permissions:version"
+VERSION_CHECK_INTERVAL = float(os.getenv("PERMISSIONS_VERSION_CHECK_INTERVAL", "1"))
+CACHE_TTL = float(os.getenv("PERMISSIONS_CACHE_TTL", "60"))
+USER_ROLES_CACHE_SIZE = int(os.getenv("PERMISSIONS_USER_CACHE_SIZE", "10000"))
+
+class PermissionResolver:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._role_permissions: Optional[Dict[int, FrozenSet[str]]] = None
+        self._user_roles: "OrderedDict[int, FrozenSet[int]]" = OrderedDict()
+        self._version = None
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _reset(self):
+        with self._lock:
+            self._role_permissions = None
+            self._user_roles.clear()
+            self.reloads += 1
+
+    def _sync_version(self):
+        now = time.time()
+        if now - self._loaded_at > CACHE_TTL:
+            self._loaded_at = now
+            self._reset()
+        if now - self._checked_at < VERSION_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            version = redis_client.get(VERSION_KEY)
+        except Exception as e:
+            # Keep serving the current copy; the TTL still bounds staleness
+            print(f"Permissions: version check failed ({e})")
+            return
+        if version != self._version:
+            self._version = version
+            self._reset()
+
+    def _load_matrix(self, db: Session) -> Dict[int, FrozenSet[str]]:
+        rows = db.query(models.RolePermissions.role_id, models.Permission.permission_name)\
+            .join(models.Permission, models.Permission.id == models.RolePermissions.permission_id)\
+            .all()
+        matrix: Dict[int, set] = {}
+        for role_id, permission_name in rows:
+            matrix.setdefault(role_id, set()).add(permission_name)
+        return {role_id: frozenset(names) for role_id, names in matrix.items()}
+
+    def _roles_for(self, user_id: int, db: Session) -> FrozenSet[int]:
+        with self._lock:
+            roles = self._user_roles.get(user_id)
+            if roles is not None:
+                self._user_roles.move_to_end(user_id)
+                self.hits += 1
+                return roles
+            self.misses += 1
+        rows = db.query(models.UserRoles.role_id).filter(models.UserRoles.user_id == user_id).all()
+        roles = frozenset(role_id for (role_id,) in rows)
+        with self._lock:
+            self._user_roles[user_id] = roles
+            while len(self._user_roles) > USER_ROLES_CACHE_SIZE:
+                self._user_roles.popitem(last=False)
+        return roles
+
+    def permissions_for(self, user_id: int, db: Session) -> FrozenSet[str]:
+        self._sync_version()
+        matrix = self._role_permissions
+        if matrix is None:
+            matrix = self._load_matrix(db)
+            self._role_permissions = matrix
+        roles = self._roles_for(user_id, db)
+        return frozenset().union(*(matrix.get(role_id, ()) for role_id in roles))
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            self._user_roles.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "version": self._version,
+            "cached_users": len(self._user_roles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "reloads": self.reloads,
+        }
+
+resolver = PermissionResolver()
+metrics.register("permissions", resolver.stats)
+
+def bump_version():
+    """Call after committing a write to `user_roles` or `role_permissions`."""
+    try:
+        redis_client.incr(VERSION_KEY)
+    except Exception as e:
+        print(f"Permissions: could not bump version ({e})")
+    resolver._reset()
+
+def invalidate_user(user_id: int):
+    """Drops one user's cached role set in this process (e.g. after sign-up)."""
+    resolver.invalidate_user(user_id)
@@ -0,0 +1,327 @@
+"""
+Who is online in each room, across all workers.
+
+Every room has a sorted set `presence:{room_id}` in Redis: one member per
+online user, scored with the time their entry expires. Alongside it, the hash
+`presence:{room_id}:conns` counts the workers holding a socket of that user in
+the room. A worker only touches Redis when a user's first socket in a room
+opens on it, or their last one closes (JOIN_LUA / LEAVE_LUA), so a user with
+several tabs is one member, and leaves when the last tab closes anywhere.
+
+Workers refresh the entries of their users every PRESENCE_HEARTBEAT seconds,
+to PRESENCE_TTL seconds ahead. Entries a dead worker left behind run out and
+are pruned by the next heartbeat of any worker with sockets in the room
+(PRUNE_LUA); the keys themselves expire once no worker refreshes them.
+Online counts are a ZCARD, O(1) per room.
+
+Join and leave events are not sent one by one: a worker collects the changes
+of a room for PRESENCE_COALESCE seconds, drops those that cancel out (a
+reconnect), and broadcasts one `presence` event with the new online count.
+Past PRESENCE_MAX_LISTED changes, the event carries only the count and
+clients refetch the list.
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from .redis_client import AsyncMockRedis, MockRedis, async_redis_client, redis_client
+
+PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", "30"))
+PRESENCE_HEARTBEAT = float(os.getenv("PRESENCE_HEARTBEAT", "10"))
+PRESENCE_COALESCE = float(os.getenv("PRESENCE_COALESCE", "0.5"))
+PRESENCE_MAX_LISTED = int(os.getenv("PRESENCE_MAX_LISTED", "50"))
+# Keys outlive their entries a little, so a short stall of every worker loses nothing
+KEY_TTL = int(PRESENCE_TTL * 4)
+# Expired entries removed per room per heartbeat
+PRUNE_LIMIT = 1000
+
+JOIN_LUA = """
+local now = tonumber(ARGV[2])
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local joined = 0
+if (not score) or tonumber(score) < now then
+    redis.call('HSET', KEYS[2], ARGV[1], 1)
+    joined = 1
+else
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return joined
+"""
+
+LEAVE_LUA = """
+if redis.call('HINCRBY', KEYS[2], ARGV[1], -1) > 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[2], ARGV[1])
+return redis.call('ZREM', KEYS[1], ARGV[1])
+"""
+
+PRUNE_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, user in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], user)
+    redis.call('HDEL', KEYS[2], user)
+end
+return expired
+"""
+
+def members_key(room_id: int) -> str:
+    return f"presence:{room_id}"
+
+def conns_key(room_id: int) -> str:
+    return f"presence:{room_id}:conns"
+
+def online_counts(room_ids: Iterable[int], client=None) -> Dict[int, int]:
+    """Online users per room, one pipelined round trip. For sync code; empty if Redis is down."""
+    client = client or redis_client
+    room_ids = list(room_ids)
+    if not room_ids:
+        return {}
+    try:
+        with client.pipeline(transaction=False) as pipe:
+            for room_id in room_ids:
+                pipe.zcard(members_key(room_id))
+            return dict(zip(room_ids, pipe.execute()))
+    except Exception as e:
+        print(f"Presence: counts unavailable ({e})")
+        return {}
+
+def online_users(room_id: int, client=None) -> list:
+    """Ids of the users online in a room, longest idle entry first."""
+    client = client or redis_client
+    return [int(user) for user in client.zrangebyscore(members_key(room_id), time.time(), "+inf")]
+
+class PresenceTracker:
+    def __init__(self, publish: Callable[[dict, int], Awaitable], client=None,
+                 ttl: float = PRESENCE_TTL, heartbeat: float = PRESENCE_HEARTBEAT,
+                 coalesce: float = PRESENCE_COALESCE):
+        self.client = client or async_redis_client
+        self.publish = publish
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.coalesce = coalesce
+        # (room_id, user_id) -> sockets open on this worker
+        self._local: Dict[Tuple[int, int], int] = {}
+        # Registered in Redis by this worker: key -> token of that JOIN_LUA call
+        self._joined: Dict[Tuple[int, int], int] = {}
+        self._joining = set()
+        self._tokens = 0
+        # room_id -> {user_id: True (joined) / False (left)}, waiting to be broadcast
+        self._pending: Dict[int, Dict[int, bool]] = {}
+        self._flushes: Dict[int, asyncio.Task] = {}
+        self._scripts = {}
+        self._task: Optional[asyncio.Task] = None
+        self.joins = 0
+        self.leaves = 0
+        self.expired = 0
+        self.events = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def start(self):
+        if self._task is not None or self.heartbeat <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._flushes.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._flushes.clear()
+        self._pending.clear()
+        # Leave right away instead of lingering until the entries run out
+        for room_id, user_id in list(self._local):
+            self._local[(room_id, user_id)] = 1
+            await self.leave(room_id, user_id, announce=False)
+
+    def _script(self, source: str):
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = self.client.register_script(source)
+        return script
+
+    def _in_memory(self) -> Optional[MockRedis]:
+        return self.client.sync if isinstance(self.client, AsyncMockRedis) else None
+
+    async def join(self, room_id: int, user_id: int):
+        """A socket of the user opened in the room on this worker."""
+        key = (room_id, user_id)
+        self._local[key] = self._local.get(key, 0) + 1
+        # A join still in flight for an earlier socket registers this one too
+        if self._local[key] == 1 and key not in self._joining:
+            await self._register(key)
+
+    async def _join_entry(self, room_id: int, user_id: int) -> int:
+        args = (user_id, time.time(), self.ttl, KEY_TTL)
+        mock = self._in_memory()
+        if mock is not None:
+            return mock.presence_join(members_key(room_id), conns_key(room_id), *args)
+        return await self._script(JOIN_LUA)(keys=[members_key(room_id), conns_key(room_id)], args=list(args))
+
+    async def _leave_entry(self, room_id: int, user_id: int) -> int:
+        mock = self._in_memory()
+        if mock is not None:
+            return mock.presence_leave(members_key(room_id), conns_key(room_id), user_id)
+        return await self._script(LEAVE_LUA)(keys=[members_key(room_id), conns_key(room_id)], args=[user_id])
+
+    async def _register(self, key: Tuple[int, int]):
+        room_id, user_id = key
+        self._joining.add(key)
+        try:
+            while True:
+                try:
+                    joined = await self._join_entry(room_id, user_id)
+                except Exception as e:
+                    # Presence is best effort; never take the socket down with it. The
+                    # next heartbeat retries.
+                    self.errors += 1
+                    print(f"Presence: join failed ({e})")
+                    return
+                if key in self._local:
+                    break
+                # The last socket closed while JOIN_LUA ran, and its leave left
+                # the entry to us: take it back without announcing anything
+                try:
+                    await self._leave_entry(room_id, user_id)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Presence: leave failed ({e})")
+                    return
+                if key not in self._local:
+                    return
+        finally:
+            self._joining.discard(key)
+        self._tokens += 1
+        self._joined[key] = self._tokens
+        if joined:
+            self.joins += 1
+            self._changed(room_id, user_id, True)
+
+    async def leave(self, room_id: int, user_id: int, announce: bool = True):
+        """A socket of the user in the room closed on this worker."""
+        key = (room_id, user_id)
+        count = self._local.get(key, 0) - 1
+        if count > 0:
+            self._local[key] = count
+            return
+        self._local.pop(key, None)
+        self._joined.pop(key, None)
+        if key in self._joining:
+            # _register sees the socket gone once its JOIN_LUA returns and undoes it
+            return
+        try:
+            left = await self._leave_entry(room_id, user_id)
+        except Exception as e:
+            self.errors += 1
+            print(f"Presence: leave failed ({e})")
+            return
+        if left:
+            self.leaves += 1
+            if announce:
+                self._changed(room_id, user_id, False)
+
+    def _changed(self, room_id: int, user_id: int, joined: bool):
+        pending = self._pending.setdefault(room_id, {})
+        if pending.get(user_id, joined) != joined:
+            # Left and came back (or the reverse) within one window: nothing to tell
+            del pending[user_id]
+            self.coalesced += 2
+        else:
+            if user_id in pending:
+                self.coalesced += 1
+            pending[user_id] = joined
+        if room_id not in self._flushes:
+            self._flushes[room_id] = asyncio.create_task(self._flush_later(room_id))
+
+    async def _flush_later(self, room_id: int):
+        await asyncio.sleep(self.coalesce)
+        self._flushes.pop(room_id, None)
+        changes = self._pending.pop(room_id, {})
+        if not changes:
+            return
+        try:
+            online = await self.client.zcard(members_key(room_id))
+        except Exception as e:
+            self.errors += 1
+            print(f"Presence: count failed ({e})")
+            return
+        event = {"type": "presence", "online": online}
+        if len(changes) <= PRESENCE_MAX_LISTED:
+            event["joined"] = sorted(user for user, joined in changes.items() if joined)
+            event["left"] = sorted(user for user, joined in changes.items() if not joined)
+        else:
+            event["changed"] = len(changes)
+        self.events += 1
+        await self.publish(event, room_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.errors += 1
+                print(f"Presence: heartbeat failed ({e})")
+
+    async def refresh(self):
+        """Pushes the expiry of this worker's users ahead, then prunes expired entries of its rooms."""
+        for key in [key for key in self._local if key not in self._joined and key not in self._joining]:
+            # Unless its sockets closed, or a join started, during an earlier await
+            if key in self._local and key not in self._joined and key not in self._joining:
+                await self._register(key)
+        now = time.time()
+        # Joins still in flight are left out: their JOIN_LUA sets the expiry
+        tokens = dict(self._joined)
+        rooms = sorted({room_id for room_id, _ in tokens})
+        if not tokens:
+            return
+        async with self.client.pipeline(transaction=False) as pipe:
+            for room_id, user_id in tokens:
+                # XX: an entry pruned meanwhile (this worker stalled) must go through JOIN_LUA
+                pipe.zadd(members_key(room_id), {user_id: now + self.ttl}, xx=True, ch=True)
+            for room_id in rooms:
+                pipe.expire(members_key(room_id), KEY_TTL)
+                pipe.expire(conns_key(room_id), KEY_TTL)
+            refreshed = (await pipe.execute())[:len(tokens)]
+        for (key, token), found in zip(tokens.items(), refreshed):
+            # Unless the user left (and maybe came back) while the pipeline ran
+            if not found and self._joined.get(key) == token:
+                del self._joined[key]
+                await self._register(key)
+
+        mock = self._in_memory()
+        for room_id in rooms:
+            if mock is not None:
+                expired = mock.presence_prune(members_key(room_id), conns_key(room_id), now, PRUNE_LIMIT)
+            else:
+                expired = await self._script(PRUNE_LUA)(
+                    keys=[members_key(room_id), conns_key(room_id)], args=[now, PRUNE_LIMIT]
+                )
+            for user_id in expired:
+                self.expired += 1
+                self._changed(room_id, int(user_id), False)
+
+    def stats(self) -> dict:
+        return {
+            "local_users": len(self._local),
+            "local_rooms": len({room_id for room_id, _ in self._local}),
+            "joins": self.joins,
+            "leaves": self.leaves,
+            "expired": self.expired,
+            "events": self.events,
+            "coalesced": self.coalesced,
+            "pending_rooms": len(self._pending),
+            "errors": self.errors,
+        }
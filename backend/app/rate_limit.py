@@ -0,0 +1,211 @@
+"""
+Atomic rate limiting on Redis.
+
+Each check is one round trip: a Lua script reads the limiter state, decides,
+and writes the new state in a single atomic step, so concurrent requests
+cannot both slip through. MockRedis implements the same two algorithms in
+process.
+
+Policies are written as "<kind>:<limit>/<seconds>":
+- "token_bucket:5/10" holds up to 5 tokens, refilled at 5 per 10 seconds,
+  so short bursts are allowed while the average stays at the rate.
+- "sliding_window:5/10" allows at most 5 hits in any 10-second window.
+
+A limiter can guard an HTTP route as a dependency (429 with Retry-After), or
+be called inline with `await limiter.check(...)`, e.g. in a WebSocket loop.
+"""
+import math
+import os
+import uuid
+from typing import NamedTuple
+
+from fastapi import Depends, HTTPException, Request, status
+
+from . import models
+from . import auth as auth_utils
+from .redis_client import AsyncMockRedis, MockRedis, async_redis_client, redis_client
+
+TOKEN_BUCKET_LUA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(retry_after), tostring(tokens)}
+"""
+
+SLIDING_WINDOW_LUA = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+local count = redis.call('ZCARD', KEYS[1])
+if count < limit then
+    redis.call('ZADD', KEYS[1], now, now .. ':' .. ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return {1, '0', tostring(limit - count - 1)}
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return {0, tostring((tonumber(oldest[2]) + window - now) / 1000), '0'}
+"""
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    retry_after: float
+    remaining: float
+
+class _Policy:
+    """One Lua script on Redis, the matching MockRedis method in memory."""
+    script = None
+
+    def args(self, cost: int) -> list:
+        raise NotImplementedError
+
+    def in_memory(self, client: MockRedis, key: str, cost: int) -> tuple:
+        raise NotImplementedError
+
+    def hit(self, client, key: str, cost: int = 1) -> RateLimitResult:
+        if isinstance(client, MockRedis):
+            return RateLimitResult(*self.in_memory(client, key, cost))
+        return _result(_script(client, self.script)(keys=[key], args=self.args(cost)))
+
+    async def ahit(self, client, key: str, cost: int = 1) -> RateLimitResult:
+        """`hit` through an asyncio client."""
+        if isinstance(client, AsyncMockRedis):
+            return RateLimitResult(*self.in_memory(client.sync, key, cost))
+        return _result(await _script(client, self.script)(keys=[key], args=self.args(cost)))
+
+class TokenBucket(_Policy):
+    script = TOKEN_BUCKET_LUA
+
+    def __init__(self, limit: int, period: float):
+        self.capacity = limit
+        self.rate = limit / period
+
+    def args(self, cost):
+        return [self.rate, self.capacity, cost]
+
+    def in_memory(self, client, key, cost):
+        return client.token_bucket(key, self.rate, self.capacity, cost)
+
+class SlidingWindow(_Policy):
+    script = SLIDING_WINDOW_LUA
+
+    def __init__(self, limit: int, period: float):
+        self.limit = limit
+        self.window_ms = int(period * 1000)
+
+    def args(self, cost):
+        return [self.limit, self.window_ms, uuid.uuid4().hex]
+
+    def in_memory(self, client, key, cost):
+        return client.sliding_window(key, self.limit, self.window_ms / 1000)
+
+POLICIES = {"token_bucket": TokenBucket, "sliding_window": SlidingWindow}
+
+_scripts = {}
+
+def _script(client, source: str):
+    # register_script runs EVALSHA and only sends the source when Redis lacks it
+    script = _scripts.get((id(client), source))
+    if script is None:
+        script = _scripts[(id(client), source)] = client.register_script(source)
+    return script
+
+def _result(reply) -> RateLimitResult:
+    allowed, retry_after, remaining = reply
+    return RateLimitResult(bool(allowed), float(retry_after), float(remaining))
+
+def parse_policy(spec: str):
+    """'token_bucket:5/10' -> TokenBucket(5, 10)."""
+    try:
+        kind, rule = spec.split(":", 1)
+        limit, period = rule.split("/", 1)
+        return POLICIES[kind.strip()](int(limit), float(period))
+    except (KeyError, ValueError):
+        raise ValueError(f"Invalid rate limit policy {spec!r}, expected e.g. 'token_bucket:5/10'")
+
+class RateLimiter:
+    """
+    A named limit applied per caller. Policy comes from the RATE_LIMIT_<NAME>
+    environment variable, or `default_policy`.
+    """
+    def __init__(self, name: str, default_policy: str, client=None, async_client=None):
+        self.name = name
+        self.policy = parse_policy(os.getenv(f"RATE_LIMIT_{name.upper()}", default_policy))
+        self.client = client or redis_client
+        if async_client is None:
+            async_client = AsyncMockRedis(self.client) if isinstance(self.client, MockRedis) else async_redis_client
+        self.async_client = async_client
+
+    def key(self, *parts) -> str:
+        return ":".join(["rate", self.name, *(str(part) for part in parts)])
+
+    def hit(self, *parts) -> RateLimitResult:
+        """For sync code (threadpool routes)."""
+        try:
+            return self.policy.hit(self.client, self.key(*parts))
+        except Exception as e:
+            return self._fail_open(e)
+
+    async def check(self, *parts) -> RateLimitResult:
+        """For the event loop: async routes and WebSockets."""
+        try:
+            return await self.policy.ahit(self.async_client, self.key(*parts))
+        except Exception as e:
+            return self._fail_open(e)
+
+    def _fail_open(self, error) -> RateLimitResult:
+        # Never take the feature down with the limiter
+        print(f"Rate limiter '{self.name}' unavailable ({error}), allowing request")
+        return RateLimitResult(True, 0.0, 0.0)
+
+class RateLimit:
+    """
+    Route dependency: limits each user, optionally per value of some path
+    parameters (e.g. per room). Raises 429 with Retry-After when exceeded.
+    """
+    def __init__(self, limiter: RateLimiter, path_params=()):
+        self.limiter = limiter
+        self.path_params = path_params
+
+    async def __call__(self, request: Request, current_user: models.User = Depends(auth_utils.get_current_user)):
+        parts = [current_user.id, *(request.path_params.get(name) for name in self.path_params)]
+        await enforce(self.limiter, *parts)
+        return current_user
+
+async def enforce(limiter: RateLimiter, *parts):
+    """
+    Inline form of RateLimit, for routes that should only spend a token once
+    the request is known to be valid. Raises 429 with Retry-After when exceeded.
+    """
+    result = await limiter.check(*parts)
+    if not result.allowed:
+        retry_after = max(1, math.ceil(result.retry_after))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Please wait {retry_after}s before trying again",
+            headers={"Retry-After": str(retry_after)}
+        )
+
+# Chat messages, per user per room, shared by the HTTP endpoint and the WebSocket:
+# one per second on average, in bursts of up to 5
+chat_limiter = RateLimiter("chat", "token_bucket:5/5")
+
+# Room exports, per user: each one streams a room's whole history
+export_limiter = RateLimiter("export", "sliding_window:5/60")
@@ -0,0 +1,282 @@
+"""
+Per-room read watermarks and the sidebar's unread counts.
+
+`room_read_watermarks` holds, per user and room, the sort key (created_at, id)
+of the last chat message and the last post the user has read; everything
+that sorts after it (except their own, and hidden items) is unread. That is
+the key history is paged by, so the count agrees with what the user has
+scrolled past; ids alone would not, since chat message ids are handed out in
+blocks per worker (chat_pipeline) and are only roughly in time order.
+
+Clients report reads by id over the room socket
+(`{"type": "read", "message_id": 123}`) or `POST /rooms/{id}/read`. Reads
+only update an in-memory map; a writer task resolves the ids reported since
+the last flush to their keys (one query per table) every
+READ_FLUSH_INTERVAL seconds and upserts the latest key of each room in one
+statement. Ids that are not in the room (yet) are ignored, and a watermark
+only ever moves forward, so late, repeated or bogus reports are harmless.
+
+The sidebar gets the counts of all joined rooms from one query, cached in
+Redis per user for UNREAD_CACHE_TTL seconds and dropped when the user's
+watermarks are written. New activity by others therefore shows up within the
+TTL. Joining a room starts its watermarks at the latest message and post.
+Counts stop at UNREAD_COUNT_CAP, so a room with a long unread history costs
+no more than an active one.
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import bindparam, case, func, literal, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import Session
+
+from . import database, metrics, models
+from .pagination import CursorTimestamp
+from .redis_client import redis_client
+
+FLUSH_INTERVAL = float(os.getenv("READ_FLUSH_INTERVAL", "1"))
+CACHE_TTL = int(os.getenv("UNREAD_CACHE_TTL", "15"))
+UNREAD_CAP = int(os.getenv("UNREAD_COUNT_CAP", "100"))
+CACHE_PREFIX = "unread:"
+# Ids are 32-bit integer columns
+MAX_ID = 2**31 - 1
+# Distinct ids kept per user, room and kind between flushes
+MAX_PENDING_IDS = 16
+
+# Sorts before every stored key: rooms without a watermark count from the start
+BEGINNING = literal(datetime(1970, 1, 1, tzinfo=timezone.utc), CursorTimestamp())
+
+watermarks = models.RoomReadWatermark.__table__
+
+# kind -> (model, watermark key columns)
+KINDS = {
+    "message": (models.ChatMessage, watermarks.c.last_read_message_at, watermarks.c.last_read_message_id),
+    "post": (models.Post, watermarks.c.last_read_post_at, watermarks.c.last_read_post_id),
+}
+
+def _upsert(conn, rows: list):
+    """Inserts watermarks or moves existing ones forward; never back."""
+    insert = postgresql.insert if conn.dialect.name == "postgresql" else sqlite.insert
+    # Keys are bound like cursors, so they compare equal to the rows they came from
+    statement = insert(watermarks).values(
+        last_read_message_at=bindparam("last_read_message_at", type_=CursorTimestamp()),
+        last_read_post_at=bindparam("last_read_post_at", type_=CursorTimestamp()),
+    )
+    values = {"updated_at": func.now()}
+    for _, at, id in KINDS.values():
+        new_at, new_id = statement.excluded[at.name], statement.excluded[id.name]
+        later = new_at.isnot(None) & (at.is_(None) | (tuple_(new_at, new_id) > tuple_(at, id)))
+        values[at.name] = case((later, new_at), else_=at)
+        values[id.name] = case((later, new_id), else_=id)
+    conn.execute(statement.on_conflict_do_update(
+        index_elements=[watermarks.c.user_id, watermarks.c.room_id], set_=values
+    ), rows)
+
+def _resolve(conn, pending: dict) -> list:
+    """
+    Watermark rows for the reported ids: per user and room, the latest
+    (created_at, id) among the reported ids that are in that room.
+    """
+    keys = {}
+    for kind, (model, _, _) in KINDS.items():
+        ids = {id for reported in pending.values() for id in reported[kind]}
+        keys[kind] = {row.id: row for row in conn.execute(
+            select(model.id, model.room_id, model.created_at).where(model.id.in_(ids))
+        )} if ids else {}
+    rows = []
+    for (user_id, room_id), reported in pending.items():
+        row = {"user_id": user_id, "room_id": room_id}
+        for kind in KINDS:
+            found = [keys[kind][id] for id in reported[kind] if id in keys[kind] and keys[kind][id].room_id == room_id]
+            latest = max(found, key=lambda key: (key.created_at, key.id)) if found else None
+            row[f"last_read_{kind}_at"] = latest.created_at if latest else None
+            row[f"last_read_{kind}_id"] = latest.id if latest else 0
+        if row["last_read_message_at"] is not None or row["last_read_post_at"] is not None:
+            rows.append(row)
+    return rows
+
+def _unread(model, author, watermark_at, watermark_id, user_id: int):
+    # Counting at most UNREAD_CAP rows keeps every room to a short index range
+    capped = select(model.id).where(
+        model.room_id == models.RoomMember.room_id,
+        tuple_(model.created_at, model.id) > tuple_(func.coalesce(watermark_at, BEGINNING), func.coalesce(watermark_id, 0)),
+        model.is_hidden.is_(False),
+        author != user_id,
+    ).limit(UNREAD_CAP).correlate(models.RoomMember, watermarks).subquery()
+    return select(func.count()).select_from(capped).scalar_subquery()
+
+def unread_query(user_id: int):
+    """(room_id, unread_messages, unread_posts) for every room the user has joined."""
+    Watermark = models.RoomReadWatermark
+    return select(
+        models.RoomMember.room_id,
+        _unread(models.ChatMessage, models.ChatMessage.user_id,
+                Watermark.last_read_message_at, Watermark.last_read_message_id, user_id).label("unread_messages"),
+        _unread(models.Post, models.Post.owner_id,
+                Watermark.last_read_post_at, Watermark.last_read_post_id, user_id).label("unread_posts"),
+    ).join(models.Room, models.Room.id == models.RoomMember.room_id)\
+        .outerjoin(Watermark, (Watermark.user_id == models.RoomMember.user_id) & (Watermark.room_id == models.RoomMember.room_id))\
+        .where(models.RoomMember.user_id == user_id, models.Room.deleted_at.is_(None))
+
+def start_at_latest(db: Session, user_id: int, room_id: int):
+    """On joining: the room's existing history does not count as unread."""
+    row = {"user_id": user_id, "room_id": room_id}
+    for kind, (model, _, _) in KINDS.items():
+        latest = db.execute(
+            select(model.created_at, model.id).where(model.room_id == room_id)
+            .order_by(model.created_at.desc(), model.id.desc()).limit(1)
+        ).first()
+        row[f"last_read_{kind}_at"] = latest.created_at if latest else None
+        row[f"last_read_{kind}_id"] = latest.id if latest else 0
+    _upsert(db.connection(), [row])
+
+def invalidate(*user_ids: int):
+    try:
+        with redis_client.pipeline() as pipe:
+            for user_id in user_ids:
+                pipe.delete(f"{CACHE_PREFIX}{user_id}")
+            pipe.execute()
+    except Exception as e:
+        # Counts still expire after the TTL
+        print(f"Unread counts: invalidating failed ({e})")
+
+class WatermarkWriter:
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # (user_id, room_id) -> {"message": ids, "post": ids} reported since the last flush
+        self._pending: Dict[Tuple[int, int], Dict[str, Set[int]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.marks = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.failed_flushes = 0
+        self.ignored = 0
+        self.dropped = 0
+        self.last_flush_ms = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    async def start(self):
+        if self._task is not None or self.flush_interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # Reads reported since the last flush
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def mark(self, user_id: int, room_id: int, message_id: Optional[int] = None, post_id: Optional[int] = None):
+        """Records a read. Only touches memory; ids that are not integers in 1..MAX_ID are ignored."""
+        reported = {
+            kind: {value} if isinstance(value, int) and not isinstance(value, bool) and 0 < value <= MAX_ID else set()
+            for kind, value in (("message", message_id), ("post", post_id))
+        }
+        if reported["message"] or reported["post"]:
+            self.marks += 1
+            self._merge((user_id, room_id), reported)
+
+    def _merge(self, key: Tuple[int, int], reported: Dict[str, Set[int]]):
+        current = self._pending.setdefault(key, {"message": set(), "post": set()})
+        for kind, ids in reported.items():
+            current[kind] |= ids
+            # A client flooding reads keeps a bounded set; the lowest ids are the likeliest to be old
+            while len(current[kind]) > MAX_PENDING_IDS:
+                current[kind].discard(min(current[kind]))
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        started = time.perf_counter()
+        try:
+            # The sync engine, off the event loop
+            written = await asyncio.to_thread(self._write, pending)
+        except Exception as e:
+            self.failed_flushes += 1
+            print(f"Read watermarks: flush of {len(pending)} failed ({e}), retrying with the next one")
+            for key, reported in pending.items():
+                self._merge(key, reported)
+            return
+        self.flushes += 1
+        self.rows_written += written
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+        invalidate(*{user_id for user_id, _ in pending})
+
+    def _write(self, pending: dict) -> int:
+        with database.engine.connect() as conn:
+            rows = _resolve(conn, pending)
+        self.ignored += len(pending) - len(rows)
+        if not rows:
+            return 0
+        try:
+            with database.engine.begin() as conn:
+                _upsert(conn, rows)
+            return len(rows)
+        except (IntegrityError, DataError, OverflowError):
+            pass
+        # A user or room deleted meanwhile, or a value the column rejects:
+        # write the others one by one
+        written = 0
+        for row in rows:
+            try:
+                with database.engine.begin() as conn:
+                    _upsert(conn, [row])
+                written += 1
+            except (IntegrityError, DataError, OverflowError) as e:
+                print(f"Read watermarks: dropping user {row['user_id']} room {row['room_id']} ({e})")
+                self.dropped += 1
+        return written
+
+    def counts(self, db: Session, user_id: int) -> Dict[int, Tuple[int, int]]:
+        """room_id -> (unread messages, unread posts) for the user's joined rooms."""
+        key = f"{CACHE_PREFIX}{user_id}"
+        try:
+            cached = redis_client.get(key)
+        except Exception as e:
+            print(f"Unread counts: cache unavailable ({e})")
+            cached = None
+        if cached is not None:
+            self.cache_hits += 1
+            return {int(room_id): tuple(counts) for room_id, counts in json.loads(cached).items()}
+        self.cache_misses += 1
+        counts = {row.room_id: (row.unread_messages, row.unread_posts) for row in db.execute(unread_query(user_id))}
+        try:
+            redis_client.set(key, json.dumps(counts), ex=CACHE_TTL)
+        except Exception:
+            pass
+        return counts
+
+    def stats(self) -> dict:
+        return {
+            "marks": self.marks,
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "failed_flushes": self.failed_flushes,
+            "ignored": self.ignored,
+            "dropped": self.dropped,
+            "last_flush_ms": self.last_flush_ms,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+writer = WatermarkWriter()
+metrics.register("read_watermarks", writer.stats)
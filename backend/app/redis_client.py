@@ -1,56 +1,445 @@
+import asyncio
+import heapq
+import threading
 import time
 import os
+from collections import Counter, OrderedDict
+from typing import Optional
+
 import redis
+import redis.asyncio
 from dotenv import load_dotenv
 
+from . import metrics
+
 load_dotenv()
 
+# In-memory mode only: key limit (0 = unbounded) and how often expired keys are swept
+MAX_KEYS = int(os.getenv("MOCK_REDIS_MAX_KEYS", "100000"))
+SWEEP_INTERVAL = float(os.getenv("MOCK_REDIS_SWEEP_INTERVAL", "5"))
+SWEEP_BATCH = 1000
+
+class MockPubSub:
+    """
+    In-memory stand-in for `redis.asyncio` PubSub, fed by `MockRedis.publish`.
+    Only usable from the event loop thread.
+    """
+    def __init__(self, broker):
+        self._broker = broker
+        self._messages = asyncio.Queue()
+        self.channels = set()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self._broker.subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            self.channels.discard(channel)
+            listeners = self._broker.subscribers.get(channel)
+            if listeners:
+                listeners.discard(self)
+                if not listeners:
+                    del self._broker.subscribers[channel]
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            if timeout:
+                return await asyncio.wait_for(self._messages.get(), timeout)
+            return self._messages.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return None
+
+    async def aclose(self):
+        await self.unsubscribe()
+
 class MockRedis:
-    def __init__(self):
-        self.store = {}
+    """
+    In-memory stand-in for the synchronous Redis client (single worker, tests).
+
+    Safe to call from the threadpool: every operation holds one lock. Expired
+    keys are removed lazily on access and also by `sweep()`, which pops due
+    entries off a min-heap of expiry times; `start()` runs it periodically so
+    keys that are never read again do not pile up. At most `max_keys` keys are
+    kept (MOCK_REDIS_MAX_KEYS, 0 for no limit): past that, the least recently
+    used key is evicted, like Redis with `maxmemory-policy allkeys-lru`.
+    """
+    def __init__(self, max_keys: int = MAX_KEYS, sweep_interval: float = SWEEP_INTERVAL):
+        self.store = OrderedDict()
         self.expires = {}
+        self.subscribers = {}
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self._expiry_heap = []
+        self._lock = threading.RLock()
+        self._task: Optional[asyncio.Task] = None
+        self.ops = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.expired_on_access = 0
+        self.expired_by_sweep = 0
+        self.evicted = 0
 
     def setex(self, name, time_sec, value):
-        self.store[name] = value
-        self.expires[name] = time.time() + time_sec
-        return True
+        with self._lock:
+            self.ops["setex"] += 1
+            self._set(name, value, time.time() + time_sec)
+            return True
+
+    def set(self, name, value, ex=None, nx=False):
+        with self._lock:
+            self.ops["set"] += 1
+            if nx and not self._is_expired(name):
+                return None
+            self._set(name, value, time.time() + ex if ex else None)
+            return True
+
+    def mget(self, keys):
+        with self._lock:
+            self.ops["mget"] += 1
+            return [self._get(name) for name in keys]
 
     def get(self, name):
-        if self._is_expired(name):
-            return None
-        return self.store.get(name)
+        with self._lock:
+            self.ops["get"] += 1
+            if self._is_expired(name):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.store.move_to_end(name)
+            return self.store[name]
 
     def delete(self, name):
-        self.store.pop(name, None)
-        self.expires.pop(name, None)
-        return 1
+        with self._lock:
+            self.ops["delete"] += 1
+            return self._delete(name)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.ops["incr"] += 1
+            value = int(self._get(name) or 0) + amount
+            self._set(name, str(value), self.expires.get(name))
+            return value
+
+    def expire(self, name, time_sec):
+        with self._lock:
+            self.ops["expire"] += 1
+            if self._is_expired(name):
+                return False
+            self._set(name, self.store[name], time.time() + time_sec)
+            return True
 
     def exists(self, name):
-        return not self._is_expired(name)
+        with self._lock:
+            self.ops["exists"] += 1
+            return not self._is_expired(name)
 
     def ttl(self, name):
-        if name not in self.store:
-            return -2
-        expiry = self.expires.get(name)
+        with self._lock:
+            self.ops["ttl"] += 1
+            if self._is_expired(name):
+                return -2
+            expiry = self.expires.get(name)
+            if expiry is None:
+                return -1
+            return max(0, int(expiry - time.time()))
+
+    def token_bucket(self, name, rate, capacity, cost=1):
+        """Same semantics as rate_limit.TOKEN_BUCKET_LUA. Returns (allowed, retry_after, remaining)."""
+        with self._lock:
+            self.ops["token_bucket"] += 1
+            now = time.time()
+            state = self._get(name) or {"tokens": capacity, "ts": now}
+            tokens = min(capacity, state["tokens"] + max(0.0, now - state["ts"]) * rate)
+            allowed = tokens >= cost
+            retry_after = 0.0
+            if allowed:
+                tokens -= cost
+            else:
+                retry_after = (cost - tokens) / rate
+            self._set(name, {"tokens": tokens, "ts": now}, now + capacity / rate + 1)
+            return allowed, retry_after, tokens
+
+    def sliding_window(self, name, limit, window):
+        """Same semantics as rate_limit.SLIDING_WINDOW_LUA. Returns (allowed, retry_after, remaining)."""
+        with self._lock:
+            self.ops["sliding_window"] += 1
+            now = time.time()
+            hits = [t for t in (self._get(name) or []) if t > now - window]
+            if len(hits) < limit:
+                hits.append(now)
+                self._set(name, hits, now + window)
+                return True, 0.0, limit - len(hits)
+            self._set(name, hits, self.expires.get(name))
+            return False, hits[0] + window - now, 0
+
+    def zadd(self, name, mapping, xx=False, ch=False):
+        with self._lock:
+            self.ops["zadd"] += 1
+            scores = self._get(name) or {}
+            added = changed = 0
+            for member, score in mapping.items():
+                member = str(member)
+                if member not in scores:
+                    if xx:
+                        continue
+                    added += 1
+                elif scores[member] != score:
+                    changed += 1
+                scores[member] = float(score)
+            if scores:
+                self._set(name, scores, self.expires.get(name))
+            return added + changed if ch else added
+
+    def zcard(self, name):
+        with self._lock:
+            self.ops["zcard"] += 1
+            return len(self._get(name) or {})
+
+    def zrangebyscore(self, name, min, max):
+        with self._lock:
+            self.ops["zrangebyscore"] += 1
+            scores = self._get(name) or {}
+            low, high = float(min), float(max)
+            return [member for member, score in sorted(scores.items(), key=lambda item: (item[1], item[0]))
+                    if low <= score <= high]
+
+    def presence_join(self, members, conns, user, now, ttl, key_ttl):
+        """Same semantics as presence.JOIN_LUA. Returns 1 if the user just came online."""
+        with self._lock:
+            self.ops["presence_join"] += 1
+            user = str(user)
+            scores = self._get(members) or {}
+            counts = self._get(conns) or {}
+            joined = user not in scores or scores[user] < now
+            counts[user] = 1 if joined else counts.get(user, 0) + 1
+            scores[user] = now + ttl
+            self._set(members, scores, time.time() + key_ttl)
+            self._set(conns, counts, time.time() + key_ttl)
+            return 1 if joined else 0
+
+    def presence_leave(self, members, conns, user):
+        """Same semantics as presence.LEAVE_LUA. Returns 1 if the user just went offline."""
+        with self._lock:
+            self.ops["presence_leave"] += 1
+            user = str(user)
+            counts = self._get(conns) or {}
+            left = counts.get(user, 0) - 1
+            if left > 0:
+                counts[user] = left
+                return 0
+            counts.pop(user, None)
+            scores = self._get(members) or {}
+            return 1 if scores.pop(user, None) is not None else 0
+
+    def presence_prune(self, members, conns, now, limit):
+        """Same semantics as presence.PRUNE_LUA. Returns the users whose entry expired."""
+        with self._lock:
+            self.ops["presence_prune"] += 1
+            scores = self._get(members) or {}
+            counts = self._get(conns) or {}
+            expired = sorted((user for user, score in scores.items() if score < now), key=scores.get)[:limit]
+            for user in expired:
+                del scores[user]
+                counts.pop(user, None)
+            return expired
+
+    def publish(self, channel, message):
+        self.ops["publish"] += 1
+        listeners = self.subscribers.get(channel, ())
+        for listener in listeners:
+            listener._messages.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(listeners)
+
+    def pubsub(self):
+        return MockPubSub(self)
+
+    def pipeline(self, transaction=True):
+        return MockPipeline(self)
+
+    def sweep(self, limit: Optional[int] = None) -> int:
+        """Removes keys whose expiry has passed, at most `limit` of them. Returns how many."""
+        removed = 0
+        with self._lock:
+            now = time.time()
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= now and (limit is None or removed < limit):
+                expiry, name = heapq.heappop(heap)
+                # Entries go stale when a key is overwritten or deleted
+                if self.expires.get(name) == expiry:
+                    self._delete(name)
+                    removed += 1
+            self.expired_by_sweep += removed
+        return removed
+
+    async def start(self):
+        if self._task is not None or self.sweep_interval <= 0:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            # In batches, so the lock is never held long on the event loop
+            while self.sweep(SWEEP_BATCH) == SWEEP_BATCH:
+                await asyncio.sleep(0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "keys": len(self.store),
+                "keys_with_ttl": len(self.expires),
+                "max_keys": self.max_keys,
+                "expiry_heap_size": len(self._expiry_heap),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired_on_access": self.expired_on_access,
+                "expired_by_sweep": self.expired_by_sweep,
+                "evicted": self.evicted,
+                "ops": dict(self.ops),
+            }
+
+    # The helpers below expect the lock to be held
+
+    def _get(self, name):
+        if self._is_expired(name):
+            return None
+        self.store.move_to_end(name)
+        return self.store[name]
+
+    def _set(self, name, value, expiry=None):
+        if name not in self.store and self.max_keys and len(self.store) >= self.max_keys:
+            # Prefer dropping dead keys over evicting live ones
+            if not (self._expiry_heap and self._expiry_heap[0][0] <= time.time() and self.sweep()):
+                oldest, _ = self.store.popitem(last=False)
+                self.expires.pop(oldest, None)
+                self.evicted += 1
+        self.store[name] = value
+        self.store.move_to_end(name)
         if expiry is None:
-            return -1
-        remaining = int(expiry - time.time())
-        return max(0, remaining) if remaining >= 0 else -2
+            self.expires.pop(name, None)
+        elif self.expires.get(name) != expiry:
+            self.expires[name] = expiry
+            heapq.heappush(self._expiry_heap, (expiry, name))
+            # Keys rewritten on every hit (rate limits) leave stale entries behind
+            if len(self._expiry_heap) > 2 * len(self.expires) + 1024:
+                self._expiry_heap = [(when, key) for key, when in self.expires.items()]
+                heapq.heapify(self._expiry_heap)
+
+    def _delete(self, name):
+        self.expires.pop(name, None)
+        return 1 if self.store.pop(name, None) is not None else 0
 
     def _is_expired(self, name):
         if name not in self.store:
             return True
         expiry = self.expires.get(name)
         if expiry and time.time() > expiry:
-            self.delete(name)
+            self._delete(name)
+            self.expired_on_access += 1
             return True
         return False
 
+class MockPipeline:
+    """
+    Queues commands and runs them together on `execute()`, like a redis-py
+    pipeline. The whole batch runs under the store lock, so it is atomic as
+    with MULTI/EXEC.
+    """
+    def __init__(self, client: MockRedis):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, command):
+        method = getattr(self._client, command)
+
+        def queue(*args, **kwargs):
+            self._commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.reset()
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        with self._client._lock:
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+
+    def reset(self):
+        self._commands = []
+
+class AsyncMockRedis:
+    """
+    `redis.asyncio`-style facade over a MockRedis, so async code can await the
+    same calls against either backend. Shares the sync client's data.
+    """
+    def __init__(self, client: MockRedis):
+        self.sync = client
+
+    def __getattr__(self, command):
+        method = getattr(self.sync, command)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    def pubsub(self):
+        return self.sync.pubsub()
+
+    def pipeline(self, transaction=True):
+        return AsyncMockPipeline(self.sync)
+
+    async def aclose(self):
+        pass
+
+class AsyncMockPipeline(MockPipeline):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.reset()
+
+    async def execute(self):
+        return MockPipeline.execute(self)
+
+# Connection pool, shared by every thread of this worker. A request waits up to
+# REDIS_POOL_TIMEOUT for a free connection instead of failing when all are busy.
+REDIS_POOL_OPTIONS = {
+    "max_connections": int(os.getenv("REDIS_MAX_CONNECTIONS", "50")),
+    "timeout": float(os.getenv("REDIS_POOL_TIMEOUT", "5")),
+    "socket_timeout": float(os.getenv("REDIS_SOCKET_TIMEOUT", "5")),
+    "socket_connect_timeout": float(os.getenv("REDIS_CONNECT_TIMEOUT", "5")),
+    # Idle connections are PINGed before reuse after this many seconds
+    "health_check_interval": int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30")),
+    "retry_on_timeout": True,
+    "decode_responses": True,
+}
+
 # Initialize actual Redis if URL is provided
 redis_url = os.getenv("REDIS_URL")
 if redis_url:
     try:
-        redis_client = redis.from_url(redis_url, decode_responses=True)
+        redis_client = redis.Redis.from_pool(
+            redis.BlockingConnectionPool.from_url(redis_url, **REDIS_POOL_OPTIONS)
+        )
         # Test connection
         redis_client.ping()
         print(f"Connected to Redis at {redis_url[:15]}...")
@@ -60,3 +449,15 @@ if redis_url:
 else:
     print("WARNING: REDIS_URL not found. Using MockRedis (In-Memory)")
     redis_client = MockRedis()
+
+if isinstance(redis_client, MockRedis):
+    metrics.register("mock_redis", redis_client.stats)
+
+# asyncio client for the event loop (WebSockets, async routes, pub/sub), with
+# its own pool; in-memory mode wraps the same MockRedis
+if isinstance(redis_client, MockRedis):
+    async_redis_client = AsyncMockRedis(redis_client)
+else:
+    async_redis_client = redis.asyncio.Redis.from_pool(
+        redis.asyncio.BlockingConnectionPool.from_url(redis_url, **REDIS_POOL_OPTIONS)
+    )
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from .. import schemas, crud, database, auth
+from .. import schemas, crud, database, auth, auth_cache, permissions
 
 router = APIRouter(
     prefix="/auth",
@@ -49,6 +49,7 @@ def sync_user_profile(
             
         db.commit()
         db.refresh(existing_user_by_email)
+        auth_cache.invalidate_user(supabase_uid)
         return existing_user_by_email
 
     # 4. Create New User
@@ -74,6 +75,8 @@ def sync_user_profile(
 
         db.commit()
         db.refresh(new_user)
+        auth_cache.invalidate_user(supabase_uid)
+        permissions.invalidate_user(new_user.id)
         return new_user
 
     except Exception as e:
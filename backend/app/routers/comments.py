@@ -1,8 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from .. import models, schemas, database
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from typing import List, Optional
+from .. import models, schemas, database, comment_tree
 from .. import auth as auth_utils
+from ..pagination import set_next_cursor
 
 router = APIRouter(
     prefix="/posts",
@@ -17,9 +19,62 @@ def read_comments(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    comments = db.query(models.Comment).filter(models.Comment.post_id == post_id).order_by(models.Comment.created_at.asc()).all()
+    # Every comment on the post is in this one result; the `replies` lists are
+    # filled from it in memory instead of one lazy load per comment
+    comments = db.query(models.Comment)\
+        .options(joinedload(models.Comment.owner))\
+        .filter(models.Comment.post_id == post_id, models.Comment.is_hidden.is_(False))\
+        .order_by(models.Comment.created_at.asc(), models.Comment.id.asc())\
+        .all()
+    replies = {}
+    for comment in comments:
+        replies.setdefault(comment.parent_id, []).append(comment)
+    for comment in comments:
+        set_committed_value(comment, "replies", replies.get(comment.id, []))
     return comments
 
+@router.get("/{post_id}/comments/tree", response_model=List[schemas.CommentThread])
+def read_comment_tree(
+    post_id: int,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    max_depth: int = Query(3, ge=0, le=10),
+    replies_limit: int = Query(3, ge=0, le=50),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    Top-level comments, oldest first, each with up to `replies_limit` replies
+    per level and `max_depth` levels deep. Page with the X-Next-Cursor header.
+    """
+    threads = comment_tree.load_threads(
+        db, post_id=post_id, limit=limit, cursor=cursor, max_depth=max_depth, replies_limit=replies_limit
+    )
+    set_next_cursor(response, threads, limit, lambda thread: (thread["created_at"], thread["id"]))
+    return threads
+
+@router.get("/comments/{comment_id}/replies", response_model=List[schemas.CommentThread])
+def read_comment_replies(
+    comment_id: int,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    max_depth: int = Query(2, ge=0, le=10),
+    replies_limit: int = Query(3, ge=0, le=50),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """
+    "Load more replies": the replies of one comment, as threads. Pass the
+    parent's `replies_cursor` as `cursor` to continue after the ones already shown.
+    """
+    threads = comment_tree.load_threads(
+        db, parent_id=comment_id, limit=limit, cursor=cursor, max_depth=max_depth, replies_limit=replies_limit
+    )
+    set_next_cursor(response, threads, limit, lambda thread: (thread["created_at"], thread["id"]))
+    return threads
+
 @router.post("/{post_id}/comments", response_model=schemas.Comment)
 def create_comment(
     post_id: int,
@@ -1,6 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from .. import models, schemas, database
+from typing import Dict, List
+from .. import models, schemas, database, http_cache
 from .. import auth as auth_utils
 
 router = APIRouter(
@@ -26,17 +29,52 @@ def toggle_like(
         models.PostLike.user_id == current_user.id
     )
     found_like = like_query.first()
-    
+    # The counter moves in the same transaction as the like row, with an
+    # atomic UPDATE so concurrent likes on the same post are not lost
+    counter = db.query(models.Post).filter(models.Post.id == post_id)
+
     if found_like:
         db.delete(found_like)
+        counter.update({models.Post.like_count: models.Post.like_count - 1}, synchronize_session=False)
         db.commit()
+        http_cache.invalidate(f"post:{post_id}")
         return {"message": "Unliked", "liked": False}
     else:
         new_like = models.PostLike(post_id=post_id, user_id=current_user.id)
         db.add(new_like)
-        db.commit()
+        counter.update({models.Post.like_count: models.Post.like_count + 1}, synchronize_session=False)
+        try:
+            db.commit()
+            http_cache.invalidate(f"post:{post_id}")
+        except IntegrityError:
+            # A concurrent request from the same user liked it first (uq_post_likes_post_user)
+            db.rollback()
         return {"message": "Liked", "liked": True}
 
+MAX_BATCH_POSTS = 200
+
+def like_states(db: Session, post_ids: List[int], user_id: int) -> Dict[int, dict]:
+    """{post_id: {"count", "is_liked"}} for the posts that exist, in one query."""
+    rows = db.query(models.Post.id, models.Post.like_count, models.PostLike.id)\
+        .outerjoin(models.PostLike, and_(
+            models.PostLike.post_id == models.Post.id,
+            models.PostLike.user_id == user_id
+        ))\
+        .filter(models.Post.id.in_(post_ids))\
+        .all()
+    return {post_id: {"count": count, "is_liked": like_id is not None} for post_id, count, like_id in rows}
+
+@router.get("/likes/batch")
+def get_likes_batch(
+    post_ids: List[int] = Query(...),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Like count and state for several posts at once, e.g. a whole feed page."""
+    if len(post_ids) > MAX_BATCH_POSTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_POSTS} post_ids per request")
+    return like_states(db, post_ids, current_user.id)
+
 @router.get("/{post_id}/likes")
 def get_likes(
     post_id: int,
@@ -44,10 +82,4 @@ def get_likes(
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
     # Return count and if current user liked
-    count = db.query(models.PostLike).filter(models.PostLike.post_id == post_id).count()
-    is_liked = db.query(models.PostLike).filter(
-        models.PostLike.post_id == post_id,
-        models.PostLike.user_id == current_user.id
-    ).first() is not None
-    
-    return {"count": count, "is_liked": is_liked}
+    return like_states(db, [post_id], current_user.id).get(post_id, {"count": 0, "is_liked": False})
@@ -1,8 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from sqlalchemy.orm import Session, joinedload
 from typing import List, Optional
-from .. import models, schemas, database
+from .. import models, schemas, database, http_cache, metrics, moderation
 from .. import auth as auth_utils
+from ..pagination import keyset_filter, set_next_cursor
+from ..websockets import manager
 
 router = APIRouter(
     prefix="/moderator",
@@ -13,16 +16,28 @@ get_db = database.get_db
 
 @router.get("/posts", response_model=List[schemas.Post])
 def get_all_posts_for_moderation(
+    response: Response,
     skip: int = 0,
     limit: int = 50,
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_mod: models.User = Depends(auth_utils.get_current_moderator)
 ):
     """
     Get all posts across all rooms for moderation.
     Only accessible by moderators and admins.
+    Pages with `cursor` (from the X-Next-Cursor header) or legacy `skip`.
     """
-    posts = db.query(models.Post).order_by(models.Post.created_at.desc()).offset(skip).limit(limit).all()
+    # One joined query for the page and its owners instead of one lookup per post
+    query = db.query(models.Post)\
+        .options(joinedload(models.Post.owner))\
+        .order_by(models.Post.created_at.desc(), models.Post.id.desc())
+    if cursor:
+        query = query.filter(keyset_filter((models.Post.created_at, models.Post.id), cursor))
+    else:
+        query = query.offset(skip)
+    posts = query.limit(limit).all()
+    set_next_cursor(response, posts, limit, lambda post: (post.created_at, post.id))
     return posts
 
 @router.delete("/posts/{post_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -41,4 +56,119 @@ def delete_post_as_moderator(
     
     db.delete(post)
     db.commit()
+    http_cache.invalidate(f"post:{post_id}")
     return None
+
+@router.post("/bulk", response_model=schemas.BulkModerationResult)
+async def bulk_moderate(
+    request: schemas.BulkModeration,
+    db: Session = Depends(get_db),
+    current_mod: models.User = Depends(auth_utils.get_current_moderator)
+):
+    """
+    Delete, hide or unhide many posts, comments or chat messages at once,
+    selected by `ids` and/or `author_id`, `room_id`, `since`, `until`.
+    Up to `limit` rows per call; repeat while `has_more` is set.
+    Each affected room gets a `moderation` event with the ids. Chat
+    messages are matched in the archive as well; pass the returned
+    `archive_after` back to resume its scan.
+    Needs the delete_any_* permission of the target.
+    """
+    if not moderation.has_filter(request):
+        raise HTTPException(status_code=400, detail="Give ids or at least one filter")
+    required = moderation.PERMISSIONS[request.target]
+    if not await asyncio.to_thread(auth_utils.has_permission, current_mod.id, required, db):
+        raise HTTPException(status_code=403, detail=f"Missing required permission: {required}")
+
+    affected = related_deleted = batches = handled = 0
+    room_ids = set()
+    has_more = False
+    # Table rows already changed no longer match, so the table is scanned from
+    # the start on every call; the archive resumes at `archive_after`
+    sources = [(moderation.apply_batch, 0)]
+    if request.target == "messages":
+        sources.append((moderation.apply_archive_batch, request.archive_after))
+    archive_after = request.archive_after
+    for apply, after_id in sources:
+        while True:
+            if handled >= request.limit:
+                has_more = True
+                break
+            size = min(moderation.BATCH_SIZE, request.limit - handled)
+            # Statements run on the sync engine, off the event loop
+            batch = await asyncio.to_thread(apply, request, after_id, size)
+            if batch is None:
+                break
+            after_id = batch.last_id
+            if apply is moderation.apply_archive_batch:
+                archive_after = after_id
+            handled += sum(len(ids) for ids in batch.rooms.values())
+            affected += batch.affected
+            related_deleted += batch.related_deleted
+            batches += 1
+            for room_id, ids in batch.rooms.items():
+                if room_id is None:
+                    continue
+                room_ids.add(room_id)
+                await manager.broadcast({
+                    "type": "moderation",
+                    "target": request.target,
+                    "action": request.action,
+                    "ids": ids,
+                }, room_id)
+        if has_more:
+            break
+
+    if request.target == "posts" and batches:
+        # Sync Redis client, off the event loop
+        await asyncio.to_thread(http_cache.invalidate, "posts")
+    return {
+        "target": request.target,
+        "action": request.action,
+        "affected": affected,
+        "related_deleted": related_deleted,
+        "batches": batches,
+        "room_ids": sorted(room_ids),
+        "has_more": has_more,
+        "archive_after": archive_after,
+    }
+
+@router.get("/metrics")
+def get_metrics(current_mod: models.User = Depends(auth_utils.get_current_moderator)):
+    """
+    In-process cache and pipeline counters for this worker.
+    Only accessible by moderators and admins.
+    """
+    return metrics.snapshot()
+
+@router.get("/deletion-jobs", response_model=List[schemas.DeletionJob])
+def list_deletion_jobs(
+    status: Optional[str] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_mod: models.User = Depends(auth_utils.get_current_moderator)
+):
+    """
+    Recent user and room deletions, newest first, optionally by status
+    (pending, running, done, failed).
+    Only accessible by moderators and admins.
+    """
+    query = db.query(models.DeletionJob).order_by(models.DeletionJob.id.desc())
+    if status:
+        query = query.filter(models.DeletionJob.status == status)
+    return query.limit(limit).all()
+
+@router.get("/deletion-jobs/{job_id}", response_model=schemas.DeletionJob)
+def get_deletion_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_mod: models.User = Depends(auth_utils.get_current_moderator)
+):
+    """
+    Progress of a deletion: current step and rows purged so far.
+    Only accessible by moderators and admins.
+    """
+    job = db.query(models.DeletionJob).filter(models.DeletionJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Deletion job not found")
+    return job
@@ -1,8 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 from typing import List, Optional
-from .. import models, schemas, database
+from .. import models, schemas, database, http_cache
 from .. import auth as auth_utils
+from .. import search as search_index
+from ..pagination import keyset_filter, set_next_cursor
 
 router = APIRouter(
     prefix="/posts",
@@ -10,32 +14,45 @@ router = APIRouter(
 )
 
 get_db = database.get_db
-
-from sqlalchemy import or_
+get_async_db = database.get_async_db
 
 @router.get("/", response_model=List[schemas.Post])
-def get_posts(
+async def get_posts(
+    response: Response,
     room_id: Optional[int] = None,
     search: Optional[str] = None,
     skip: int = 0, 
     limit: int = 100, 
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    query = db.query(models.Post)
-    if room_id:
-        query = query.filter(models.Post.room_id == room_id)
-    
+    """
+    Newest first. Pass the X-Next-Cursor header of a page as `cursor` to get
+    the next one; `skip` still works for older clients.
+    With `search`, results are ranked by relevance instead, best match first.
+    """
     if search:
-        search_filter = f"%{search}%"
-        query = query.filter(
-            or_(
-                models.Post.title.ilike(search_filter),
-                models.Post.content.ilike(search_filter)
-            )
-        )
-        
-    return query.order_by(models.Post.created_at.desc()).offset(skip).limit(limit).all()
+        rows = await search_index.search_posts(db, search, room_id=room_id, limit=limit, skip=skip, cursor=cursor)
+        set_next_cursor(response, rows, limit, lambda row: (row.rank, row.Post.id))
+        return [row.Post for row in rows]
+
+    # Owners are serialized with each post; lazy loading is not available on AsyncSession
+    query = select(models.Post)\
+        .options(selectinload(models.Post.owner))\
+        .where(models.Post.is_hidden.is_(False))
+    if room_id:
+        query = query.where(models.Post.room_id == room_id)
+
+    if cursor:
+        query = query.where(keyset_filter((models.Post.created_at, models.Post.id), cursor))
+    else:
+        query = query.offset(skip)
+
+    result = await db.execute(query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(limit))
+    posts = result.scalars().all()
+    set_next_cursor(response, posts, limit, lambda post: (post.created_at, post.id))
+    return posts
 
 @router.post("/", response_model=schemas.Post)
 def create_post(
@@ -43,6 +60,9 @@ def create_post(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.PermissionChecker("create_post"))
 ):
+    room = db.query(models.Room.id).filter(models.Room.id == post.room_id, models.Room.deleted_at.is_(None)).first()
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
     new_post = models.Post(**post.dict(), owner_id=current_user.id)
     db.add(new_post)
     db.commit()
@@ -67,6 +87,7 @@ def delete_post(
 
     db.delete(post)
     db.commit()
+    http_cache.invalidate(f"post:{post_id}")
     return None
 
 @router.put("/{post_id}", response_model=schemas.Post)
@@ -90,15 +111,21 @@ def update_post(
         
     db.commit()
     db.refresh(post)
+    http_cache.invalidate(f"post:{post_id}")
     return post
 
 @router.get("/{post_id}", response_model=schemas.Post)
 def get_post(
     post_id: int, 
+    request: Request,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    post = db.query(models.Post).filter(models.Post.id == post_id).first()
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-    return post
+    def build(response: Response):
+        post = db.query(models.Post).filter(models.Post.id == post_id, models.Post.is_hidden.is_(False)).first()
+        if not post:
+            raise HTTPException(status_code=404, detail="Post not found")
+        return schemas.Post.model_validate(post)
+
+    # "posts" covers writes that touch many posts at once (user or room deletion)
+    return http_cache.response_cache.respond(request, f"post:{post_id}", [f"post:{post_id}", "posts"], build)
@@ -1,9 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from typing import List
-from .. import models, schemas, database
+from datetime import datetime
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
+from .. import models, schemas, database, chat_archive, deletion_jobs, export, http_cache, presence, read_watermarks
 from .. import auth as auth_utils
-from ..redis_client import redis_client
+from ..chat_pipeline import pipeline as chat_pipeline
+from ..pagination import encode_cursor, keyset_filter, set_next_cursor
+from ..rate_limit import RateLimit, chat_limiter, enforce, export_limiter
 
 router = APIRouter(
     prefix="/rooms",
@@ -11,16 +18,39 @@ router = APIRouter(
 )
 
 get_db = database.get_db
+get_async_db = database.get_async_db
 
 @router.get("/", response_model=List[schemas.Room])
 def read_rooms(
+    request: Request,
     skip: int = 0, 
     limit: int = 100, 
+    cursor: Optional[str] = None,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    rooms = db.query(models.Room).offset(skip).limit(limit).all()
-    return rooms
+    def build(response: Response):
+        # Rooms have no timestamp, so the cursor is on id alone
+        query = db.query(models.Room).filter(models.Room.deleted_at.is_(None)).order_by(models.Room.id)
+        if cursor:
+            query = query.filter(keyset_filter((models.Room.id,), cursor, descending=False))
+        else:
+            query = query.offset(skip)
+        rooms = query.limit(limit).all()
+        set_next_cursor(response, rooms, limit, lambda room: (room.id,))
+        return [schemas.Room.model_validate(room) for room in rooms]
+
+    def with_online_counts(rooms):
+        # One pipelined ZCARD per page; too volatile to cache with the list
+        counts = presence.online_counts(room["id"] for room in rooms)
+        for room in rooms:
+            room["online_count"] = counts.get(room["id"], 0)
+        return rooms
+
+    # The same for every user; only the query string varies
+    return http_cache.response_cache.respond(
+        request, f"rooms?{request.url.query}", ["rooms"], build, overlay=with_online_counts
+    )
 
 @router.post("/", response_model=schemas.Room)
 def create_room(
@@ -36,6 +66,7 @@ def create_room(
     db.add(new_room)
     db.commit()
     db.refresh(new_room)
+    http_cache.invalidate("rooms")
     return new_room
 
 @router.post("/{room_id}/join")
@@ -44,7 +75,7 @@ def join_room(
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    room = db.query(models.Room).filter(models.Room.id == room_id).first()
+    room = db.query(models.Room).filter(models.Room.id == room_id, models.Room.deleted_at.is_(None)).first()
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
@@ -58,31 +89,132 @@ def join_room(
         # If already a member, toggle off (Leave)
         db.delete(is_member)
         db.commit()
+        http_cache.invalidate(f"memberships:{current_user.id}")
         return {"message": f"Left room {room.name}", "joined": False}
     else:
         new_member = models.RoomMember(user_id=current_user.id, room_id=room_id)
         db.add(new_member)
+        read_watermarks.start_at_latest(db, current_user.id, room_id)
         db.commit()
+        http_cache.invalidate(f"memberships:{current_user.id}")
         return {"message": f"Joined room {room.name}", "joined": True}
 
+@router.post("/{room_id}/read", status_code=status.HTTP_204_NO_CONTENT)
+def mark_read(
+    room_id: int,
+    read: schemas.ReadMark,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """For clients without the room socket open; written with the next watermark flush."""
+    is_member = db.query(models.RoomMember).filter(
+        models.RoomMember.user_id == current_user.id,
+        models.RoomMember.room_id == room_id
+    ).first()
+    if not is_member:
+        raise HTTPException(status_code=403, detail="Not a member of this room")
+    read_watermarks.writer.mark(current_user.id, room_id, read.message_id, read.post_id)
+
+@router.get("/{room_id}/presence", response_model=schemas.RoomPresence)
+def get_presence(
+    room_id: int,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(auth_utils.get_current_user)
+):
+    """Who is online in the room now; `presence` socket events carry the changes."""
+    room = db.query(models.Room.id).filter(models.Room.id == room_id, models.Room.deleted_at.is_(None)).first()
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    try:
+        user_ids = presence.online_users(room_id)
+    except Exception as e:
+        print(f"Presence: unavailable ({e})")
+        raise HTTPException(status_code=503, detail="Presence unavailable")
+    users = db.query(models.User.id, models.User.username).filter(models.User.id.in_(user_ids)).all() if user_ids else []
+    usernames = dict(users)
+    return {
+        "room_id": room_id,
+        "online_count": len(user_ids),
+        "users": [{"id": user_id, "username": usernames[user_id]} for user_id in user_ids if user_id in usernames],
+    }
+
 @router.get("/{room_id}/messages", response_model=List[schemas.ChatMessage])
-def get_messages(
+async def get_messages(
     room_id: int,
+    response: Response,
     limit: int = 50,
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    messages = db.query(models.ChatMessage).filter(
-        models.ChatMessage.room_id == room_id
-    ).order_by(models.ChatMessage.created_at.desc()).limit(limit).all()
+    """
+    Latest messages, oldest first. X-Next-Cursor points at the oldest message
+    of the page; pass it as `cursor` to page further back in history.
+    """
+    query = select(models.ChatMessage)\
+        .options(selectinload(models.ChatMessage.owner))\
+        .where(models.ChatMessage.room_id == room_id, models.ChatMessage.is_hidden.is_(False))
+    if cursor:
+        query = query.where(keyset_filter((models.ChatMessage.created_at, models.ChatMessage.id), cursor))
+    result = await db.execute(
+        query.order_by(models.ChatMessage.created_at.desc(), models.ChatMessage.id.desc()).limit(limit)
+    )
+    messages = result.scalars().all()
+    if len(messages) < limit:
+        # Paged past the oldest message in the table: continue in the archive
+        before = encode_cursor(messages[-1].created_at, messages[-1].id) if messages else cursor
+        messages = [*messages, *await chat_archive.read_before(db, room_id, before, limit - len(messages))]
+    set_next_cursor(response, messages, limit, lambda message: (message.created_at, message.id))
     
     return messages[::-1] # Return in chronological order (oldest first) for chat UI
 
+def _export(db: Session, room_id: int, kind: str, format: str, since: Optional[datetime], until: Optional[datetime]):
+    room = db.query(models.Room.id).filter(models.Room.id == room_id, models.Room.deleted_at.is_(None)).first()
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    # The session would otherwise stay checked out (in a transaction) until the stream ends
+    db.close()
+    return StreamingResponse(
+        export.stream(kind, room_id, format=format, since=since, until=until),
+        media_type=export.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="room-{room_id}-{kind}.{format}"'}
+    )
+
+@router.get("/{room_id}/export/messages")
+def export_messages(
+    room_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(RateLimit(export_limiter))
+):
+    """
+    The room's whole chat history (or `since`..`until`), oldest first,
+    streamed as NDJSON or CSV.
+    """
+    return _export(db, room_id, "messages", format, since, until)
+
+@router.get("/{room_id}/export/posts")
+def export_posts(
+    room_id: int,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(RateLimit(export_limiter))
+):
+    """
+    The room's posts (or those created `since`..`until`), oldest first,
+    streamed as NDJSON or CSV.
+    """
+    return _export(db, room_id, "posts", format, since, until)
+
 @router.post("/{room_id}/messages", response_model=schemas.ChatMessage)
-def send_message(
+async def send_message(
     room_id: int,
     message: schemas.ChatMessageCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     current_user: models.User = Depends(auth_utils.PermissionChecker("chat"))
 ):
 
@@ -90,37 +222,29 @@ def send_message(
     if not message.content or not message.content.strip():
         raise HTTPException(status_code=400, detail="Message content cannot be empty")
 
-    # 1. Verify membership
-    is_member = db.query(models.RoomMember).filter(
-        models.RoomMember.user_id == current_user.id,
-        models.RoomMember.room_id == room_id
-    ).first()
-    if not is_member:
+    # 1. Verify the room is still there and the user is a member
+    room = (await db.execute(
+        select(models.Room.id, models.RoomMember.user_id.label("member_id"))
+        .outerjoin(models.RoomMember, (models.RoomMember.room_id == models.Room.id) & (models.RoomMember.user_id == current_user.id))
+        .where(models.Room.id == room_id, models.Room.deleted_at.is_(None))
+    )).first()
+    if room is None:
+        raise HTTPException(status_code=404, detail="Room not found")
+    if room.member_id is None:
         raise HTTPException(status_code=403, detail="Must join room to send messages")
 
-    # 2. Rate Limiting (1 second)
-    rate_limit_key = f"chat_rate:{current_user.id}:{room_id}"
-    if redis_client.exists(rate_limit_key):
-        ttl = redis_client.ttl(rate_limit_key)
-        raise HTTPException(
-            status_code=429, 
-            detail=f"Please wait {ttl}s before sending another message"
-        )
+    # 2. Per user per room, the same budget as the room's WebSocket. Checked
+    # last, so rejected requests do not use it up
+    await enforce(chat_limiter, current_user.id, room_id)
 
-    # 3. Create Message
-    new_message = models.ChatMessage(
-        content=message.content.strip(),
+    # 3. Create Message (persisted by the write-behind pipeline)
+    new_message = await chat_pipeline.submit(
         room_id=room_id,
-        user_id=current_user.id
+        user_id=current_user.id,
+        content=message.content.strip()
     )
-    db.add(new_message)
-    db.commit()
-    db.refresh(new_message)
-
-    # 4. Set Rate Limit
-    redis_client.setex(rate_limit_key, 1, "1") # 1 second expiry
 
-    return new_message
+    return {**new_message, "owner": current_user}
 @router.delete("/messages/{message_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_message(
     message_id: int,
@@ -129,42 +253,55 @@ def delete_message(
 ):
     message = db.query(models.ChatMessage).filter(models.ChatMessage.id == message_id).first()
     if not message:
-        raise HTTPException(status_code=404, detail="Message not found")
+        # Older messages live in the archive
+        if chat_archive.delete_message(db.connection(), message_id) is None:
+            raise HTTPException(status_code=404, detail="Message not found")
+        db.commit()
+        return None
     
     db.delete(message)
     db.commit()
     return None
-@router.delete("/{room_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/{room_id}", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.DeletionJob)
 def delete_room(
     room_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.PermissionChecker("manage_rooms"))
 ):
-    room = db.query(models.Room).filter(models.Room.id == room_id).first()
+    room = db.query(models.Room).filter(models.Room.id == room_id, models.Room.deleted_at.is_(None)).first()
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    # Optional: Delete related members/messages if not handled by DB CASCADE
-    # For now, let's assume standard SQLAlchemy session delete
-    db.delete(room)
-    db.commit()
-    return None
+    # The room disappears now; its members, messages and posts are purged in the background
+    job = deletion_jobs.delete_room(db, room)
+    background_tasks.add_task(manager.close_room, room_id)
+    return job
 
 from fastapi import WebSocket, WebSocketDisconnect
 from ..websockets import manager
 import json
 
+def _authenticate_ws(token: str):
+    # Auth may provision users on first sight, so it stays on the sync
+    # session and runs in the threadpool instead of the event loop.
+    db = database.SessionLocal()
+    try:
+        user = auth_utils.get_user_from_token(token, db)
+        return user if user is not None and user.deleted_at is None else None
+    finally:
+        db.close()
+
 @router.websocket("/{room_id}/ws")
 async def websocket_endpoint(
     websocket: WebSocket, 
     room_id: int, 
-    token: str,
-    db: Session = Depends(get_db)
+    token: str
 ):
     # Authenticate User
     print(f"WS: Attempting connection for room {room_id}")
     try:
-        user = auth_utils.get_user_from_token(token, db)
+        user = await run_in_threadpool(_authenticate_ws, token)
         if not user:
              print("WS: Authentication failed - User not found or token invalid")
              await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
@@ -176,10 +313,15 @@ async def websocket_endpoint(
         return
 
     # Check Membership
-    is_member = db.query(models.RoomMember).filter(
-        models.RoomMember.user_id == user.id,
-        models.RoomMember.room_id == room_id
-    ).first()
+    # Sessions are opened per operation so an idle socket never pins a pooled connection
+    async with database.AsyncSessionLocal() as db:
+        is_member = await db.scalar(
+            select(models.RoomMember).join(models.Room, models.Room.id == models.RoomMember.room_id).where(
+                models.RoomMember.user_id == user.id,
+                models.RoomMember.room_id == room_id,
+                models.Room.deleted_at.is_(None)
+            )
+        )
     
     if not is_member:
         print(f"WS: User {user.username} is not a member of room {room_id}")
@@ -187,45 +329,56 @@ async def websocket_endpoint(
         return
 
     print("WS: Connection accepted, connecting to manager...")
-    await manager.connect(websocket, room_id)
+    await manager.connect(websocket, room_id, user.id)
     print("WS: Connected!")
     try:
         while True:
             data = await websocket.receive_text()
+            # Dropped from delivery: the room or the user was deleted and the close is on its way
+            if not manager.accepting(websocket):
+                continue
+
             # Expecting data to be just message content string or JSON?
             # Let's assume sending just the content string for simplicity or parse JSON if complex
             # If client sends JSON like {content: "hi"}, parse it.
             
             content = data
+            read = None
             try:
                 msg_data = json.loads(data)
-                if 'content' in msg_data:
+                if msg_data.get('type') == 'read':
+                    read = msg_data
+                elif 'content' in msg_data:
                     content = msg_data['content']
             except:
                 pass # Treat as raw string
+
+            if read is not None:
+                # {"type": "read", "message_id": 123}: memory only, flushed in batches
+                read_watermarks.writer.mark(user.id, room_id, read.get('message_id'), read.get('post_id'))
+                continue
             
             if not content.strip():
                 continue
 
-            # Basic Persistence
-            # Note: Heavy DB ops in async loop can block. Ideally use `await run_in_threadpool`.
-            # For this scale, direct sync DB call is 'okay' but 'async db' is better.
-            # We'll do a quick sync save.
-            
-            new_msg = models.ChatMessage(
-                content=content,
-                room_id=room_id,
-                user_id=user.id
-            )
-            db.add(new_msg)
-            db.commit()
-            db.refresh(new_msg)
+            limited = await chat_limiter.check(user.id, room_id)
+            if not limited.allowed:
+                manager.send_personal(websocket, {
+                    "type": "error",
+                    "detail": "Rate limited",
+                    "retry_after": round(limited.retry_after, 2)
+                })
+                continue
+
+            # Persistence is write-behind: the message gets its id now and
+            # is inserted with the next batch, so broadcast does not wait on the DB
+            new_msg = await chat_pipeline.submit(room_id=room_id, user_id=user.id, content=content)
             
             # Construct response schema
             response = {
-                "id": new_msg.id,
-                "content": new_msg.content,
-                "created_at": new_msg.created_at.isoformat(),
+                "id": new_msg["id"],
+                "content": new_msg["content"],
+                "created_at": new_msg["created_at"].isoformat(),
                 "user_id": user.id,
                 "owner": {
                     "username": user.username,
@@ -236,7 +389,7 @@ async def websocket_endpoint(
             await manager.broadcast(response, room_id)
             
     except WebSocketDisconnect:
-        manager.disconnect(websocket, room_id)
+        await manager.disconnect(websocket, room_id)
     except Exception as e:
         print(f"WS Error: {e}")
-        manager.disconnect(websocket, room_id)
+        await manager.disconnect(websocket, room_id)
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, Response, status
 from sqlalchemy.orm import Session
-from .. import models, schemas, database, crud
+from .. import models, schemas, database, deletion_jobs, http_cache, read_watermarks
 from .. import auth as auth_utils
+from ..websockets import manager
 
 router = APIRouter(
     prefix="/users",
@@ -31,37 +32,56 @@ def read_users_me(
 
 @router.get("/me/sidebar")
 def get_sidebar_data(
+    request: Request,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    # Return list of joined rooms
-    return {
-        "joined_rooms": [
-            {
-                "id": room.id,
-                "name": room.name
-            } for room in current_user.joined_rooms
-        ]
-    }
+    def build(response: Response):
+        # Return list of joined rooms
+        rooms = db.query(models.Room.id, models.Room.name)\
+            .join(models.RoomMember, models.RoomMember.room_id == models.Room.id)\
+            .filter(models.RoomMember.user_id == current_user.id, models.Room.deleted_at.is_(None))\
+            .order_by(models.Room.id).all()
+        return {"joined_rooms": [{"id": room.id, "name": room.name} for room in rooms]}
 
-@router.delete("/me", status_code=204)
+    def with_unread_counts(data):
+        # All joined rooms in one (cached) query
+        counts = read_watermarks.writer.counts(db, current_user.id)
+        for room in data["joined_rooms"]:
+            room["unread_messages"], room["unread_posts"] = counts.get(room["id"], (0, 0))
+        return data
+
+    # Per user: joins and leaves bump their memberships, room changes bump "rooms"
+    return http_cache.response_cache.respond(
+        request, f"sidebar:{current_user.id}", ["rooms", f"memberships:{current_user.id}"], build,
+        overlay=with_unread_counts
+    )
+
+@router.delete("/me", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.DeletionJob)
 def delete_user_me(
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_user: models.User = Depends(auth_utils.get_current_user)
 ):
-    crud.delete_user_cascade(db, current_user)
-    return None
+    # The account is closed now; its data is purged in the background
+    job = deletion_jobs.delete_user(db, current_user)
+    background_tasks.add_task(manager.close_user, current_user.id)
+    return job
 
-@router.delete("/{user_id}", status_code=204)
+@router.delete("/{user_id}", status_code=status.HTTP_202_ACCEPTED, response_model=schemas.DeletionJob)
 def delete_user_by_admin(
     user_id: int,
+    background_tasks: BackgroundTasks,
     db: Session = Depends(get_db),
     current_admin: models.User = Depends(auth_utils.get_current_moderator)
 ):
     """
     Allow admins/moderators to delete a user by ID.
     """
-    user_to_delete = db.query(models.User).filter(models.User.id == user_id).first()
+    user_to_delete = db.query(models.User).filter(
+        models.User.id == user_id,
+        models.User.deleted_at.is_(None)
+    ).first()
     if not user_to_delete:
         raise HTTPException(status_code=404, detail="User not found")
         
@@ -79,5 +99,6 @@ def delete_user_by_admin(
             if role_obj and role_obj.role_name == 'admin':
                  raise HTTPException(status_code=403, detail="Moderators cannot delete Admins")
 
-    crud.delete_user_cascade(db, user_to_delete)
-    return None
+    job = deletion_jobs.delete_user(db, user_to_delete)
+    background_tasks.add_task(manager.close_user, user_to_delete.id)
+    return job
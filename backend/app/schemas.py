@@ -1,5 +1,5 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field
+from typing import Literal, Optional, List
 from datetime import datetime
 
 class UserBase(BaseModel):
@@ -59,6 +59,8 @@ class Post(PostBase):
     created_at: datetime
     owner_id: int
     owner: User
+    like_count: int = 0
+    is_hidden: bool = False
     # comments: List["Comment"] = [] 
 
     class Config:
@@ -73,10 +75,26 @@ class RoomCreate(RoomBase):
 
 class Room(RoomBase):
     id: int
+    # Live, from presence; not stored
+    online_count: int = 0
 
     class Config:
         from_attributes = True
 
+class OnlineUser(BaseModel):
+    id: int
+    username: str
+
+class RoomPresence(BaseModel):
+    room_id: int
+    online_count: int
+    users: List[OnlineUser]
+
+class ReadMark(BaseModel):
+    # The newest chat message / post the user has seen in the room (32-bit ids)
+    message_id: Optional[int] = Field(None, gt=0, le=2**31 - 1)
+    post_id: Optional[int] = Field(None, gt=0, le=2**31 - 1)
+
 class CommentBase(BaseModel):
     content: str
     post_id: int # Explicitly keeping post_id in base for now
@@ -98,6 +116,19 @@ class Comment(CommentBase):
     class Config:
         from_attributes = True
 
+class CommentThread(CommentBase):
+    id: int
+    created_at: datetime
+    owner_id: int
+    owner: User
+    # Replies beyond the ones included are fetched from /posts/comments/{id}/replies
+    reply_count: int = 0
+    replies: List["CommentThread"] = []
+    replies_cursor: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
 class PasswordResetRequest(BaseModel):
     email: EmailStr
 
@@ -125,3 +156,47 @@ class ChatMessage(ChatMessageBase):
 
     class Config:
         from_attributes = True
+
+class DeletionJob(BaseModel):
+    id: int
+    entity_type: str
+    entity_id: int
+    status: str
+    step: Optional[str] = None
+    rows_deleted: int = 0
+    attempts: int = 0
+    error: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+class BulkModeration(BaseModel):
+    target: Literal["posts", "comments", "messages"]
+    action: Literal["delete", "hide", "unhide"]
+    # At least one of ids / author_id / room_id / since / until is required
+    ids: Optional[List[int]] = Field(None, max_length=10000)
+    author_id: Optional[int] = None
+    room_id: Optional[int] = None
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    # Rows handled per request; call again while `has_more` is set
+    limit: int = Field(5000, ge=1, le=50000)
+    # Chat messages: the `archive_after` of the previous call, so the archive
+    # scan resumes where it stopped
+    archive_after: int = Field(0, ge=0)
+
+class BulkModerationResult(BaseModel):
+    target: str
+    action: str
+    # Rows of the target changed (replies included for comments)
+    affected: int
+    # Comments, likes and saves removed with deleted posts
+    related_deleted: int
+    batches: int
+    room_ids: List[int]
+    has_more: bool
+    # Chat messages: where the archive scan stopped, to send with the next call
+    archive_after: int = 0
@@ -0,0 +1,151 @@
+"""
+Full-text search over posts.
+
+- Postgres: a stored generated `search_vector` tsvector column (title weighted
+  above content) with a GIN index. Postgres recomputes it on every INSERT and
+  UPDATE, and it goes away with the row.
+- SQLite: an external-content FTS5 table `posts_fts`, kept in sync with
+  `posts` by insert/update/delete triggers.
+
+Results are ranked (ts_rank_cd / bm25), can be scoped to a room, and page with
+a (rank, id) keyset cursor. Other databases, or a database whose index has not
+been created yet, fall back to the old ILIKE scan, newest first; its rows
+carry created_at as their rank, so the same cursor pages by (created_at, id).
+"""
+import re
+from typing import Optional
+
+from sqlalchemy import column, func, literal_column, or_, select, table, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from . import database, models
+from .pagination import keyset_filter
+
+TS_CONFIG = "english"
+
+_POSTGRES_DDL = [
+    f"""ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('{TS_CONFIG}', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('{TS_CONFIG}', coalesce(content, '')), 'B')
+    ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_posts_search_vector ON posts USING GIN (search_vector)",
+]
+
+_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(title, content, content='posts', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_ai AFTER INSERT ON posts BEGIN
+        INSERT INTO posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_ad AFTER DELETE ON posts BEGIN
+        INSERT INTO posts_fts(posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS posts_fts_au AFTER UPDATE OF title, content ON posts BEGIN
+        INSERT INTO posts_fts(posts_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO posts_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+]
+
+def ensure_search_index(connection):
+    """Creates the search column/index (Postgres) or FTS table and triggers (SQLite). Idempotent."""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        for statement in _POSTGRES_DDL:
+            connection.execute(text(statement))
+    elif dialect == "sqlite":
+        existed = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'")
+        ).first() is not None
+        for statement in _SQLITE_DDL:
+            connection.execute(text(statement))
+        if not existed:
+            # Index the posts written before the table existed
+            connection.execute(text("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')"))
+
+_index_ready: Optional[bool] = None
+
+async def _has_index(db: AsyncSession) -> bool:
+    global _index_ready
+    if _index_ready is None:
+        dialect = database.async_engine.dialect.name
+        if dialect == "postgresql":
+            probe = "SELECT 1 FROM information_schema.columns WHERE table_name = 'posts' AND column_name = 'search_vector'"
+        elif dialect == "sqlite":
+            probe = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'"
+        else:
+            _index_ready = False
+            return False
+        _index_ready = (await db.execute(text(probe))).first() is not None
+    return _index_ready
+
+def _fts5_query(term: str) -> str:
+    # Quote every word so user input cannot inject FTS5 syntax; prefix-match the last one
+    words = re.findall(r"\w+", term)
+    if not words:
+        return ""
+    quoted = [f'"{word}"' for word in words]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def _ranked_matches(term: str):
+    """SELECT id, rank for posts matching `term`; higher rank is better."""
+    dialect = database.async_engine.dialect.name
+    if dialect == "postgresql":
+        query = func.websearch_to_tsquery(TS_CONFIG, term)
+        vector = literal_column("posts.search_vector")
+        return select(models.Post.id.label("id"), func.ts_rank_cd(vector, query).label("rank"))\
+            .where(vector.op("@@")(query))
+    match = _fts5_query(term)
+    fts = table("posts_fts", column("rowid"))
+    # bm25() is lower-is-better, so negate it
+    return select(fts.c.rowid.label("id"), (-func.bm25(literal_column("posts_fts"))).label("rank"))\
+        .select_from(fts)\
+        .where(literal_column("posts_fts").op("MATCH")(match))
+
+async def search_posts(
+    db: AsyncSession,
+    term: str,
+    room_id: Optional[int] = None,
+    limit: int = 100,
+    skip: int = 0,
+    cursor: Optional[str] = None,
+):
+    """
+    Returns rows of (Post, rank), best match first.
+    Page with the cursor built from the last row's (rank, id).
+    """
+    if not await _has_index(db):
+        return await _search_posts_scan(db, term, room_id, limit, skip, cursor)
+    if database.async_engine.dialect.name == "sqlite" and not _fts5_query(term):
+        return []
+
+    ranked = _ranked_matches(term).subquery()
+    query = select(models.Post, ranked.c.rank)\
+        .join(ranked, ranked.c.id == models.Post.id)\
+        .options(selectinload(models.Post.owner))\
+        .where(models.Post.is_hidden.is_(False))
+    if room_id:
+        query = query.where(models.Post.room_id == room_id)
+    if cursor:
+        query = query.where(keyset_filter((ranked.c.rank, models.Post.id), cursor))
+    else:
+        query = query.offset(skip)
+    result = await db.execute(query.order_by(ranked.c.rank.desc(), models.Post.id.desc()).limit(limit))
+    return result.all()
+
+async def _search_posts_scan(db: AsyncSession, term: str, room_id: Optional[int], limit: int, skip: int,
+                             cursor: Optional[str] = None):
+    search_filter = f"%{term}%"
+    # The sort key stands in for the rank, so callers build the cursor the same way
+    query = select(models.Post, models.Post.created_at.label("rank"))\
+        .options(selectinload(models.Post.owner))\
+        .where(or_(models.Post.title.ilike(search_filter), models.Post.content.ilike(search_filter)))\
+        .where(models.Post.is_hidden.is_(False))
+    if room_id:
+        query = query.where(models.Post.room_id == room_id)
+    if cursor:
+        query = query.where(keyset_filter((models.Post.created_at, models.Post.id), cursor))
+    else:
+        query = query.offset(skip)
+    result = await db.execute(query.order_by(models.Post.created_at.desc(), models.Post.id.desc()).limit(limit))
+    return result.all()
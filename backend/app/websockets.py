@@ -1,33 +1,347 @@
-from typing import List, Dict
-from fastapi import WebSocket
+import asyncio
+import inspect
+import json
+import os
+from typing import Set, Dict, Optional
+from fastapi import WebSocket, status
+from . import metrics
+from .presence import PresenceTracker
+from .redis_client import async_redis_client
+
+try:
+    import orjson
+except ImportError:  # optional speedup
+    orjson = None
+
+SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+# What to do when a client's send queue is full: "drop_oldest" or "disconnect"
+SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+def encode_frame(message: dict) -> str:
+    """Encodes an event once into the text frame sent to every recipient."""
+    if orjson is not None:
+        return orjson.dumps(message).decode()
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False, default=str)
+
+class PubSubBroadcastBackend:
+    """
+    Fans room events out to every worker through Redis pub/sub.
+
+    Each worker subscribes only to the rooms it has local sockets for, on
+    channel `room_events:{room_id}`, plus `ws_control` for commands to every
+    worker (closing the sockets of a deleted room or user). Works with a
+    `redis.asyncio` client, or with `MockRedis` as an in-process stand-in
+    (single worker, tests).
+    """
+    CHANNEL_PREFIX = "room_events:"
+    CONTROL_CHANNEL = "ws_control"
+
+    def __init__(self, client):
+        self.client = client
+        self.pubsub = client.pubsub()
+        self._rooms = set()
+        self._control = False
+        self._has_rooms = asyncio.Event()
+
+    def _channel(self, room_id: int) -> str:
+        return f"{self.CHANNEL_PREFIX}{room_id}"
+
+    async def publish(self, room_id: int, payload: str):
+        result = self.client.publish(self._channel(room_id), payload)
+        if inspect.isawaitable(result):
+            await result
+
+    async def publish_control(self, payload: str):
+        result = self.client.publish(self.CONTROL_CHANNEL, payload)
+        if inspect.isawaitable(result):
+            await result
+
+    async def subscribe_control(self):
+        await self.pubsub.subscribe(self.CONTROL_CHANNEL)
+        self._control = True
+        self._has_rooms.set()
+
+    async def subscribe(self, room_id: int):
+        self._rooms.add(room_id)
+        await self.pubsub.subscribe(self._channel(room_id))
+        self._has_rooms.set()
+
+    def is_subscribed(self, room_id: int) -> bool:
+        return room_id in self._rooms
+
+    async def unsubscribe(self, room_id: int):
+        self._rooms.discard(room_id)
+        await self.pubsub.unsubscribe(self._channel(room_id))
+        if not self._rooms and not self._control:
+            self._has_rooms.clear()
+
+    async def listen(self):
+        """Yields (room_id, payload) for every event published to a subscribed room; room_id is None for control messages."""
+        while True:
+            # A pubsub connection with no subscriptions cannot be read from
+            await self._has_rooms.wait()
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if not message or message.get("type") != "message":
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if channel == self.CONTROL_CHANNEL:
+                yield None, message["data"]
+            else:
+                yield int(channel[len(self.CHANNEL_PREFIX):]), message["data"]
+
+    async def close(self):
+        await self.pubsub.aclose()
+
+class ClientConnection:
+    """
+    A socket's bounded outbound queue, drained by its own writer task, so a
+    slow client only ever delays itself.
+    """
+    def __init__(self, websocket: WebSocket, room_id: int, manager: "ConnectionManager"):
+        self.websocket = websocket
+        self.room_id = room_id
+        self.manager = manager
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.writer = asyncio.create_task(self._write())
+
+    def close(self, code: int, reason: str):
+        """Closes the socket once the frames already queued are sent."""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.manager.dropped_messages += 1
+        self.queue.put_nowait((code, reason))
+
+    def offer(self, frame: str) -> bool:
+        """Queues a pre-encoded frame without waiting. Returns False if the client should be dropped."""
+        try:
+            self.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                return False
+        self.queue.get_nowait()
+        self.queue.put_nowait(frame)
+        self.manager.dropped_messages += 1
+        return True
+
+    async def _write(self):
+        while True:
+            frame = await self.queue.get()
+            if isinstance(frame, tuple):
+                code, reason = frame
+                await self.manager._close_quietly(self.websocket, code, reason)
+                return
+            try:
+                await self.websocket.send_text(frame)
+            except Exception:
+                # Broken pipe or closed connection: stop sending to it right away
+                self.manager._evict(self)
+                return
 
 class ConnectionManager:
-    def __init__(self):
-        # Map room_id -> List of WebSockets
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+    def __init__(self, backend: Optional[PubSubBroadcastBackend] = None):
+        # Map room_id -> set of WebSockets (local to this worker)
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        self._clients: Dict[WebSocket, ClientConnection] = {}
+        # Sockets of signed-in users, for presence
+        self._users: Dict[WebSocket, int] = {}
+        self.backend = backend
+        self.presence = PresenceTracker(self.broadcast)
+        self._listener: Optional[asyncio.Task] = None
+        self._subscribing: Optional[asyncio.Lock] = None
+        self.dropped_messages = 0
+        self.evictions = 0
+        self.slow_consumer_disconnects = 0
+        self.closed_by_deletion = 0
+
+    async def start(self):
+        if self._listener is not None:
+            return
+        if self.backend is None:
+            self.backend = PubSubBroadcastBackend(async_redis_client)
+        self._subscribing = asyncio.Lock()
+        await self.backend.subscribe_control()
+        self._listener = asyncio.create_task(self._listen())
+        await self.presence.start()
+
+    async def stop(self):
+        if self._listener is None:
+            return
+        await self.presence.stop()
+        self._listener.cancel()
+        try:
+            await self._listener
+        except asyncio.CancelledError:
+            pass
+        self._listener = None
+        for client in self._clients.values():
+            client.writer.cancel()
+        await self.backend.close()
+        self.backend = None
 
-    async def connect(self, websocket: WebSocket, room_id: int):
+    async def connect(self, websocket: WebSocket, room_id: int, user_id: Optional[int] = None):
+        await self.start()
         await websocket.accept()
-        if room_id not in self.active_connections:
-            self.active_connections[room_id] = []
-        self.active_connections[room_id].append(websocket)
-
-    def disconnect(self, websocket: WebSocket, room_id: int):
-        if room_id in self.active_connections:
-            # Use a slightly safer remove in case it's already gone
-            if websocket in self.active_connections[room_id]:
-                self.active_connections[room_id].remove(websocket)
-            if not self.active_connections[room_id]:
+        first = room_id not in self.active_connections
+        self.active_connections.setdefault(room_id, set()).add(websocket)
+        self._clients[websocket] = ClientConnection(websocket, room_id, self)
+        if user_id is not None:
+            self._users[websocket] = user_id
+        if first:
+            await self._sync_subscription(room_id)
+        if user_id is not None:
+            await self.presence.join(room_id, user_id)
+
+    async def disconnect(self, websocket: WebSocket, room_id: int):
+        client = self._clients.pop(websocket, None)
+        if client is not None:
+            client.writer.cancel()
+        # Kept through evictions, so an evicted socket still leaves on disconnect
+        user_id = self._users.pop(websocket, None)
+        # Local bookkeeping first: the awaits below can be cancelled with the socket's task
+        room = self.active_connections.get(room_id)
+        emptied = False
+        if room is not None:
+            room.discard(websocket)
+            if not room:
                 del self.active_connections[room_id]
+                emptied = True
+        if user_id is not None:
+            await self.presence.leave(room_id, user_id)
+        if emptied:
+            await self._sync_subscription(room_id)
+
+    async def _sync_subscription(self, room_id: int):
+        """
+        Subscribes to a room or unsubscribes from it, whichever matches
+        whether it has local sockets right now. Serialized, so a socket
+        joining while the last one leaves never ends up without the channel.
+        """
+        if self.backend is None:
+            return
+        async with self._subscribing:
+            if self.backend is None:
+                return
+            wanted = room_id in self.active_connections
+            if wanted and not self.backend.is_subscribed(room_id):
+                await self.backend.subscribe(room_id)
+            elif not wanted and self.backend.is_subscribed(room_id):
+                await self.backend.unsubscribe(room_id)
+
+    def accepting(self, websocket: WebSocket) -> bool:
+        """False once the socket was dropped from delivery or is being closed; its messages are ignored."""
+        return websocket in self._clients
+
+    def send_personal(self, websocket: WebSocket, message: dict):
+        """Queues an event for one socket only (e.g. an error for its sender)."""
+        client = self._clients.get(websocket)
+        if client is not None:
+            self._offer(client, encode_frame(message))
+
+    def _evict(self, client: ClientConnection):
+        """Drops a client from delivery immediately; the room unsubscribe happens on disconnect."""
+        self.evictions += 1
+        self._clients.pop(client.websocket, None)
+        room = self.active_connections.get(client.room_id)
+        if room is not None:
+            room.discard(client.websocket)
 
     async def broadcast(self, message: dict, room_id: int):
-        if room_id in self.active_connections:
-            for connection in self.active_connections[room_id]:
-                try:
-                    await connection.send_json(message)
-                except Exception:
-                    # Handle broken pipe or closed connection gracefully-ish
-                    # Ideally we might want to schedule disconnection here, but let's keep it simple
-                    pass
+        """
+        Publishes to every worker; each one delivers to its own sockets.
+        The event is encoded once here and the same frame goes to every recipient.
+        """
+        await self.start()
+        frame = encode_frame(message)
+        try:
+            await self.backend.publish(room_id, frame)
+        except Exception as e:
+            # Broker unavailable: at least reach the sockets on this worker
+            print(f"WS: publish failed ({e}), delivering locally only")
+            self._deliver_local(frame, room_id)
+
+    async def close_room(self, room_id: int):
+        """Closes the sockets of a deleted room, on every worker."""
+        await self._publish_control({"type": "close_room", "room_id": room_id})
+
+    async def close_user(self, user_id: int):
+        """Closes every socket of a deleted user, on every worker."""
+        await self._publish_control({"type": "close_user", "user_id": user_id})
+
+    async def _publish_control(self, command: dict):
+        await self.start()
+        try:
+            await self.backend.publish_control(encode_frame(command))
+        except Exception as e:
+            print(f"WS: control publish failed ({e}), applying locally only")
+            self._control(command)
+
+    def _control(self, command: dict):
+        if command.get("type") == "close_room":
+            sockets = list(self.active_connections.get(command.get("room_id"), ()))
+            reason = "Room deleted"
+        elif command.get("type") == "close_user":
+            sockets = [websocket for websocket, user_id in self._users.items() if user_id == command.get("user_id")]
+            reason = "Account deleted"
+        else:
+            return
+        for websocket in sockets:
+            client = self._clients.get(websocket)
+            if client is None:
+                continue
+            # Out of delivery now; the endpoint cleans up when the close completes
+            self._clients.pop(websocket, None)
+            room = self.active_connections.get(client.room_id)
+            if room is not None:
+                room.discard(websocket)
+            client.close(status.WS_1008_POLICY_VIOLATION, reason)
+            self.closed_by_deletion += 1
+
+    async def _listen(self):
+        while True:
+            try:
+                async for room_id, frame in self.backend.listen():
+                    if room_id is None:
+                        self._control(json.loads(frame))
+                    else:
+                        self._deliver_local(frame, room_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WS: pub/sub listener error ({e}), retrying")
+                await asyncio.sleep(1)
+
+    def _deliver_local(self, frame: str, room_id: int):
+        for websocket in list(self.active_connections.get(room_id, ())):
+            client = self._clients.get(websocket)
+            if client is not None:
+                self._offer(client, frame)
+
+    def _offer(self, client: ClientConnection, frame: str):
+        if not client.offer(frame):
+            self.slow_consumer_disconnects += 1
+            self._evict(client)
+            client.writer.cancel()
+            asyncio.create_task(self._close_quietly(client.websocket, status.WS_1013_TRY_AGAIN_LATER, "Too slow"))
+
+    async def _close_quietly(self, websocket: WebSocket, code: int, reason: str):
+        try:
+            await websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self.active_connections),
+            "connections": len(self._clients),
+            "dropped_messages": self.dropped_messages,
+            "evictions": self.evictions,
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "closed_by_deletion": self.closed_by_deletion,
+        }
 
 manager = ConnectionManager()
+metrics.register("websockets", manager.stats)
+metrics.register("presence", manager.presence.stats)
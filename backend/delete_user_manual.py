@@ -1,12 +1,13 @@
 import sys
 import os
+import time
 from sqlalchemy.orm import Session
 
 # Add the current directory to sys.path so we can import app
 sys.path.append(os.getcwd())
 
 from app.database import SessionLocal
-from app import models
+from app import deletion_jobs, models
 
 def delete_user(user_id):
     db: Session = SessionLocal()
@@ -18,42 +19,28 @@ def delete_user(user_id):
 
         print(f"Deleting user: {user.username} (ID: {user.id})")
 
-        # Delete UserRoles
-        db.query(models.UserRoles).filter(models.UserRoles.user_id == user.id).delete()
-        
-        # Delete Room Memberships
-        db.query(models.RoomMember).filter(models.RoomMember.user_id == user.id).delete()
-        
-        # Delete Likes
-        db.query(models.PostLike).filter(models.PostLike.user_id == user.id).delete()
-        
-        # Delete Saved Posts
-        db.query(models.SavedPost).filter(models.SavedPost.user_id == user.id).delete()
-        
-        # Delete Chat Messages
-        db.query(models.ChatMessage).filter(models.ChatMessage.user_id == user.id).delete()
-        
-        # Delete Comments
-        db.query(models.Comment).filter(models.Comment.owner_id == user.id).delete()
-        
-        # Delete Posts (and their related data)
-        user_post_ids = db.query(models.Post.id).filter(models.Post.owner_id == user.id).all()
-        user_post_ids = [p[0] for p in user_post_ids]
-        
-        if user_post_ids:
-            # Delete comments on users posts
-            db.query(models.Comment).filter(models.Comment.post_id.in_(user_post_ids)).delete(synchronize_session=False)
-            # Delete likes on users posts
-            db.query(models.PostLike).filter(models.PostLike.post_id.in_(user_post_ids)).delete(synchronize_session=False)
-            # Delete saved entries of users posts
-            db.query(models.SavedPost).filter(models.SavedPost.post_id.in_(user_post_ids)).delete(synchronize_session=False)
-            
-        db.query(models.Post).filter(models.Post.owner_id == user.id).delete(synchronize_session=False)
-
-        # Finally delete the user
-        db.delete(user)
-        db.commit()
-        print("User deleted successfully.")
+        # Same batched purge the API queues, run to completion here
+        job = db.query(models.DeletionJob).filter(
+            models.DeletionJob.entity_type == "user",
+            models.DeletionJob.entity_id == user.id
+        ).first()
+        if job is None:
+            job = deletion_jobs.delete_user(db, user)
+        elif job.status == "failed":
+            print(f"Retrying deletion job {job.id}, which failed: {job.error}")
+            job.status, job.attempts = "pending", 0
+            db.commit()
+        # Only this job; one leased by a running worker (or by a failed
+        # attempt, until its lease runs out) is waited for
+        while True:
+            ran = deletion_jobs.worker.run_job(job.id)
+            db.refresh(job)
+            if job.status in ("done", "failed"):
+                break
+            if not ran:
+                print(f"Deletion job {job.id} is leased until {job.locked_until}, waiting...")
+                time.sleep(5)
+        print(f"Deletion job {job.id}: {job.status}, {job.rows_deleted} rows deleted.")
     except Exception as e:
         print(f"Error deleting user: {e}")
         db.rollback()
@@ -1,6 +1,7 @@
 
 import sys
 from app.database import engine
+from app import permissions
 from sqlalchemy import text
 
 def make_admin(username):
@@ -43,7 +44,10 @@ def make_admin(username):
             text("INSERT INTO user_roles (user_id, role_id) VALUES (:u_id, :r_id)"),
             {"u_id": user_id, "r_id": role_id}
         )
-        print(f"Success: User '{username}' has been promoted to admin.")
+
+    # After commit, so workers reload the new role assignment
+    permissions.bump_version()
+    print(f"Success: User '{username}' has been promoted to admin.")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
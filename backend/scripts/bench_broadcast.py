@@ -0,0 +1,102 @@
+"""
+Micro-benchmark: per-message CPU cost of a room broadcast.
+
+Compares the old delivery (send_json per socket, i.e. one JSON encode per
+recipient) with ConnectionManager, which encodes once and hands the same frame
+to every socket's writer. Two costs are reported per broadcast:
+
+- encode: JSON serialization only. This is O(N * encode) before and O(encode) now.
+- deliver: end to end through pub/sub and the per-socket writer tasks into
+  in-memory fake sockets. Once encoding is out of the loop, this is mostly
+  task scheduling, which is the price of isolating slow clients.
+
+Usage: python scripts/bench_broadcast.py [iterations]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.redis_client import MockRedis
+from app.websockets import ConnectionManager, PubSubBroadcastBackend, encode_frame
+
+ROOM_SIZES = [10, 100, 1000, 5000]
+
+MESSAGE = {
+    "id": 123456,
+    "content": "Can someone explain why the integral of 1/x is ln|x| and not ln(x)? " * 3,
+    "created_at": "2026-01-01T12:00:00.000000+00:00",
+    "user_id": 42,
+    "owner": {"username": "aspirant_42", "id": 42},
+}
+
+delivered = 0
+
+class FakeWebSocket:
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        # What Starlette's send_json does before writing the frame
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, data):
+        global delivered
+        delivered += 1
+
+def per_call(fn, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations
+
+async def per_call_async(fn, iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        await fn()
+    return (time.process_time() - start) / iterations
+
+async def bench(room_size: int, iterations: int):
+    sockets = [FakeWebSocket() for _ in range(room_size)]
+    manager = ConnectionManager(PubSubBroadcastBackend(MockRedis()))
+    await manager.start()
+    for websocket in sockets:
+        await manager.connect(websocket, 1)
+
+    def legacy_encode():
+        for _ in sockets:
+            json.dumps(MESSAGE, separators=(",", ":"), ensure_ascii=False)
+
+    async def legacy_deliver():
+        for websocket in sockets:
+            await websocket.send_json(MESSAGE)
+
+    async def deliver():
+        target = delivered + room_size
+        await manager.broadcast(MESSAGE, 1)
+        while delivered < target:
+            await asyncio.sleep(0)
+
+    results = (
+        per_call(legacy_encode, iterations),
+        per_call(lambda: encode_frame(MESSAGE), iterations),
+        await per_call_async(legacy_deliver, iterations),
+        await per_call_async(deliver, iterations),
+    )
+    await manager.stop()
+    return results
+
+async def main(iterations: int):
+    print(f"{'Room size':>9} | {'encode: per socket':>18} {'once':>10} | {'deliver: old':>12} {'new':>10}")
+    for room_size in ROOM_SIZES:
+        legacy_encode, encode, legacy_deliver, deliver = await bench(room_size, iterations)
+        print(
+            f"{room_size:>9} | {legacy_encode * 1000:>15.3f} ms {encode * 1000:>7.3f} ms"
+            f" | {legacy_deliver * 1000:>9.3f} ms {deliver * 1000:>7.3f} ms"
+        )
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20))
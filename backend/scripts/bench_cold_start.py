@@ -0,0 +1,53 @@
+"""
+Cold start: how long a fresh worker process takes from importing the app to
+finishing its startup hooks, and how many SQL statements it sends on the way.
+
+Each run is a separate interpreter, like a new uvicorn worker or a serverless
+cold start. Point DATABASE_URL at an already-migrated database to measure the
+steady state that every boot pays.
+
+Usage: python scripts/bench_cold_start.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import asyncio, time
+started = time.perf_counter()
+from sqlalchemy import event
+from app import database
+statements = []
+for target in (database.engine, database.async_engine.sync_engine):
+    event.listen(target, "before_cursor_execute", lambda *args: statements.append(1))
+imported_database = time.perf_counter()
+from app.main import app
+
+async def boot():
+    async with app.router.lifespan_context(app):
+        return time.perf_counter()
+
+ready = asyncio.run(boot())
+print(ready - started, ready - imported_database, len(statements))
+"""
+
+def main(runs: int):
+    totals, app_times, statements = [], [], []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        )
+        total, app_time, count = result.stdout.strip().splitlines()[-1].split()
+        totals.append(float(total))
+        app_times.append(float(app_time))
+        statements.append(int(count))
+    print(f"Runs: {runs}")
+    print(f"Process start to ready (median): {statistics.median(totals) * 1000:.0f} ms")
+    print(f"app.main import + startup (median): {statistics.median(app_times) * 1000:.0f} ms")
+    print(f"SQL statements per boot: {statistics.median(statements):.0f}")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,51 @@
+"""
+MockRedis under rate-limit traffic: keys written once and never read again.
+
+Writes one short-lived rate-limit key per (user, room), waits for them to
+expire, and shows how many are still held before and after a sweep. Then
+hammers one counter from many threads to check that no increment is lost,
+and prints the op counters exposed at /moderator/metrics.
+
+Usage: python scripts/bench_mock_redis.py [users] [rooms]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.rate_limit import TokenBucket
+from app.redis_client import MockRedis
+
+def main(users: int, rooms: int):
+    client = MockRedis(max_keys=0)
+    bucket = TokenBucket(1, 0.5)
+
+    started = time.perf_counter()
+    for user_id in range(users):
+        for room_id in range(rooms):
+            bucket.hit(client, f"rate:chat:{user_id}:{room_id}")
+    elapsed = time.perf_counter() - started
+    print(f"Rate-limit checks: {users * rooms} in {elapsed * 1000:.0f} ms")
+
+    time.sleep(1.6)
+    print(f"Keys held after expiry: {len(client.store)}")
+    started = time.perf_counter()
+    removed = client.sweep()
+    print(f"Sweep removed {removed} keys in {(time.perf_counter() - started) * 1000:.0f} ms, {len(client.store)} left")
+
+    bounded = MockRedis(max_keys=1000)
+    for i in range(5000):
+        bounded.setex(f"key:{i}", 60, i)
+    print(f"Bounded store: {len(bounded.store)} keys, {bounded.evicted} evicted")
+
+    threads, per_thread = 16, 5000
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda _: [client.incr("counter") for _ in range(per_thread)], range(threads)))
+    print(f"Concurrent incr: {client.get('counter')} (expected {threads * per_thread})")
+    print(f"Stats: {client.stats()}")
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*(args + [20000, 10][len(args):]))
@@ -0,0 +1,64 @@
+"""
+Round trips vs pipelining on the configured Redis (REDIS_URL, or MockRedis).
+
+Does the same batch of counter updates (INCR + EXPIRE per key) one command
+at a time, then as a single pipeline, on both the sync and the asyncio
+client.
+
+Usage: python scripts/bench_redis_pipeline.py [keys]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.redis_client import async_redis_client, redis_client
+
+def sync_bench(keys):
+    started = time.perf_counter()
+    for key in keys:
+        redis_client.incr(key)
+        redis_client.expire(key, 60)
+    one_by_one = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with redis_client.pipeline() as pipe:
+        for key in keys:
+            pipe.incr(key)
+            pipe.expire(key, 60)
+        pipe.execute()
+    return one_by_one, time.perf_counter() - started
+
+async def async_bench(keys):
+    started = time.perf_counter()
+    for key in keys:
+        await async_redis_client.incr(key)
+        await async_redis_client.expire(key, 60)
+    one_by_one = time.perf_counter() - started
+
+    started = time.perf_counter()
+    async with async_redis_client.pipeline() as pipe:
+        for key in keys:
+            pipe.incr(key)
+            pipe.expire(key, 60)
+        await pipe.execute()
+    pipelined = time.perf_counter() - started
+    await async_redis_client.aclose()
+    return one_by_one, pipelined
+
+def main(count: int):
+    keys = [f"bench:pipeline:{i}" for i in range(count)]
+    print(f"Client: {type(redis_client).__name__}, {count} keys x 2 commands")
+    for name, (one_by_one, pipelined) in [
+        ("sync", sync_bench(keys)),
+        ("asyncio", asyncio.run(async_bench(keys))),
+    ]:
+        print(f"{name:>8}: one by one {one_by_one * 1000:.1f} ms, pipelined {pipelined * 1000:.1f} ms "
+              f"({one_by_one / max(pipelined, 1e-9):.0f}x)")
+    for key in keys:
+        redis_client.delete(key)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
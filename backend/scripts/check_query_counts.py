@@ -0,0 +1,103 @@
+"""
+Regression check for N+1 queries in the list endpoints.
+
+Builds a throwaway SQLite database, then requests every list endpoint with a
+small and a large number of rows. An endpoint that loads owners (or replies)
+one row at a time issues more queries for the larger page; this script fails
+if any endpoint's query count depends on the number of rows returned.
+
+Usage: python scripts/check_query_counts.py
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/query_counts.db"
+os.environ.setdefault("LIKE_RECONCILE_INTERVAL", "0")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app.database import SessionLocal, async_engine, engine
+from app.main import app
+from app import models
+from generate_test_token import generate_token
+from make_admin import make_admin
+
+ROOM_ID = 1
+SIZES = (5, 50)
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        for target in (engine, async_engine.sync_engine):
+            event.listen(target, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        for target in (engine, async_engine.sync_engine):
+            event.remove(target, "before_cursor_execute", self)
+
+def seed(total: int, post_id: int):
+    """Brings the room and the post's comment thread up to `total` rows, each by a different user."""
+    db = SessionLocal()
+    posts = db.query(models.Post).filter(models.Post.room_id == ROOM_ID).count()
+    comments = db.query(models.Comment).filter(models.Comment.post_id == post_id).count()
+    for i in range(max(posts, comments), total):
+        user = models.User(username=f"author_{i}", email=f"author_{i}@example.com")
+        db.add(user)
+        db.flush()
+        if i >= posts:
+            db.add(models.Post(title=f"Post {i}", content="...", room_id=ROOM_ID, owner_id=user.id))
+        if i >= comments:
+            # Every other comment replies to the first one, so replies are exercised too
+            parent_id = None
+            if i % 2:
+                parent_id = db.query(models.Comment.id).filter(models.Comment.post_id == post_id)\
+                    .order_by(models.Comment.id).limit(1).scalar()
+            db.add(models.Comment(content=f"Comment {i}", post_id=post_id, owner_id=user.id, parent_id=parent_id))
+    db.commit()
+    db.close()
+
+def main():
+    headers = {"Authorization": "Bearer " + generate_token("query_counter", "query_counter@example.com", sub="query-counter")}
+    failures = 0
+    with TestClient(app) as client:
+        client.get("/users/me", headers=headers)
+        make_admin("query_counter")
+        client.post(f"/rooms/{ROOM_ID}/join", headers=headers)
+        post_id = client.post("/posts/", json={"title": "Thread", "content": "...", "room_id": ROOM_ID}, headers=headers).json()["id"]
+
+        endpoints = [
+            "/posts/?room_id=1&limit=100",
+            "/posts/?search=post&limit=100",
+            "/moderator/posts?limit=100",
+            f"/posts/{post_id}/comments",
+            f"/posts/{post_id}/comments/tree?limit=100",
+        ]
+        counts = {url: [] for url in endpoints}
+        for size in SIZES:
+            seed(size, post_id)
+            for url in endpoints:
+                client.get(url, headers=headers)  # warm caches so only the listing itself is counted
+                with QueryCounter() as counter:
+                    response = client.get(url, headers=headers)
+                counts[url].append((len(response.json()), counter.count))
+
+        for url, samples in counts.items():
+            queries = {count for _, count in samples}
+            status = "ok" if len(queries) == 1 else "FAIL"
+            failures += status == "FAIL"
+            print(f"{status:>4}  {url:<40} " + ", ".join(f"{rows} rows: {count} queries" for rows, count in samples))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
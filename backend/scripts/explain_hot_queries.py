@@ -0,0 +1,133 @@
+"""
+Checks that every hot query in the routers is served by an index.
+
+Runs EXPLAIN for each query against DATABASE_URL and fails if the plan reads
+a whole table. On Postgres, sequential scans are disabled for the session
+first, so the check does not depend on table sizes or statistics: if the
+plan still contains a Seq Scan, no usable index exists. Apply migrations
+first (python -m app.migrations).
+
+Usage: python scripts/explain_hot_queries.py
+"""
+import os
+import re
+import sys
+from datetime import datetime, timezone
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import select, text, tuple_
+
+from app import models, read_watermarks
+from app.database import engine
+
+NOW = datetime.now(timezone.utc)
+
+HOT_QUERIES = {
+    "rooms.get_messages (page)": select(models.ChatMessage)
+        .where(models.ChatMessage.room_id == 1, models.ChatMessage.is_hidden.is_(False))
+        .order_by(models.ChatMessage.created_at.desc(), models.ChatMessage.id.desc())
+        .limit(50),
+    "rooms.get_messages (cursor)": select(models.ChatMessage)
+        .where(models.ChatMessage.room_id == 1, models.ChatMessage.is_hidden.is_(False))
+        .where(tuple_(models.ChatMessage.created_at, models.ChatMessage.id) < tuple_(NOW, 1000))
+        .order_by(models.ChatMessage.created_at.desc(), models.ChatMessage.id.desc())
+        .limit(50),
+    "posts.get_posts (room)": select(models.Post)
+        .where(models.Post.room_id == 1, models.Post.is_hidden.is_(False))
+        .order_by(models.Post.created_at.desc(), models.Post.id.desc())
+        .limit(100),
+    "posts.get_posts (cursor)": select(models.Post)
+        .where(models.Post.room_id == 1, models.Post.is_hidden.is_(False))
+        .where(tuple_(models.Post.created_at, models.Post.id) < tuple_(NOW, 1000))
+        .order_by(models.Post.created_at.desc(), models.Post.id.desc())
+        .limit(100),
+    "export messages (window)": select(models.ChatMessage.id)
+        .where(models.ChatMessage.room_id == 1, models.ChatMessage.is_hidden.is_(False))
+        .where(tuple_(models.ChatMessage.created_at, models.ChatMessage.id) > tuple_(NOW, 1000))
+        .order_by(models.ChatMessage.created_at, models.ChatMessage.id)
+        .limit(50000),
+    "chat_archive.read_before": select(models.ChatArchiveSegment.data)
+        .where(models.ChatArchiveSegment.room_id == 1)
+        .where(tuple_(models.ChatArchiveSegment.first_created_at, models.ChatArchiveSegment.first_id) < tuple_(NOW, 1000))
+        .order_by(models.ChatArchiveSegment.first_created_at.desc(), models.ChatArchiveSegment.first_id.desc())
+        .limit(1),
+    "moderator.get_all_posts_for_moderation": select(models.Post)
+        .order_by(models.Post.created_at.desc(), models.Post.id.desc())
+        .limit(50),
+    "comments.read_comments": select(models.Comment)
+        .where(models.Comment.post_id == 1, models.Comment.is_hidden.is_(False))
+        .order_by(models.Comment.created_at, models.Comment.id),
+    "comment_tree replies": select(models.Comment.id)
+        .where(models.Comment.parent_id == 1)
+        .order_by(models.Comment.created_at, models.Comment.id)
+        .limit(3),
+    "likes.toggle_like": select(models.PostLike)
+        .where(models.PostLike.post_id == 1, models.PostLike.user_id == 1),
+    "likes.like_states": select(models.Post.id, models.Post.like_count, models.PostLike.id)
+        .outerjoin(models.PostLike, (models.PostLike.post_id == models.Post.id) & (models.PostLike.user_id == 1))
+        .where(models.Post.id.in_([1, 2, 3])),
+    "saved post lookup": select(models.SavedPost)
+        .where(models.SavedPost.user_id == 1, models.SavedPost.post_id == 1),
+    "permissions.roles_for": select(models.UserRoles.role_id)
+        .where(models.UserRoles.user_id == 1),
+    # Purge batches of deletion_jobs
+    "deletion: posts of a user": select(models.Post.id).where(models.Post.owner_id == 1).limit(1000),
+    "deletion: comments of a user": select(models.Comment.id).where(models.Comment.owner_id == 1).limit(1000),
+    "deletion: likes given": select(models.PostLike.id).where(models.PostLike.user_id == 1).limit(1000),
+    "deletion: saves of a post": select(models.SavedPost.id).where(models.SavedPost.post_id == 1).limit(1000),
+    "deletion: messages of a user": select(models.ChatMessage.id).where(models.ChatMessage.user_id == 1).limit(1000),
+    "deletion: members of a room": select(models.RoomMember.user_id).where(models.RoomMember.room_id == 1).limit(1000),
+    "moderation: bulk by author": select(models.ChatMessage.id)
+        .where(models.ChatMessage.user_id == 1, models.ChatMessage.id > 0)
+        .order_by(models.ChatMessage.id).limit(500),
+    "deletion: watermarks of a room": select(models.RoomReadWatermark.user_id)
+        .where(models.RoomReadWatermark.room_id == 1).limit(1000),
+    "users.get_sidebar_data (unread counts)": read_watermarks.unread_query(1),
+    "deletion: pending jobs": select(models.DeletionJob.id)
+        .where(models.DeletionJob.status.in_(["pending", "running"]))
+        .order_by(models.DeletionJob.id).limit(1),
+}
+
+# A full read of a table: Postgres Seq Scan, or a SQLite SCAN without an index
+FULL_SCAN = {
+    "postgresql": re.compile(r"Seq Scan on (\w+)"),
+    "sqlite": re.compile(r"^SCAN (\w+)$"),
+}
+# SQLite also SCANs the rows of a subquery in FROM, which is not a table
+SUBQUERY = re.compile(r"^(?:CO-ROUTINE|MATERIALIZE) (\w+)$")
+
+def explain(conn, statement):
+    compiled = statement.compile(engine, compile_kwargs={"render_postcompile": True})
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+    prefix = "EXPLAIN" if engine.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN"
+    return [str(row[-1]) for row in conn.exec_driver_sql(f"{prefix} {compiled}", params)]
+
+def main():
+    dialect = engine.dialect.name
+    full_scan = FULL_SCAN.get(dialect)
+    if full_scan is None:
+        print(f"Unsupported database: {dialect}")
+        sys.exit(2)
+
+    failures = 0
+    with engine.connect() as conn:
+        if dialect == "postgresql":
+            conn.execute(text("SET enable_seqscan = off"))
+        for name, statement in HOT_QUERIES.items():
+            plan = explain(conn, statement)
+            subqueries = {match.group(1) for line in plan if (match := SUBQUERY.search(line.strip()))}
+            scans = [match.group(1) for line in plan
+                     if (match := full_scan.search(line.strip())) and match.group(1) not in subqueries]
+            ok = not scans
+            failures += not ok
+            print(f"{'ok' if ok else 'FAIL':>4}  {name}" + ("" if ok else f"  (full scan of {', '.join(scans)})"))
+            for line in plan:
+                print(f"        {line}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
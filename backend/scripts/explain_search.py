@@ -0,0 +1,48 @@
+"""
+Shows how the database executes a post search, and how long it takes.
+
+On Postgres the plan should be a Bitmap Index Scan on ix_posts_search_vector,
+on SQLite a VIRTUAL TABLE INDEX scan of posts_fts; a Seq Scan / SCAN posts
+means the search index is missing.
+
+Usage: python scripts/explain_search.py "search terms" [room_id]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import text
+
+from app import search
+from app.database import AsyncSessionLocal, async_engine, engine
+
+async def main(term: str, room_id):
+    explain = "EXPLAIN ANALYZE" if engine.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN"
+    with engine.begin() as conn:
+        search.ensure_search_index(conn)
+        print(f"Posts: {conn.execute(text('SELECT count(*) FROM posts')).scalar()}")
+        compiled = search._ranked_matches(term).compile(engine)
+        if compiled.positional:
+            params = tuple(compiled.params[name] for name in compiled.positiontup)
+        else:
+            params = compiled.params
+        print("Plan:")
+        for row in conn.exec_driver_sql(f"{explain} {compiled}", params):
+            print(f"  {row[-1]}")
+
+    async with AsyncSessionLocal() as db:
+
+        await search.search_posts(db, term, room_id=room_id, limit=20)  # warm up
+        start = time.perf_counter()
+        rows = await search.search_posts(db, term, room_id=room_id, limit=20)
+        print(f"First page: {len(rows)} posts in {(time.perf_counter() - start) * 1000:.2f} ms")
+    await async_engine.dispose()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None))
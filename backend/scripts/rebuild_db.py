@@ -4,13 +4,14 @@ import os
 # Ensure backend directory is in python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from app import migrations
 from app.database import Base, engine, SessionLocal
 from app.models import Room, User
 from app.auth import get_password_hash
 
 def init_db():
     print("Dropping all tables...")
-    Base.metadata.drop_all(bind=engine)
+    migrations.reset_schema()
     
     print("Creating all tables...")
     Base.metadata.create_all(bind=engine)
@@ -32,8 +33,11 @@ def init_db():
         db.add(room)
     
     db.commit()
-    print("Database seeded successfully!")
     db.close()
 
+    # Indexes, search and roles/permissions; the rooms above are kept
+    migrations.migrate()
+    print("Database seeded successfully!")
+
 if __name__ == "__main__":
     init_db()
@@ -1,79 +1,118 @@
+"""
+Imports users from a CSV roster (default: users.csv) and gives them the
+normal_user role.
 
+The file is streamed in chunks of CHUNK_SIZE rows, so memory stays flat
+however large it is. Each chunk costs two statements in its own transaction:
+a multi-row INSERT ... ON CONFLICT DO NOTHING for the users (existing emails,
+usernames or supabase ids are skipped), and one INSERT ... SELECT assigning
+the role to every user of the chunk that lacks it. Re-running after a failure
+is safe: finished chunks are simply skipped over.
+
+Usage: python seed_users_from_csv.py [path] [chunk_size]
+"""
 import csv
 import os
-from sqlalchemy import text
+import sys
+import time
+from itertools import islice
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.dialects import postgresql, sqlite
 from app.database import engine
+from app import models, permissions
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def seed_users():
-    csv_file_path = 'users.csv'
-    
+CHUNK_SIZE = 1000
+# Seconds between progress lines
+PROGRESS_INTERVAL = 1.0
+
+users = models.User.__table__
+
+ASSIGN_ROLE = text("""
+    INSERT INTO user_roles (user_id, role_id)
+    SELECT users.id, :role_id FROM users
+    WHERE (users.email IN :emails OR users.username IN :usernames)
+      AND NOT EXISTS (
+          SELECT 1 FROM user_roles WHERE user_roles.user_id = users.id AND user_roles.role_id = :role_id
+      )
+""").bindparams(bindparam("emails", expanding=True), bindparam("usernames", expanding=True))
+
+def _insert_users():
+    dialect_insert = postgresql.insert if engine.dialect.name == "postgresql" else sqlite.insert
+    return dialect_insert(users).on_conflict_do_nothing().returning(users.c.id)
+
+def _user_values(row: dict) -> dict:
+    return {
+        "username": row['username'].strip(),
+        "email": row['email'].strip(),
+        "full_name": row.get('full_name') or None,
+        "date_of_birth": row.get('date_of_birth') or None,
+        "hashed_password": row.get('hashed_password') or None,
+        "is_verified": (row.get('is_verified') or '').lower() == 'true',
+        # Blank ids would collide on the unique constraint
+        "supabase_id": row.get('supabase_id') or None,
+    }
+
+def _chunks(reader, size: int):
+    while True:
+        chunk = list(islice(reader, size))
+        if not chunk:
+            return
+        yield chunk
+
+def seed_users(csv_file_path: str = 'users.csv', chunk_size: int = CHUNK_SIZE):
     if not os.path.exists(csv_file_path):
         print(f"Error: {csv_file_path} not found.")
         return
 
-    with engine.begin() as conn:
+    with engine.connect() as conn:
         # Get normal_user role ID
-        role_res = conn.execute(text("SELECT id FROM roles WHERE role_name = 'normal_user'")).fetchone()
-        if not role_res:
-            print("Error: 'normal_user' role not found. Please ensure roles are seeded first.")
-            return
-        normal_role_id = role_res[0]
-
-        with open(csv_file_path, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # Check if user already exists by email or username
-                existing = conn.execute(
-                    text("SELECT id FROM users WHERE email = :email OR username = :username"),
-                    {"email": row['email'], "username": row['username']}
-                ).fetchone()
-
-                if existing:
-                    print(f"User {row['username']} ({row['email']}) already exists. Skipping.")
-                    user_id = existing[0]
-                else:
-                    # Insert new user
-                    # We'll let the database handle the ID generation to avoid conflicts with existing sequences
-                    try:
-                        res = conn.execute(
-                            text("""
-                                INSERT INTO users (username, email, full_name, date_of_birth, hashed_password, is_verified, supabase_id)
-                                VALUES (:username, :email, :full_name, :date_of_birth, :hashed_password, :is_verified, :supabase_id)
-                                RETURNING id
-                            """),
-                            {
-                                "username": row['username'],
-                                "email": row['email'],
-                                "full_name": row['full_name'],
-                                "date_of_birth": row['date_of_birth'],
-                                "hashed_password": row['hashed_password'],
-                                "is_verified": row['is_verified'].lower() == 'true',
-                                "supabase_id": row['supabase_id']
-                            }
-                        )
-                        user_id = res.fetchone()[0]
-                        print(f"Created user: {row['username']}")
-                    except Exception as e:
-                        print(f"Error creating user {row['username']}: {e}")
-                        continue
-
-                # Ensure user has the normal_user role
-                role_exists = conn.execute(
-                    text("SELECT 1 FROM user_roles WHERE user_id = :u_id AND role_id = :r_id"),
-                    {"u_id": user_id, "r_id": normal_role_id}
-                ).fetchone()
-
-                if not role_exists:
-                    conn.execute(
-                        text("INSERT INTO user_roles (user_id, role_id) VALUES (:u_id, :r_id)"),
-                        {"u_id": user_id, "r_id": normal_role_id}
-                    )
-                    print(f"Assigned 'normal_user' role to {row['username']}")
-
-    print("Seeding completed.")
+        normal_role_id = conn.execute(
+            select(models.Roles.id).where(models.Roles.role_name == 'normal_user')
+        ).scalar()
+    if not normal_role_id:
+        print("Error: 'normal_user' role not found. Please ensure roles are seeded first.")
+        return
+
+    insert_users = _insert_users()
+    read = created = roles = invalid = 0
+    started = reported = time.perf_counter()
+
+    with open(csv_file_path, mode='r', encoding='utf-8-sig', newline='') as csvfile:
+        for chunk in _chunks(csv.DictReader(csvfile), chunk_size):
+            read += len(chunk)
+            values = []
+            for row in chunk:
+                if not (row.get('username') or '').strip() or not (row.get('email') or '').strip():
+                    invalid += 1
+                    continue
+                values.append(_user_values(row))
+            if not values:
+                continue
+
+            with engine.begin() as conn:
+                created += len(conn.execute(insert_users, values).all())
+                roles += conn.execute(ASSIGN_ROLE, {
+                    "role_id": normal_role_id,
+                    "emails": [v["email"] for v in values],
+                    "usernames": [v["username"] for v in values],
+                }).rowcount
+
+            now = time.perf_counter()
+            if now - reported >= PROGRESS_INTERVAL:
+                reported = now
+                print(f"{read} rows read, {created} users created, {roles} roles assigned "
+                      f"({read / (now - started):.0f} rows/s)")
+
+    permissions.bump_version()
+    elapsed = time.perf_counter() - started
+    print(f"Seeding completed in {elapsed:.1f}s ({read / max(elapsed, 1e-9):.0f} rows/s): {read} rows, "
+          f"{created} created, {read - created - invalid} already existed, {invalid} invalid, "
+          f"{roles} roles assigned.")
 
 if __name__ == "__main__":
-    seed_users()
+    args = sys.argv[1:]
+    seed_users(args[0] if args else 'users.csv', int(args[1]) if len(args) > 1 else CHUNK_SIZE)